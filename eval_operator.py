@@ -35,6 +35,10 @@ def test_3d(config):
         ckpt = torch.load(ckpt_path)
         model.load_state_dict(ckpt['model'])
         print('Weights loaded from %s' % ckpt_path)
+    if 'adapter_ckpt' in config['test']:
+        # low-rank adapters finetuned on top of the pretrained weights
+        model.load_adapters(torch.load(config['test']['adapter_ckpt'])['adapter'])
+        print('Adapters loaded from %s' % config['test']['adapter_ckpt'])
     print(f'Resolution : {loader.S}x{loader.S}x{loader.T}')
     forcing = get_forcing(loader.S).to(device)
     eval_ns(model,
@@ -0,0 +1,127 @@
+'''
+Export trained FNO2d / FNO3d models for CPU inference, e.g.
+python3 export_model.py --config_paths configs/test/Re500-05s.yaml configs/test/darcy.yaml --outdir exp/export
+
+The pointwise layers (fc0, fc1, fc2, ... and the 1x1 Conv1d ws, rewritten as nn.Linear) are quantized to int8
+with dynamic quantization, the spectral weights are stored in float16 and multiplied in complex float32.
+The model is traced with torch.jit.trace on the grid of the test data into a single .pt file,
+which is loaded with torch.jit.load and needs no code of this repo.
+The test error of the exported model is compared with the float32 model on the same test data.
+'''
+import os
+import copy
+import yaml
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+
+from prune_modes import build, val_error, time_inference
+
+
+class PointwiseLinear(nn.Module):
+    '''
+    1x1 Conv1d as an nn.Linear over the channels, so that dynamic quantization applies to it
+    '''
+    def __init__(self, conv):
+        super(PointwiseLinear, self).__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[..., 0])
+            self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        '''
+        x: (batchsize, in_channels, N) -> (batchsize, out_channels, N)
+        '''
+        return self.linear(x.transpose(1, 2)).transpose(1, 2).contiguous()
+
+
+def compress(model):
+    '''
+    Copy of the model with int8 pointwise layers and float16 spectral weights
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    model.ws = nn.ModuleList([PointwiseLinear(w) for w in model.ws])
+    for speconv in model.sp_convs:
+        speconv.store_half()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+@torch.no_grad()
+def export(model, batches, predict, path, meta):
+    '''
+    Trace the model on the input of the first test batch and save it with its metadata
+    '''
+    inputs = []
+    handle = model.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+    x, y = batches[0]
+    predict(model, x, y)
+    handle.remove()
+    traced = torch.jit.trace(model, (inputs[0], ), check_trace=False)
+    meta['input_shape'] = list(inputs[0].shape)
+    torch.jit.save(traced, path, _extra_files={'meta.yaml': yaml.dump(meta)})
+    return torch.jit.load(path)
+
+
+def file_size(path):
+    return os.path.getsize(path) / 2 ** 20
+
+
+def export_config(config_path, args):
+    with open(config_path, 'r') as stream:
+        config = yaml.load(stream, yaml.FullLoader)
+    device = torch.device('cpu')
+    model, dataloader, predict = build(config, device)
+    model.eval()
+    batches = []
+    for x, y in dataloader:
+        batches.append((x, y))
+        if args.n_test is not None and len(batches) * x.shape[0] >= args.n_test:
+            break
+
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    fp32_path = os.path.join(args.outdir, f'{name}-fp32.pt')
+    torch.save({'model': model.state_dict()}, fp32_path)
+    export_path = os.path.join(args.outdir, f'{name}-int8.pt')
+    exported = export(compress(model), batches, predict, export_path,
+                      {'config': config_path, 'model': config['model']})
+
+    err_fp32 = val_error(model, batches, predict)
+    err_export = val_error(exported, batches, predict)
+    with torch.no_grad():
+        diffs = []
+        for x, y in batches:
+            ref = predict(model, x, y)
+            diffs.append((torch.norm(predict(exported, x, y) - ref) / torch.norm(ref)).item())
+    t_fp32 = time_inference(model, batches, predict)
+    t_export = time_inference(exported, batches, predict)
+    result = {'config': name,
+              'test error fp32': err_fp32,
+              'test error export': err_export,
+              'delta': err_export - err_fp32,
+              'relative diff': sum(diffs) / len(diffs),
+              'size fp32 MB': file_size(fp32_path),
+              'size export MB': file_size(export_path),
+              'time fp32 ms': t_fp32 * 1000,
+              'time export ms': t_export * 1000}
+    print(f'{name}: test error {err_fp32:.5f} -> {err_export:.5f} ({err_export - err_fp32:+.2e}), '
+          f'relative difference to fp32 {result["relative diff"]:.2e}')
+    print(f'{name}: size {result["size fp32 MB"]:.2f} MB -> {result["size export MB"]:.2f} MB, '
+          f'CPU time per batch {t_fp32 * 1000:.2f} ms -> {t_export * 1000:.2f} ms; saved at {export_path}')
+    return result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--config_paths', type=str, nargs='+', help='Paths to the test configuration files')
+    parser.add_argument('--outdir', type=str, default='exp/export')
+    parser.add_argument('--n_test', type=int, default=None, help='Number of test samples, default all of them')
+    parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads')
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.outdir, exist_ok=True)
+    results = [export_config(config_path, args) for config_path in args.config_paths]
+    with open(os.path.join(args.outdir, 'report.yaml'), 'w') as f:
+        yaml.dump(results, f, sort_keys=False)
@@ -1,12 +1,15 @@
 import math
+import json
 import numpy as np
 import os
 from tqdm import tqdm
 
 import torch
-from solver.random_fields import GaussianRF, GaussianRF2d
+import torch.multiprocessing as mp
+from solver.random_fields import GaussianRF2d
 from solver.kolmogorov_flow import KolmogorovFlow2d
 from solver.periodic import NavierStokes2d
+from solver.spinup import SpinupCache, branch, kolmogorov_spinup
 from timeit import default_timer
 import argparse
 
@@ -20,28 +23,26 @@ def legacy_solver(args):
     sub = s // args.res_x
     
     n = 4   # forcing
-    Re = args.re
+    Re = args.re[0]
 
     T_in = 100.0
     T = args.T
     t = args.t_res
     dt = 1.0 / t
 
-    GRF = GaussianRF(2, s, 2 * math.pi, alpha=2.5, tau=7, device=device)
-    u0 = GRF.sample(1)
-
-    NS = KolmogorovFlow2d(u0, Re, n)
-    NS.advance(T_in, delta_t=1e-3)
+    w0 = kolmogorov_spinup(Re, s, n=n, T_in=T_in, seed=args.seed, 
+                           cache_dir=args.cache_dir, device=device)
+    NS = KolmogorovFlow2d(w0, Re, n)
 
     sol = np.zeros((T, t + 1, s // sub, s // sub))
-    sol_ini = NS.vorticity().squeeze(0).cpu().numpy()[::sub, ::sub]
+    sol_ini = NS.vorticity(res=s // sub).squeeze(0).cpu().numpy()
     pbar = tqdm(range(T))
     for i in pbar:
         sol[i, 0, :, :] = sol_ini
         for j in range(t):
             t1 = default_timer()
             NS.advance(dt, delta_t=1e-3)
-            sol[i, j + 1, :, :] = NS.vorticity().squeeze(0).cpu().numpy()[::sub, ::sub]
+            sol[i, j + 1, :, :] = NS.vorticity(res=s // sub).squeeze(0).cpu().numpy()
             t2 = default_timer()
         pbar.set_description(
             (
@@ -55,12 +56,24 @@ def legacy_solver(args):
     np.save(save_path, sol)
 
 
-def gen_data(args):
+def gen_data(args, seed=None, shard_id=None):
+    '''
+    Generate one batch of trajectories and save each of them as a .npy file
+    Args:
+        args: parsed options
+        seed: random seed of the initial conditions, default args.seed
+        shard_id: index of the shard, added to the file names when not None
+    Returns:
+        list of dicts with the saved file path and the parameters of each trajectory
+    '''
     dtype = torch.float64
-    device = torch.device('cuda:0')
+    device = torch.device(args.device)
     save_dir = args.outdir
     os.makedirs(save_dir, exist_ok=True)
-    
+    if seed is None:
+        seed = args.seed
+    torch.manual_seed(seed)
+
     T = args.T  # total time
     bsize = args.batchsize
     L = 2 * math.pi
@@ -69,29 +82,35 @@ def gen_data(args):
 
     t_res = args.t_res
     dt = 1 / t_res
-    re = args.re
+    # Reynolds number and forcing number of each sample
+    re_list, n_list = sample_params(args)
+    re = torch.tensor(re_list, dtype=dtype, device=device)
+    n = torch.tensor(n_list, dtype=dtype, device=device).view(-1, 1, 1)
 
     solver = NavierStokes2d(s,s,L,L,device=device,dtype=dtype)
     grf = GaussianRF2d(s,s,L,L,alpha=2.5,tau=3.0,sigma=None,device=device,dtype=dtype)
 
     t = torch.linspace(0, L, s+1, dtype=dtype, device=device)[0:-1]
     _, Y = torch.meshgrid(t, t, indexing='ij')
-    f = -4*torch.cos(4.0*Y)
+    # forcing -n cos(ny) of each sample
+    f = -n*torch.cos(n*Y)
     vor = np.zeros((bsize, T, t_res + 1, s // x_sub, s // x_sub))
 
-    pbar = tqdm(range(T))
-    w = grf.sample(bsize)
-    w = solver.advance(w, f, T=100, Re=re, adaptive=True)
+    pbar = tqdm(range(T), disable=not args.tqdm)
+    w = spinup(args, solver, grf, f, re, seed, device)
+    # keep the state in Fourier space and record snapshots on the coarse grid directly from the spectrum
+    w_h = torch.fft.rfft2(w)
+    r = s // x_sub
     
-    init_vor = w[:, ::x_sub, ::x_sub].cpu().type(torch.float32).numpy()
+    init_vor = solver.physical(w_h, r).cpu().type(torch.float32).numpy()
     for j in pbar:
         vor[:, j, 0, :, :] = init_vor
 
         for k in range(t_res):
             t1 = default_timer()
 
-            w = solver.advance(w, f, T=dt, Re=re, adaptive=True)
-            vor[:, j, k+1, :, :] = w[:,::x_sub,::x_sub].cpu().type(torch.float32).numpy()
+            w_h = solver.advance_h(w_h, f, T=dt, Re=re, adaptive=True)
+            vor[:, j, k+1, :, :] = solver.physical(w_h, r).cpu().type(torch.float32).numpy()
 
             t2 = default_timer()
 
@@ -102,22 +121,188 @@ def gen_data(args):
         )
         init_vor = vor[:, j, -1, :, :]
 
+    tag = '' if shard_id is None else f'_shard{shard_id}'
+    saved = []
     for i in range(bsize):
-        save_path = os.path.join(save_dir, f'NS-Re{int(re)}_T{T}_id{i}.npy')
+        save_path = os.path.join(save_dir, f'NS-Re{int(re_list[i])}_T{T}{tag}_id{i}.npy')
         # np.save('NS_fine_Re500_S512_s64_T500_t128.npy', sol)
         np.save(save_path, vor[i])
+        saved.append({'path': save_path, 're': re_list[i], 'forcing': n_list[i]})
+    return saved
+
+
+def sample_params(args):
+    '''
+    Assign the Reynolds numbers in args.re and the forcing numbers in args.forcing 
+    to the samples of a batch in a round-robin way.
+    '''
+    re_list = [float(args.re[i % len(args.re)]) for i in range(args.batchsize)]
+    n_list = [int(args.forcing[i % len(args.forcing)]) for i in range(args.batchsize)]
+    return re_list, n_list
+
+
+def spinup(args, solver, grf, f, re, seed, device):
+    '''
+    Spin up the initial vorticity for T=100 from GRF samples. 
+    The spun-up states are looked up in args.cache_dir if given. 
+    If args.branch_eps > 0, one state is spun up for each distinct (Re, forcing) of the batch, 
+    and the trajectories of that group are branched from it.
+    '''
+    re_list, n_list = sample_params(args)
+    if args.branch_eps <= 0:
+        def run():
+            w = grf.sample(args.batchsize)
+            return solver.advance(w, f, T=100, Re=re, adaptive=True)
+
+        if args.cache_dir is None:
+            return run()
+        params = {'solver': 'NavierStokes2d', 'Re': re_list, 'res': args.x_res, 
+                  'forcing': [f'-{k}cos({k}y)' for k in n_list], 'grf': {'alpha': 2.5, 'tau': 3.0}, 
+                  'seed': seed, 'batchsize': args.batchsize, 'T_in': 100.0}
+        return SpinupCache(args.cache_dir).get(params, run, device=device)
+
+    # samples sharing the same Reynolds number and forcing
+    groups = {}
+    for i, key in enumerate(zip(re_list, n_list)):
+        groups.setdefault(key, []).append(i)
+    w = torch.zeros(args.batchsize, args.x_res, args.x_res, dtype=f.dtype, device=device)
+    for g, ((Re, k), idx) in enumerate(groups.items()):
+        group_seed = seed + g
+
+        def run():
+            torch.manual_seed(group_seed)
+            w0 = grf.sample(1)
+            return solver.advance(w0, f[idx[0]: idx[0] + 1], T=100, Re=re[idx[0]: idx[0] + 1], adaptive=True)
+
+        if args.cache_dir is None:
+            w_group = run()
+        else:
+            params = {'solver': 'NavierStokes2d', 'Re': [Re], 'res': args.x_res, 
+                      'forcing': [f'-{k}cos({k}y)'], 'grf': {'alpha': 2.5, 'tau': 3.0}, 
+                      'seed': group_seed, 'batchsize': 1, 'T_in': 100.0}
+            w_group = SpinupCache(args.cache_dir).get(params, run, device=device)
+        w[idx] = branch(w_group, len(idx), eps=args.branch_eps, seed=group_seed).to(w.dtype)
+    return w
+
+
+def shard_seeds(seed, num_shards):
+    '''
+    Derive independent seeds for each shard from the global seed. 
+    The seed of a shard does not depend on the number of workers.
+    '''
+    seqs = np.random.SeedSequence(seed).spawn(num_shards)
+    return [int(seq.generate_state(1)[0]) for seq in seqs]
+
+
+def _run_shard(job):
+    args, shard_id, seed, num_threads = job
+    torch.set_num_threads(num_threads)
+    t1 = default_timer()
+    saved = gen_data(args, seed=seed, shard_id=shard_id)
+    t2 = default_timer()
+    return shard_id, seed, saved, t2 - t1
+
+
+def _write_json(path, obj):
+    # write to a temporary file first so that an interrupted run never leaves a broken manifest
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+MANIFEST_KEYS = ['re', 'forcing', 'x_res', 'x_sub', 'T', 't_res', 'batchsize', 'seed', 'branch_eps']
+
+
+def gen_farm(args):
+    '''
+    Split num_batchs x batchsize trajectories into num_batchs shards and run the shards 
+    on a process pool. Finished shards are tracked in outdir/manifest.json so that an 
+    interrupted run can be resumed. All trajectories are listed in outdir/index.json at the end.
+    '''
+    os.makedirs(args.outdir, exist_ok=True)
+    manifest_path = os.path.join(args.outdir, 'manifest.json')
+    config = {key: getattr(args, key) for key in MANIFEST_KEYS}
+    num_shards = args.num_batchs
+    seeds = shard_seeds(args.seed, num_shards)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['config'] != config:
+            raise ValueError(f'{manifest_path} was created with {manifest["config"]}, '
+                             f'which does not match the current options {config}')
+    else:
+        manifest = {'config': config, 'shards': {}}
+
+    done = set()
+    for key, shard in manifest['shards'].items():
+        if all(os.path.exists(traj['path']) for traj in shard['files']):
+            done.add(int(key))
+    jobs = [(args, i, seeds[i]) for i in range(num_shards) if i not in done]
+    print(f'{len(done)} of {num_shards} shards already finished; {len(jobs)} to go')
+
+    if args.num_workers is None:
+        num_workers = min(len(jobs), os.cpu_count()) if args.device == 'cpu' else 1
+    else:
+        num_workers = args.num_workers
+    num_workers = max(1, min(num_workers, len(jobs)))
+    if args.threads is None:
+        num_threads = max(1, os.cpu_count() // num_workers)
+    else:
+        num_threads = args.threads
+    jobs = [job + (num_threads, ) for job in jobs]
+
+    if jobs:
+        print(f'Running {len(jobs)} shards on {num_workers} workers with {num_threads} threads each')
+        if num_workers == 1:
+            results = map(_run_shard, jobs)
+            pool = None
+        else:
+            # spawn instead of fork so that CUDA can be initialized in the workers
+            pool = mp.get_context('spawn').Pool(num_workers)
+            results = pool.imap_unordered(_run_shard, jobs)
+        for shard_id, seed, saved, time_cost in results:
+            manifest['shards'][str(shard_id)] = {'seed': seed, 'files': saved, 'time': time_cost}
+            _write_json(manifest_path, manifest)
+            print(f'Shard {shard_id} done in {time_cost:.1f}s')
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # merge shards into one index
+    index = []
+    for i in range(num_shards):
+        shard = manifest['shards'][str(i)]
+        for j, traj in enumerate(shard['files']):
+            index.append({'path': os.path.relpath(traj['path'], args.outdir), 
+                          'shard': i, 'id': j, 
+                          'seed': shard['seed'], 
+                          're': traj['re'], 
+                          'forcing': traj['forcing']})
+    index_path = os.path.join(args.outdir, 'index.json')
+    _write_json(index_path, {'config': config, 'trajectories': index})
+    print(f'{len(index)} trajectories are indexed in {index_path}')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', type=int, default=0)
-    parser.add_argument('--re', type=float, default=40.0)
+    parser.add_argument('--re', type=float, nargs='+', default=[40.0], help='Reynolds numbers, assigned to the samples round-robin')
+    parser.add_argument('--forcing', type=int, nargs='+', default=[4], help='Forcing numbers n of -n cos(ny), assigned round-robin')
     parser.add_argument('--x_res', type=int, default=512)
     parser.add_argument('--x_sub', type=int, default=2)
     parser.add_argument('--T', type=int, default=300)
     parser.add_argument('--outdir', type=str, default='../data')
     parser.add_argument('--t_res', type=int, default=512)
     parser.add_argument('--batchsize', type=int, default=1)
-    parser.add_argument('--num_batchs', type=int, default=1)
+    parser.add_argument('--num_batchs', type=int, default=1, help='Number of shards, each has batchsize trajectories')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--threads', type=int, default=None, help='Number of threads per worker')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--tqdm', action='store_true', help='Turn on the tqdm')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the spun-up state cache')
+    parser.add_argument('--branch_eps', type=float, default=0.0, 
+                        help='If positive, branch the samples of each (Re, forcing) from one spun-up state with perturbations of this relative size')
     args = parser.parse_args()
-    gen_data(args)
\ No newline at end of file
+    gen_farm(args)
\ No newline at end of file
@@ -4,6 +4,7 @@ import random
 from argparse import ArgumentParser
 import math
 from tqdm import tqdm
+from timeit import default_timer
 
 import torch
 
@@ -13,8 +14,11 @@ from torch.utils.data import DataLoader, Subset
 from models import FNO3d
 
 from train_utils.losses import LpLoss, PINO_loss3d, get_forcing
-from train_utils.datasets import KFDataset, KFaDataset, sample_data
-from train_utils.utils import save_ckpt, count_params, dict2str
+from train_utils.datasets import KFDataset, KFaDataset, ResumableIterator
+from train_utils.utils import count_params, dict2str
+from train_utils.metrics import MetricAccumulator, ConvergenceMonitor
+from train_utils.checkpoint import CheckpointWriter, load_state
+from train_utils.warm_start import WarmStartStore
 
 try:
     import wandb
@@ -22,15 +26,87 @@ except ImportError:
     wandb = None
 
 
+def refine_lbfgs(model, a_in, u, forcing, lbfgs_config, config, 
+                 tolerance=None, start_iter=0, t_start=None, log=False):
+    '''
+    Second phase of the test-time optimization: L-BFGS with strong Wolfe line search on the PINO loss of the instance
+    Args:
+        a_in, u: input and truth of the instance
+        forcing: forcing term at the PDE resolution
+        lbfgs_config: dict with num_steps and optionally lr, max_iter, history_size, tolerance_grad, tolerance_change
+        tolerance: report when the PDE residual falls below, None if it has been reached already
+        start_iter: iteration of the first step, for logging
+        t_start: start time of the optimization, for the wall-clock to tolerance
+    Returns:
+        dict with the number of steps and loss evaluations, 
+        the iterations (Adam steps + loss evaluations) and wall-clock to tolerance
+    '''
+    v = 1/ config['data']['Re']
+    t_duration = config['data']['t_duration']
+    ic_weight = config['train']['ic_loss']
+    f_weight = config['train']['f_loss']
+    lploss = LpLoss(size_average=True)
+    u0 = a_in[:, :, :, 0, -1]
+
+    tolerance_change = lbfgs_config['tolerance_change'] if 'tolerance_change' in lbfgs_config else 1e-12
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.LBFGS(params, 
+                                  lr=lbfgs_config['lr'] if 'lr' in lbfgs_config else 1.0, 
+                                  max_iter=lbfgs_config['max_iter'] if 'max_iter' in lbfgs_config else 20, 
+                                  history_size=lbfgs_config['history_size'] if 'history_size' in lbfgs_config else 50, 
+                                  tolerance_grad=lbfgs_config['tolerance_grad'] if 'tolerance_grad' in lbfgs_config else 1e-9, 
+                                  tolerance_change=tolerance_change, 
+                                  line_search_fn='strong_wolfe')
+    losses = {}
+
+    def closure():
+        optimizer.zero_grad()
+        out = model(a_in)
+        loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
+        loss = loss_f * f_weight + loss_ic * ic_weight
+        loss.backward()
+        losses.update({'IC': loss_ic.detach(), 'PDE': loss_f.detach(), 'train loss': loss.detach(), 
+                       'test error': lploss(out.detach(), u)})
+        return loss
+
+    stats = {'steps': 0, 'evals': 0, 'iters to tol': None, 'time to tol': None}
+    if t_start is None:
+        t_start = default_timer()
+    prev_loss = None
+    for step in range(lbfgs_config['num_steps']):
+        loss = optimizer.step(closure).item()
+        stats['steps'] = step + 1
+        stats['evals'] = optimizer.state[params[0]]['func_evals']
+        log_dict = {key: value.item() for key, value in losses.items()}
+        if tolerance is not None and stats['time to tol'] is None and log_dict['PDE'] <= tolerance:
+            stats['time to tol'] = default_timer() - t_start
+            stats['iters to tol'] = start_iter + stats['evals']
+        print(f'L-BFGS step {step}: {dict2str(log_dict)}')
+        if wandb and log:
+            wandb.log(log_dict, step=start_iter + step)
+        if prev_loss is not None and abs(prev_loss - loss) <= tolerance_change:
+            break
+        prev_loss = loss
+    return stats
+
+
 def train_ns(model, 
              u_loader,        # training data
              optimizer, 
              scheduler,
-             device, config, args):
+             device, config, args, 
+             ckpt=None):            # checkpoint to resume from
 
     v = 1/ config['data']['Re']
     t_duration = config['data']['t_duration']
     save_step = config['train']['save_step']
+    log_step = config['train']['log_step'] if 'log_step' in config['train'] else 100
+    # stop once the PDE residual has flattened, set by the early_stop section of train
+    monitor = ConvergenceMonitor.from_config(config)
+    # report the first iteration with a PDE residual below tolerance
+    tolerance = config['train']['tolerance'] if 'tolerance' in config['train'] else None
+    # refine with L-BFGS once Adam has plateaued or used up num_iter
+    lbfgs_config = config['train']['lbfgs'] if 'lbfgs' in config['train'] and not args.adam_only else None
 
     ic_weight = config['train']['ic_loss']
     f_weight = config['train']['f_loss']
@@ -38,6 +114,8 @@ def train_ns(model,
     base_dir = os.path.join('exp', config['log']['logdir'])
     ckpt_dir = os.path.join(base_dir, 'ckpts')
     os.makedirs(ckpt_dir, exist_ok=True)
+    keep_ckpts = config['train']['keep_ckpts'] if 'keep_ckpts' in config['train'] else None
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_ckpts)
 
     # loss fn
     lploss = LpLoss(size_average=True)
@@ -51,16 +129,32 @@ def train_ns(model,
                          group=config['log']['group'], 
                          config=config, reinit=True, 
                          settings=wandb.Settings(start_method='fork'))
-    
-    pbar = range(config['train']['num_iter'])
+
+    u_loader = ResumableIterator(u_loader)
+    loaders = {'u_loader': u_loader}
+    if ckpt is not None:
+        start_iter = load_state(ckpt, optimizer, scheduler, loaders=loaders)
+    else:
+        start_iter = 0
+    # the checkpoint saved after L-BFGS holds only the weights, the optimization of the instance is done
+    finished = ckpt is not None and ckpt.get('optim') is None
+
+    num_iter = config['train']['num_iter']
+    if monitor is not None:
+        num_iter = monitor.num_iter(num_iter)
+    pbar = range(start_iter, num_iter) if not finished else range(0)
     if args.tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
 
-    u_loader = sample_data(u_loader)
+    meter = MetricAccumulator(device)
+    # kept on device, read at the log steps
+    first_hit = torch.full((), -1, dtype=torch.long, device=device)
+    time_to_tol = None
+    t_start = default_timer()
 
+    # last Adam iteration, also when resuming past num_iter
+    e = start_iter - 1
     for e in pbar:
-        log_dict = {}
-
         optimizer.zero_grad()
         # data loss
         u, a_in = next(u_loader)
@@ -71,30 +165,67 @@ def train_ns(model,
             
         u0  = a_in[:, :, :, 0, -1]
         loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
-        log_dict['IC'] = loss_ic.item()
-        log_dict['PDE'] = loss_f.item()
+        meter.update({'IC': loss_ic, 'PDE': loss_f})
+        if tolerance is not None:
+            hit = (first_hit < 0) & (loss_f.detach() <= tolerance)
+            first_hit = torch.where(hit, torch.full_like(first_hit, e), first_hit)
         loss = loss_f * f_weight + loss_ic * ic_weight
 
         loss.backward()
         optimizer.step()
         scheduler.step()
 
-        log_dict['train loss'] = loss.item()
-        log_dict['test error'] = data_loss.item()
-        
-        if args.tqdm:
-            logstr = dict2str(log_dict)
-            pbar.set_description(
-                (
-                    logstr
+        meter.update({'train loss': loss, 'test error': data_loss})
+        stop = False
+        if e % log_step == 0 or e == num_iter - 1:
+            log_dict = meter.compute()
+            meter.reset()
+            if tolerance is not None and time_to_tol is None and first_hit.item() >= 0:
+                time_to_tol = default_timer() - t_start
+                log_dict['time to tol'] = time_to_tol
+            if args.tqdm:
+                logstr = dict2str(log_dict)
+                pbar.set_description(
+                    (
+                        logstr
+                    )
                 )
-            )
-        if wandb and args.log:
-            wandb.log(log_dict)
-        if e % save_step == 0 and e > 0:
-            ckpt_path = os.path.join(ckpt_dir, f'model-{e}.pt')
-            save_ckpt(ckpt_path, model, optimizer)
+            if monitor is not None:
+                stop = monitor.step(e, log_dict)
+                if stop:
+                    log_dict['stop iter'] = e
+            if wandb and args.log:
+                wandb.log(log_dict, step=e)
+        if e % save_step == 0 and e > 0 or stop:
+            data_state = {key: loader.state_dict() for key, loader in loaders.items()}
+            writer.save(e, model, optimizer, scheduler, data_state=data_state)
+        if stop:
+            break
 
+    stats = {'stop iter': e}
+    if tolerance is not None:
+        first_hit = first_hit.item()
+        stats['iters to tol'] = first_hit if first_hit >= 0 else None
+    if lbfgs_config is not None and not finished:
+        u, a_in = next(u_loader)
+        lbfgs_stats = refine_lbfgs(model, a_in.to(device), u.to(device), forcing, 
+                                   lbfgs_config, config, 
+                                   tolerance=tolerance if time_to_tol is None else None, 
+                                   start_iter=e + 1, t_start=t_start, log=args.log)
+        if time_to_tol is None and lbfgs_stats['time to tol'] is not None:
+            time_to_tol = lbfgs_stats['time to tol']
+            stats['iters to tol'] = lbfgs_stats['iters to tol']
+        stats['lbfgs steps'] = lbfgs_stats['steps']
+        stats['lbfgs evals'] = lbfgs_stats['evals']
+        writer.save(stats['stop iter'] + lbfgs_stats['steps'], model)
+    writer.close()
+    stats['train time'] = default_timer() - t_start
+    if tolerance is not None:
+        stats['time to tol'] = time_to_tol
+        print(f'Iterations to PDE residual {tolerance}: {stats["iters to tol"]}; wall-clock: {time_to_tol}')
+    if wandb and args.log:
+        for key, value in stats.items():
+            run.summary[key] = value
     # clean up wandb
     if wandb and args.log:
         run.finish()
@@ -114,8 +245,9 @@ def train_ns(model,
         out = model(a_in)
         error = criterion(out, u)
         print(f'Test error: {error.item()}')
-        torch.save({'truth': u.cpu(), 'pred': out.cpu()}, result_path)
+        torch.save({'truth': u.cpu(), 'pred': out.cpu(), **stats}, result_path)
     print(f'Results saved to {result_path}')
+    return stats
 
 
 
@@ -163,17 +295,51 @@ def subprocess(args):
                         t_duration=config['data']['t_duration'])
     u_loader = DataLoader(dataset, batch_size=1)
 
+    # start from the solution of the nearest solved instance
+    store = WarmStartStore.from_config(config)
+    neighbor, dist = None, None
+    if store is not None:
+        base_state = {key: value.detach().clone() for key, value in model.state_dict().items()}
+        a_in = dataset[0][1][None]
+        if not args.cold and not args.resume:
+            neighbor, dist = store.nearest(a_in, exclude=args.idx)
+        if neighbor is not None:
+            model.load_state_dict(store.load(neighbor, base_state))
+            print(f'Warm start from instance {neighbor}, relative distance of the initial conditions: {dist:.3f}')
+        elif not args.resume:
+            print('Cold start from the pretrained weights')
+
+    # resume the optimization of this instance, --ckpt holds the pretrained weights
+    resume_ckpt = None
+    if args.resume:
+        resume_ckpt = torch.load(args.resume)
+        model.load_state_dict(resume_ckpt['model'])
+        print('Resuming from %s' % args.resume)
+
     optimizer = Adam(model.parameters(), lr=config['train']['base_lr'])
     scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, 
                                                      milestones=config['train']['milestones'], 
                                                      gamma=config['train']['scheduler_gamma'])
-    train_ns(model, 
-             u_loader, 
-             optimizer, 
-             scheduler, 
-             device, 
-             config, 
-             args)
+    stats = train_ns(model, 
+                     u_loader, 
+                     optimizer, 
+                     scheduler, 
+                     device, 
+                     config, 
+                     args, 
+                     ckpt=resume_ckpt)
+    if store is not None:
+        store.add(args.idx, a_in, model.state_dict(), base_state, meta=stats)
+    if 'tolerance' in config['train']:
+        # one row per run, to compare warm and cold starts, Adam alone and Adam + L-BFGS
+        report_path = os.path.join('exp', config['log']['logdir'], 'results', 'tto.csv')
+        new_file = not os.path.exists(report_path)
+        optim_name = 'adam+lbfgs' if 'lbfgs steps' in stats else 'adam'
+        with open(report_path, 'a') as f:
+            if new_file:
+                f.write('idx,start,neighbor,distance,optimizer,iters_to_tol,time_to_tol,stop_iter,train_time\n')
+            f.write(f'{args.idx},{"warm" if neighbor is not None else "cold"},{neighbor},{dist},{optim_name},'
+                    f'{stats["iters to tol"]},{stats["time to tol"]},{stats["stop iter"]},{stats["train time"]:.2f}\n')
     print('Done!')
         
         
@@ -187,7 +353,10 @@ if __name__ == '__main__':
     parser.add_argument('--log', action='store_true', help='Turn on the wandb')
     parser.add_argument('--seed', type=int, default=None)
     parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--resume', type=str, default=None, help='Checkpoint of this instance to resume from')
     parser.add_argument('--tqdm', action='store_true', help='Turn on the tqdm')
+    parser.add_argument('--cold', action='store_true', help='Start from the pretrained weights even with a warm-start store')
+    parser.add_argument('--adam_only', action='store_true', help='Skip the L-BFGS phase, e.g. to compare the time to tolerance')
     args = parser.parse_args()
     if args.seed is None:
         args.seed = random.randint(0, 100000)
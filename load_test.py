@@ -0,0 +1,98 @@
+'''
+Load generator for serve.py, e.g.
+python3 load_test.py --port 8000 --S 256 --concurrency 32 --num_requests 512
+
+Each of the `concurrency` clients keeps one connection open and sends its requests one after the other.
+The initial conditions are random fields, or the first frames of a raw data file given by --data.
+Reports the client-side latency and throughput, followed by the counters of the server.
+'''
+import io
+import json
+import asyncio
+from argparse import ArgumentParser
+from timeit import default_timer
+
+import numpy as np
+
+
+async def request(reader, writer, method, path, body=b''):
+    writer.write((f'{method} {path} HTTP/1.1\r\n'
+                  f'Host: localhost\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).decode().split(' ')[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode().split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, data
+
+
+def load_ics(args):
+    if args.data is None:
+        return np.random.randn(64, args.S, args.S).astype(np.float32)
+    raw_data = np.load(args.data, mmap_mode='r')     # N x T x S x S
+    sub = raw_data.shape[-1] // args.S
+    return np.array(raw_data[:64, 0, ::sub, ::sub], dtype=np.float32)
+
+
+async def client(args, ics, counter, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    path = '/predict' if args.T is None else f'/predict?T={args.T}'
+    while counter[0] < args.num_requests:
+        i = counter[0]
+        counter[0] += 1
+        idx = [(i * args.samples + j) % ics.shape[0] for j in range(args.samples)]
+        buffer = io.BytesIO()
+        np.save(buffer, ics[idx])
+        t0 = default_timer()
+        status, data = await request(reader, writer, 'POST', path, buffer.getvalue())
+        if status != 200:
+            errors.append(data.decode())
+            continue
+        latencies.append(default_timer() - t0)
+    writer.close()
+
+
+async def run(args):
+    ics = load_ics(args)
+    counter = [0]
+    latencies = []
+    errors = []
+    t0 = default_timer()
+    await asyncio.gather(*[client(args, ics, counter, latencies, errors) for _ in range(args.concurrency)])
+    duration = default_timer() - t0
+
+    latencies = np.array(latencies) * 1000
+    print(f'{len(latencies)} requests of {args.samples} samples in {duration:.2f}s, {len(errors)} errors')
+    if len(errors) > 0:
+        print(f'First error: {errors[0]}')
+    if len(latencies) > 0:
+        print(f'Throughput: {len(latencies) / duration:.1f} requests/s, '
+              f'{len(latencies) * args.samples / duration:.1f} samples/s')
+        print(f'Latency (ms): mean {latencies.mean():.1f}, p50 {np.percentile(latencies, 50):.1f}, '
+              f'p90 {np.percentile(latencies, 90):.1f}, p99 {np.percentile(latencies, 99):.1f}')
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, data = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+    print('Server stats:')
+    print(json.dumps(json.loads(data), indent=2))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--S', type=int, default=64, help='Spatial resolution of the initial conditions')
+    parser.add_argument('--T', type=int, default=None, help='Number of time steps, default of the server if not set')
+    parser.add_argument('--data', type=str, default=None, help='Raw data file to draw the initial conditions from')
+    parser.add_argument('--samples', type=int, default=1, help='Number of initial conditions per request')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--num_requests', type=int, default=256)
+    args = parser.parse_args()
+    asyncio.run(run(args))
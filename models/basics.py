@@ -2,6 +2,7 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 @torch.jit.script
@@ -23,6 +24,27 @@ def compl_mul3d(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
     res = torch.einsum("bixyz,ioxyz->boxyz", a, b)
     return res
 
+
+def _store_half(module, num_weights):
+    '''
+    Replace the complex parameters weights1, ..., weights{num_weights} of a spectral layer
+    by float16 buffers of their real and imaginary parts, e.g. to shrink an exported model
+    '''
+    for k in range(1, num_weights + 1):
+        w = getattr(module, f'weights{k}').detach()
+        delattr(module, f'weights{k}')
+        module.register_buffer(f'weights{k}_half', torch.view_as_real(w).half())
+    module.half_storage = True
+
+
+def _get_weight(module, k):
+    '''
+    Complex float32 weights{k} of a spectral layer, also if they are stored in float16
+    '''
+    if module.half_storage:
+        return torch.view_as_complex(getattr(module, f'weights{k}_half').float())
+    return getattr(module, f'weights{k}')
+
 ################################################################
 # 1d fourier layer
 ################################################################
@@ -77,21 +99,62 @@ class SpectralConv2d(nn.Module):
             self.scale * torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
         self.weights2 = nn.Parameter(
             self.scale * torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        self.active_modes = None
+        self.half_storage = False
+
+    def set_active_modes(self, modes1=None, modes2=None):
+        '''
+        Only use the lowest modes1 x modes2 of the allocated modes, None uses all of them.
+        The weights of the negative frequencies are the last entries of weights2.
+        '''
+        if modes1 is None:
+            self.active_modes = None
+        else:
+            self.active_modes = (min(modes1, self.modes1), min(modes2, self.modes2))
+
+    def active_weights(self):
+        '''
+        Weights of the two corners restricted to the active modes, and the active modes
+        '''
+        w1, w2 = _get_weight(self, 1), _get_weight(self, 2)
+        if self.active_modes is None:
+            return [w1, w2], (self.modes1, self.modes2)
+        m1, m2 = self.active_modes
+        return [w1[:, :, :m1, :m2], w2[:, :, -m1:, :m2]], (m1, m2)
+
+    def store_half(self):
+        '''
+        Store the weights in float16, the products are still computed in complex float32
+        '''
+        _store_half(self, 2)
+
+    @torch.no_grad()
+    def prune_to_active(self):
+        '''
+        Drop the weights of the inactive modes, so that the active modes become the allocated ones
+        '''
+        if self.active_modes is None:
+            return
+        weights, (self.modes1, self.modes2) = self.active_weights()
+        self.weights1 = nn.Parameter(weights[0].clone())
+        self.weights2 = nn.Parameter(weights[1].clone())
+        self.active_modes = None
 
     def forward(self, x):
         batchsize = x.shape[0]
         size1 = x.shape[-2]
         size2 = x.shape[-1]
+        (w1, w2), (m1, m2) = self.active_weights()
         # Compute Fourier coeffcients up to factor of e^(- something constant)
         x_ft = torch.fft.rfftn(x, dim=[2, 3])
 
         # Multiply relevant Fourier modes
         out_ft = torch.zeros(batchsize, self.out_channels, x.size(-2), x.size(-1) // 2 + 1, device=x.device,
                                 dtype=torch.cfloat)
-        out_ft[:, :, :self.modes1, :self.modes2] = \
-            compl_mul2d(x_ft[:, :, :self.modes1, :self.modes2], self.weights1)
-        out_ft[:, :, -self.modes1:, :self.modes2] = \
-            compl_mul2d(x_ft[:, :, -self.modes1:, :self.modes2], self.weights2)
+        out_ft[:, :, :m1, :m2] = \
+            compl_mul2d(x_ft[:, :, :m1, :m2], w1)
+        out_ft[:, :, -m1:, :m2] = \
+            compl_mul2d(x_ft[:, :, -m1:, :m2], w2)
 
         # Return to physical space
         x = torch.fft.irfftn(out_ft, s=(x.size(-2), x.size(-1)), dim=[2, 3])
@@ -112,39 +175,225 @@ class SpectralConv3d(nn.Module):
         self.weights2 = nn.Parameter(self.scale * torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.modes3, dtype=torch.cfloat))
         self.weights3 = nn.Parameter(self.scale * torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.modes3, dtype=torch.cfloat))
         self.weights4 = nn.Parameter(self.scale * torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.modes3, dtype=torch.cfloat))
+        self.active_modes = None
+        self.adapter_rank = None
+        self.half_storage = False
 
-    def forward(self, x):
+    def set_active_modes(self, modes1=None, modes2=None, modes3=None):
+        '''
+        Only use the lowest modes1 x modes2 x modes3 of the allocated modes, None uses all of them.
+        The weights of the negative frequencies are the last entries of weights2..4,
+        so the active block of each corner is sliced from its own end.
+        '''
+        if modes1 is None:
+            self.active_modes = None
+        else:
+            self.active_modes = (min(modes1, self.modes1), min(modes2, self.modes2), min(modes3, self.modes3))
+
+    def add_adapter(self, rank):
+        '''
+        Add a trainable low-rank delta to each block of weights: 
+        weights_k[:, :, x, y, z] + adapter_Ak[:, :, x, y, z] @ adapter_Bk[:, :, x, y, z], 
+        a product over the channels of rank `rank` for every mode. B starts at zero, so the output is unchanged.
+        '''
+        self.adapter_rank = rank
+        for k in range(1, 5):
+            A = self.scale * torch.rand(self.in_channels, rank, self.modes1, self.modes2, self.modes3, dtype=torch.cfloat)
+            B = torch.zeros(rank, self.out_channels, self.modes1, self.modes2, self.modes3, dtype=torch.cfloat)
+            device = self.weights1.device
+            self.register_parameter(f'adapter_A{k}', nn.Parameter(A.to(device)))
+            self.register_parameter(f'adapter_B{k}', nn.Parameter(B.to(device)))
+
+    def get_weights(self):
+        '''
+        Weights of the four corners, with the adapters
+        '''
+        weights = [_get_weight(self, k) for k in range(1, 5)]
+        if self.adapter_rank is None:
+            return weights
+        return [w + torch.einsum('irxyz,roxyz->ioxyz', getattr(self, f'adapter_A{k}'), getattr(self, f'adapter_B{k}'))
+                for k, w in enumerate(weights, start=1)]
+
+    def active_weights(self):
+        '''
+        Weights of the four corners, with the adapters, restricted to the active modes, and the active modes
+        '''
+        w1, w2, w3, w4 = self.get_weights()
+        if self.active_modes is None:
+            return [w1, w2, w3, w4], (self.modes1, self.modes2, self.modes3)
+        m1, m2, m3 = self.active_modes
+        weights = [w1[:, :, :m1, :m2, :m3], w2[:, :, -m1:, :m2, :m3],
+                   w3[:, :, :m1, -m2:, :m3], w4[:, :, -m1:, -m2:, :m3]]
+        return weights, (m1, m2, m3)
+
+    def store_half(self):
+        '''
+        Store the weights in float16, the products are still computed in complex float32.
+        The adapters, if any, are merged first.
+        '''
+        self.merge_adapter()
+        _store_half(self, 4)
+
+    @torch.no_grad()
+    def prune_to_active(self):
+        '''
+        Drop the weights of the inactive modes, so that the active modes become the allocated ones.
+        The adapters, if any, are merged first.
+        '''
+        if self.active_modes is None:
+            return
+        self.merge_adapter()
+        weights, (self.modes1, self.modes2, self.modes3) = self.active_weights()
+        for k, w in enumerate(weights, start=1):
+            setattr(self, f'weights{k}', nn.Parameter(w.clone()))
+        self.active_modes = None
+
+    @torch.no_grad()
+    def merge_adapter(self):
+        '''
+        Fold the adapters into the weights and remove them
+        '''
+        if self.adapter_rank is None:
+            return
+        weights = self.get_weights()
+        for k, w in enumerate(weights, start=1):
+            getattr(self, f'weights{k}').copy_(w)
+            delattr(self, f'adapter_A{k}')
+            delattr(self, f'adapter_B{k}')
+        self.adapter_rank = None
+
+    def forward(self, x, t_indices=None):
+        '''
+        Args:
+            x: (batchsize, in_channels, x_grid, y_grid, t_grid)
+            t_indices: list of time indices to synthesize, None returns all of them
+        Returns:
+            (batchsize, out_channels, x_grid, y_grid, t_grid), or (..., len(t_indices)) if t_indices is given
+        '''
         batchsize = x.shape[0]
+        (w1, w2, w3, w4), (m1, m2, m3) = self.active_weights()
         # Compute Fourier coeffcients up to factor of e^(- something constant)
         x_ft = torch.fft.rfftn(x, dim=[2,3,4])
         
-        z_dim = min(x_ft.shape[4], self.modes3)
-        
-        # Multiply relevant Fourier modes
-        out_ft = torch.zeros(batchsize, self.out_channels, x_ft.shape[2], x_ft.shape[3], self.modes3, device=x.device, dtype=torch.cfloat)
-        
-        # if x_ft.shape[4] > self.modes3, truncate; if x_ft.shape[4] < self.modes3, add zero padding 
-        coeff = torch.zeros(batchsize, self.in_channels, self.modes1, self.modes2, self.modes3, device=x.device, dtype=torch.cfloat)        
-        coeff[..., :z_dim] = x_ft[:, :, :self.modes1, :self.modes2, :z_dim]
-        out_ft[:, :, :self.modes1, :self.modes2, :] = compl_mul3d(coeff, self.weights1)
-        
-        coeff = torch.zeros(batchsize, self.in_channels, self.modes1, self.modes2, self.modes3, device=x.device, dtype=torch.cfloat)        
-        coeff[..., :z_dim] = x_ft[:, :, -self.modes1:, :self.modes2, :z_dim]
-        out_ft[:, :, -self.modes1:, :self.modes2, :] = compl_mul3d(coeff, self.weights2)
+        z_dim = min(x_ft.shape[4], m3)
+        size1, size2 = x_ft.shape[2], x_ft.shape[3]
         
-        coeff = torch.zeros(batchsize, self.in_channels, self.modes1, self.modes2, self.modes3, device=x.device, dtype=torch.cfloat)        
-        coeff[..., :z_dim] = x_ft[:, :, :self.modes1, -self.modes2:, :z_dim]
-        out_ft[:, :, :self.modes1, -self.modes2:, :] = compl_mul3d(coeff, self.weights3)
-        
-        coeff = torch.zeros(batchsize, self.in_channels, self.modes1, self.modes2, self.modes3, device=x.device, dtype=torch.cfloat)        
-        coeff[..., :z_dim] = x_ft[:, :, -self.modes1:, -self.modes2:, :z_dim]
-        out_ft[:, :, -self.modes1:, -self.modes2:, :] = compl_mul3d(coeff, self.weights4)
+        # Multiply relevant Fourier modes of the four corners
+        corners = [(slice(None, m1), slice(None, m2), w1), 
+                   (slice(-m1, None), slice(None, m2), w2), 
+                   (slice(None, m1), slice(-m2, None), w3), 
+                   (slice(-m1, None), slice(-m2, None), w4)]
+        outs = []
+        for s1, s2, w in corners:
+            # if x_ft.shape[4] > m3, truncate; if x_ft.shape[4] < m3, add zero padding 
+            coeff = F.pad(x_ft[:, :, s1, s2, :z_dim], (0, m3 - z_dim))
+            outs.append(compl_mul3d(coeff, w))
+
+        if 2 * m1 <= size1 and 2 * m2 <= size2:
+            # assemble the corners without in-place writes, which also works under torch.func.vmap
+            zeros2 = torch.zeros(batchsize, self.out_channels, m1, size2 - 2 * m2, m3, device=x.device, dtype=torch.cfloat)
+            zeros1 = torch.zeros(batchsize, self.out_channels, size1 - 2 * m1, size2, m3, device=x.device, dtype=torch.cfloat)
+            top = torch.cat([outs[0], zeros2, outs[2]], dim=3)
+            bottom = torch.cat([outs[1], zeros2, outs[3]], dim=3)
+            out_ft = torch.cat([top, zeros1, bottom], dim=2)
+        else:
+            # overlapping corners, the later ones overwrite the earlier ones
+            out_ft = torch.zeros(batchsize, self.out_channels, size1, size2, m3, device=x.device, dtype=torch.cfloat)
+            for (s1, s2, _), out in zip(corners, outs):
+                out_ft[:, :, s1, s2, :] = out
 
         #Return to physical space
+        if t_indices is not None:
+            return partial_irfft3d(out_ft, x.size(4), t_indices)
         x = torch.fft.irfftn(out_ft, s=(x.size(2), x.size(3), x.size(4)), dim=[2,3,4])
         return x
 
 
+def partial_irfft3d(x_ft, n, t_indices):
+    '''
+    irfftn over the last three dimensions, evaluated only at the time indices t_indices.
+    The first two dimensions are inverted by ifft2, the last one by a small inverse real DFT:
+    u[t] = (1/n) * sum_k c_k * Re(x_k * exp(2 pi i k t / n)), with c_k = 1 for the zero and the Nyquist frequency, 2 otherwise.
+    Args:
+        x_ft: (..., x_grid, y_grid, m) complex, the first m frequencies in time of the rfft layout, zero beyond
+        n: size of the time grid
+        t_indices: list of time indices in [0, n)
+    Returns:
+        (..., x_grid, y_grid, len(t_indices)) real
+    '''
+    x_ft = x_ft[..., :n // 2 + 1]
+    m = x_ft.shape[-1]
+    x_ft = torch.fft.ifft2(x_ft, dim=[-3, -2])
+
+    k = torch.arange(m, device=x_ft.device)
+    t = torch.as_tensor(t_indices, device=x_ft.device)
+    coeff = torch.full((m, ), 2.0, device=x_ft.device)
+    coeff[0] = 1.0
+    if n % 2 == 0 and m == n // 2 + 1:
+        coeff[-1] = 1.0
+    # reduce k * t modulo n in integers to keep the phase exact
+    phase = 2 * np.pi / n * ((k[:, None] * t[None, :]) % n).float()     # m x len(t_indices)
+    cos = coeff[:, None] * torch.cos(phase) / n
+    sin = coeff[:, None] * torch.sin(phase) / n
+    return torch.matmul(x_ft.real, cos) - torch.matmul(x_ft.imag, sin)
+
+
+def spectral_query(x, pos, modes=None, max_elements=2**24):
+    '''
+    Band-limited trigonometric interpolation of a real field at arbitrary points,
+    by a non-uniform inverse DFT of its lowest Fourier modes
+    Args:
+        x: (batchsize, channels, n_1, ..., n_d) real field on a grid, treated as periodic
+        pos: (batchsize, M, d) positions in grid index units, grid point i of dimension k is at pos[..., k] = i
+        modes: optional list of d ints, frequencies |k| < modes[j] are kept in each dimension.
+            Default all the n_j // 2 + 1 frequencies of the grid, which reproduces x exactly at the grid points.
+        max_elements: largest number of entries of the phase matrix of a chunk of points, bounds the memory
+    Returns:
+        (batchsize, M, channels)
+    '''
+    d = pos.shape[-1]
+    sizes = x.shape[2:]
+    if modes is None:
+        modes = [n // 2 + 1 for n in sizes]
+    x_ft = torch.fft.rfftn(x, dim=list(range(2, 2 + d)))
+
+    # frequencies 0, ..., m - 1, -(m - 1), ..., -1 in all dimensions but the last one, 0, ..., m - 1 in the last one;
+    # with the full band of an even n, the Nyquist frequency n / 2 is kept once, the real part below symmetrizes it
+    freqs = []
+    for j, (n, m) in enumerate(zip(sizes, modes)):
+        if j < d - 1:
+            m = min(m, n // 2 + 1)
+            num_neg = min(m - 1, n - m)
+            x_ft = torch.cat([x_ft.narrow(2 + j, 0, m), x_ft.narrow(2 + j, n - num_neg, num_neg)], dim=2 + j)
+            freqs.append(torch.cat([torch.arange(m), torch.arange(-num_neg, 0)]))
+        else:
+            m = min(m, n // 2 + 1)
+            x_ft = x_ft.narrow(2 + j, 0, m)
+            freqs.append(torch.arange(m))
+    # the negative frequencies of the last dimension are the conjugates of the positive ones
+    coeff = torch.full((freqs[-1].shape[0], ), 2.0)
+    coeff[0] = 1.0
+    if sizes[-1] % 2 == 0 and freqs[-1].shape[0] == sizes[-1] // 2 + 1:
+        coeff[-1] = 1.0
+    x_ft = x_ft * coeff.to(x.device) / np.prod(sizes)
+    batchsize, channels = x.shape[0], x.shape[1]
+    x_ft = x_ft.reshape(batchsize, channels, -1).transpose(1, 2)     # batchsize, K, channels
+    num_freqs = x_ft.shape[1]
+
+    chunk = max(1, max_elements // num_freqs)
+    out = []
+    for start in range(0, pos.shape[1], chunk):
+        p = pos[:, start: start + chunk]
+        phase = None
+        for j in range(d):
+            k = freqs[j].to(x.device, torch.float32)
+            phase_j = 2 * np.pi * p[..., j, None] / sizes[j] * k     # batchsize, chunk, K_j
+            phase = phase_j if phase is None else (phase[..., :, None] + phase_j[..., None, :]).flatten(-2)
+        basis = torch.polar(torch.ones_like(phase), phase)
+        out.append(torch.matmul(basis, x_ft).real)
+    return torch.cat(out, dim=1)
+
+
 class FourierBlock(nn.Module):
     def __init__(self, in_channels, out_channels, modes1, modes2, modes3, act='tanh'):
         super(FourierBlock, self).__init__()
@@ -1,5 +1,6 @@
+import torch
 import torch.nn as nn
-from .basics import SpectralConv2d
+from .basics import SpectralConv2d, spectral_query
 from .utils import _get_act, add_padding2, remove_padding2
 
 
@@ -30,7 +31,7 @@ class FNO2d(nn.Module):
         self.modes2 = modes2
     
         self.pad_ratio = pad_ratio
-        # input channel is 3: (a(x, y), x, y)
+        # input channel is in_dim, 3 by default: (a(x, y), x, y)
         if layers is None:
             self.layers = [width] * (len(modes1) + 1)
         else:
@@ -50,12 +51,11 @@ class FNO2d(nn.Module):
         self.fc3 = nn.Linear(layers[-1], out_dim)
         self.act = _get_act(act)
 
-    def forward(self, x):
+    def _hidden(self, x):
         '''
-        Args:
-            - x : (batch size, x_grid, y_grid, 2)
+        Lift the input and run all the Fourier layers on the padded domain
         Returns:
-            - x: (batch size, x_grid, y_grid, 1)
+            hidden field (batch size, channels, padded x_grid, padded y_grid) and the paddings
         '''
         size_1, size_2 = x.shape[1], x.shape[2]
         if max(self.pad_ratio) > 0:
@@ -77,11 +77,49 @@ class FNO2d(nn.Module):
             x = x1 + x2
             if i != length - 1:
                 x = self.act(x)
-        x = remove_padding2(x, num_pad1, num_pad2)
-        x = x.permute(0, 2, 3, 1)
+        return x, num_pad1, num_pad2
+
+    def _project(self, x):
         x = self.fc1(x)
         x = self.act(x)
         x = self.fc2(x)
         x = self.act(x)
         x = self.fc3(x)
         return x
+
+    def query(self, x, points, modes=None, max_elements=2**24):
+        '''
+        Evaluate the output at arbitrary points, by band-limited spectral interpolation of the hidden field
+        after the last Fourier layer, followed by the pointwise projection
+        Args:
+            - x: (batch size, x_grid, y_grid, in_dim), input on the grid
+            - points: (batch size, M, 2) points (x, y) in [0, 1]^2, grid point i at i / (x_grid - 1) as in torch2dgrid
+            - modes: number of modes kept in each direction, default all the modes of the grid,
+            which reproduces the output exactly at the grid points. 'layer' keeps the (active) modes of
+            the last Fourier layer: the DFT is cheaper, but the high frequencies added by the pointwise
+            skip connection are smoothed out, so the grid values are no longer reproduced.
+            - max_elements: bounds the memory of the non-uniform DFT, see spectral_query
+        Returns:
+            - u: (batch size, M, 1)
+        '''
+        size_1, size_2 = x.shape[1], x.shape[2]
+        h, num_pad1, num_pad2 = self._hidden(x)
+        if modes == 'layer':
+            speconv = self.sp_convs[-1]
+            modes = speconv.active_modes if speconv.active_modes is not None else (speconv.modes1, speconv.modes2)
+        pos = torch.stack([num_pad1[0] + points[..., 0] * (size_1 - 1),
+                           num_pad2[0] + points[..., 1] * (size_2 - 1)], dim=-1)
+        out = spectral_query(h, pos, modes, max_elements=max_elements)
+        return self._project(out)
+
+    def forward(self, x):
+        '''
+        Args:
+            - x : (batch size, x_grid, y_grid, in_dim)
+        Returns:
+            - x: (batch size, x_grid, y_grid, 1)
+        '''
+        x, num_pad1, num_pad2 = self._hidden(x)
+        x = remove_padding2(x, num_pad1, num_pad2)
+        x = x.permute(0, 2, 3, 1)
+        return self._project(x)
@@ -1,5 +1,6 @@
+import torch
 import torch.nn as nn
-from .basics import SpectralConv3d
+from .basics import SpectralConv3d, spectral_query
 from .utils import add_padding, remove_padding, _get_act
 
 
@@ -55,37 +56,192 @@ class FNO3d(nn.Module):
         self.fc2 = nn.Linear(fc_dim, out_dim)
         self.act = _get_act(act)
 
-    def forward(self, x):
+    def set_active_modes(self, ratio=None):
         '''
+        Only use the lowest Fourier modes of each layer, e.g. while training on coarse grids
         Args:
-            x: (batchsize, x_grid, y_grid, t_grid, 3)
+            ratio: fraction of the modes of each layer to use, None uses all of them
+        '''
+        for speconv in self.sp_convs:
+            if ratio is None:
+                speconv.set_active_modes(None)
+            else:
+                speconv.set_active_modes(max(1, round(speconv.modes1 * ratio)),
+                                         max(1, round(speconv.modes2 * ratio)),
+                                         max(1, round(speconv.modes3 * ratio)))
+
+    def add_adapters(self, rank):
+        '''
+        Low-rank adapter finetuning: add a rank `rank` delta to the spectral weights of every Fourier layer
+        and freeze all the other parameters, so that only the adapters are trained
+        '''
+        for param in self.parameters():
+            param.requires_grad = False
+        for speconv in self.sp_convs:
+            speconv.add_adapter(rank)
+
+    def adapter_state_dict(self):
+        '''
+        Weights of the adapters only, None if the model has no adapter
+        '''
+        if self.sp_convs[0].adapter_rank is None:
+            return None
+        return {key: value for key, value in self.state_dict().items() if '.adapter_' in key}
 
+    def load_adapters(self, state_dict):
+        '''
+        Add the adapters of a checkpoint saved with adapter_state_dict, on top of the loaded base weights
+        '''
+        rank = state_dict['sp_convs.0.adapter_A1'].shape[1]
+        if self.sp_convs[0].adapter_rank is None:
+            self.add_adapters(rank)
+        self.load_state_dict(state_dict, strict=False)
+
+    def merge_adapters(self):
+        for speconv in self.sp_convs:
+            speconv.merge_adapter()
+
+    def num_frozen_layers(self):
+        '''
+        Length of the frozen prefix of the network, i.e. the number of leading Fourier layers
+        which, together with fc0, do not require gradients.
         Returns:
-            u: (batchsize, x_grid, y_grid, t_grid, 1)
+            number of frozen Fourier layers, None if fc0 or the first Fourier layer is trainable
+        '''
+        if any(p.requires_grad for p in self.fc0.parameters()):
+            return None
+        num_layers = 0
+        for speconv, w in zip(self.sp_convs, self.ws):
+            if any(p.requires_grad for p in list(speconv.parameters()) + list(w.parameters())):
+                break
+            num_layers += 1
+        # fc0 alone is cheaper to recompute than to cache
+        if num_layers == 0:
+            return None
+        return num_layers
+
+    def forward_prefix(self, x, num_layers):
+        '''
+        Lift the input and run the first num_layers Fourier layers
+        Args:
+            x: (batchsize, x_grid, y_grid, t_grid, 3)
+            num_layers: number of Fourier layers to run
 
+        Returns:
+            hidden field (batchsize, channels, x_grid, y_grid, padded t_grid) and the padding in time
         '''
         size_z = x.shape[-2]
         if max(self.pad_ratio) > 0:
             num_pad = [round(size_z * i) for i in self.pad_ratio]
         else:
             num_pad = [0., 0.]
-        length = len(self.ws)
-        batchsize = x.shape[0]
-        
+
         x = self.fc0(x)
         x = x.permute(0, 4, 1, 2, 3)
         x = add_padding(x, num_pad=num_pad)
+        x = self._fourier_layers(x, 0, num_layers)
+        return x, num_pad
+
+    def forward_suffix(self, x, num_pad, start, t_indices=None):
+        '''
+        Run the Fourier layers from start on and the projection, the counterpart of forward_prefix
+        Args:
+            x: hidden field returned by forward_prefix(input, start)
+            num_pad: padding returned by forward_prefix
+            start: index of the first Fourier layer to run
+            t_indices: see forward
+
+        Returns:
+            u: (batchsize, x_grid, y_grid, t_grid, 1), or (..., len(t_indices), 1) if t_indices is given
+        '''
+        if t_indices is None:
+            x = self._fourier_layers(x, start, len(self.ws))
+            x = remove_padding(x, num_pad=num_pad)
+        else:
+            # indices in the padded time domain
+            size_z = x.shape[-1] - int(num_pad[0]) - int(num_pad[1])
+            t_indices = [int(num_pad[0]) + t % size_z for t in t_indices]
+            x = self._fourier_layers(x, start, len(self.ws) - 1)
+            if start < len(self.ws):
+                x = self._last_layer(x, t_indices)
+            else:
+                x = x[..., t_indices]
+        x = x.permute(0, 2, 3, 4, 1)
+        x = self.fc1(x)
+        x = self.act(x)
+        x = self.fc2(x)
+        return x
+
+    def _fourier_layers(self, x, start, stop):
+        length = len(self.ws)
+        batchsize = x.shape[0]
         size_x, size_y, size_z = x.shape[-3], x.shape[-2], x.shape[-1]
 
-        for i, (speconv, w) in enumerate(zip(self.sp_convs, self.ws)):
+        for i in range(start, stop):
+            speconv, w = self.sp_convs[i], self.ws[i]
             x1 = speconv(x)
             x2 = w(x.view(batchsize, self.layers[i], -1)).view(batchsize, self.layers[i+1], size_x, size_y, size_z)
             x = x1 + x2
             if i != length - 1:
                 x = self.act(x)
-        x = remove_padding(x, num_pad=num_pad)
-        x = x.permute(0, 2, 3, 4, 1)
-        x = self.fc1(x)
-        x = self.act(x)
-        x = self.fc2(x)
-        return x
\ No newline at end of file
+        return x
+
+    def _last_layer(self, x, t_indices):
+        '''
+        Last Fourier layer evaluated only at the time indices t_indices of the padded domain:
+        the inverse transform of the spectral convolution is a small inverse DFT in time,
+        and the pointwise skip connection runs only on those slices
+        '''
+        i = len(self.ws) - 1
+        batchsize = x.shape[0]
+        size_x, size_y = x.shape[-3], x.shape[-2]
+        x1 = self.sp_convs[i](x, t_indices=t_indices)
+        x_t = x[..., t_indices]
+        x2 = self.ws[i](x_t.reshape(batchsize, self.layers[i], -1)).view(batchsize, self.layers[i+1], size_x, size_y, len(t_indices))
+        return x1 + x2
+
+    def query(self, x, points, modes=None, max_elements=2**24):
+        '''
+        Evaluate the output at arbitrary points, by band-limited spectral interpolation of the hidden field
+        after the last Fourier layer, followed by the pointwise projection
+        Args:
+            x: (batchsize, x_grid, y_grid, t_grid, 3), input on the grid
+            points: (batchsize, M, 3) points (x, y, t) in the coordinates of get_grid3d:
+                x, y in [0, 1) periodic with grid point i at i / x_grid, t in [0, 1] with time step j at j / (t_grid - 1)
+            modes: number of modes kept in each direction, default all the modes of the grid,
+                which reproduces the output exactly at the grid points. 'layer' keeps the (active) modes of
+                the last Fourier layer: the DFT is cheaper, but the high frequencies added by the pointwise
+                skip connection and the padding are smoothed out, so the grid values are no longer reproduced.
+            max_elements: bounds the memory of the non-uniform DFT, see spectral_query
+
+        Returns:
+            u: (batchsize, M, 1)
+        '''
+        size_z = x.shape[-2]
+        h, num_pad = self.forward_prefix(x, len(self.ws))
+        if modes == 'layer':
+            speconv = self.sp_convs[-1]
+            modes = speconv.active_modes if speconv.active_modes is not None else (speconv.modes1, speconv.modes2, speconv.modes3)
+        size_x, size_y = h.shape[2], h.shape[3]
+        pos = torch.stack([points[..., 0] * size_x,
+                           points[..., 1] * size_y,
+                           num_pad[0] + points[..., 2] * (size_z - 1)], dim=-1)
+        out = spectral_query(h, pos, modes, max_elements=max_elements)
+        out = self.fc1(out)
+        out = self.act(out)
+        out = self.fc2(out)
+        return out
+
+    def forward(self, x, t_indices=None):
+        '''
+        Args:
+            x: (batchsize, x_grid, y_grid, t_grid, 3)
+            t_indices: optional list of time indices of the output, e.g. [-1] for the final time only.
+                The last Fourier layer and the projection then run only on these slices.
+
+        Returns:
+            u: (batchsize, x_grid, y_grid, t_grid, 1), or (batchsize, x_grid, y_grid, len(t_indices), 1)
+
+        '''
+        x, num_pad = self.forward_prefix(x, 0)
+        return self.forward_suffix(x, num_pad, 0, t_indices=t_indices)
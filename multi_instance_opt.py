@@ -0,0 +1,238 @@
+'''
+Test-time optimization of many instances at once.
+K copies of the pretrained model are optimized together with one vmapped forward and PDE loss,
+each on its own instance with its own Adam state and learning rate schedule.
+A copy whose instance has converged (early_stop in train) or used up num_iter is restarted on the next instance.
+'''
+import os
+import yaml
+import random
+from argparse import ArgumentParser
+from collections import deque
+from timeit import default_timer
+from tqdm import tqdm
+
+import torch
+
+from models import FNO3d
+
+from train_utils.losses import LpLoss, PINO_loss3d, get_forcing
+from train_utils.datasets import KFDataset
+from train_utils.utils import count_params
+from train_utils.metrics import ConvergenceMonitor
+from train_utils.multi_instance import StackedModels, StackedAdam
+
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
+
+METRICS = ['train loss', 'IC', 'PDE', 'test error']
+
+
+def train_instances(model, dataset, device, config, args):
+    v = 1 / config['data']['Re']
+    t_duration = config['data']['t_duration']
+    num_iter = config['train']['num_iter']
+    log_step = config['train']['log_step'] if 'log_step' in config['train'] else 100
+
+    ic_weight = config['train']['ic_loss']
+    f_weight = config['train']['f_loss']
+    # set up directory
+    base_dir = os.path.join('exp', config['log']['logdir'])
+    save_dir = os.path.join(base_dir, 'results')
+    os.makedirs(save_dir, exist_ok=True)
+
+    lploss = LpLoss(size_average=True)
+    S = config['data']['pde_res'][0]
+    forcing = get_forcing(S).to(device)
+
+    def instance_loss(net, a_in, u):
+        out = net(a_in)
+        u0 = a_in[:, :, :, 0, -1]
+        loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
+        loss = loss_f * f_weight + loss_ic * ic_weight
+        data_loss = lploss(out, u)
+        return torch.stack([loss, loss_ic, loss_f, data_loss])
+
+    if wandb and args.log:
+        run = wandb.init(project=config['log']['project'],
+                         entity=config['log']['entity'],
+                         group=config['log']['group'],
+                         config=config, reinit=True,
+                         settings=wandb.Settings(start_method='fork'))
+
+    pending = deque(range(len(dataset)))
+    num_slots = min(args.num_models, len(dataset))
+    models = StackedModels(model, num_slots)
+    optimizer = StackedAdam(models.params, lr=config['train']['base_lr'],
+                            milestones=config['train']['milestones'],
+                            gamma=config['train']['scheduler_gamma'])
+    u, a_in = dataset[0]
+    u_batch = torch.zeros((num_slots, 1) + tuple(u.shape), device=device)
+    a_batch = torch.zeros((num_slots, 1) + tuple(a_in.shape), device=device)
+
+    # state of each slot
+    instances = [None] * num_slots
+    iters = [0] * num_slots
+    budgets = [num_iter] * num_slots
+    monitors = [None] * num_slots
+    sums = torch.zeros(len(METRICS), num_slots, device=device)
+    counts = [0] * num_slots
+    t_starts = [0.0] * num_slots
+
+    def start(k):
+        idx = pending.popleft()
+        u, a_in = dataset[idx]
+        u_batch[k, 0] = torch.as_tensor(u).to(device)
+        a_batch[k, 0] = a_in.to(device)
+        models.reset(k)
+        optimizer.reset(k)
+        instances[k] = idx
+        iters[k] = 0
+        monitors[k] = ConvergenceMonitor.from_config(config)
+        budgets[k] = monitors[k].num_iter(num_iter) if monitors[k] is not None else num_iter
+        sums[:, k] = 0.0
+        counts[k] = 0
+        t_starts[k] = default_timer()
+
+    for k in range(num_slots):
+        start(k)
+
+    pbar = tqdm(total=len(dataset), dynamic_ncols=True) if args.tqdm else None
+    results = []
+    step = 0
+    while len(instances) > 0:
+        models.zero_grad()
+        losses = models.map(instance_loss, a_batch, u_batch)     # num_slots x 4
+        losses[:, 0].sum().backward()
+        optimizer.step(models.params)
+
+        sums += losses.detach().t()
+        step += 1
+        iters = [it + 1 for it in iters]
+        counts = [c + 1 for c in counts]
+        if step % log_step != 0 and all(it < budget for it, budget in zip(iters, budgets)):
+            continue
+
+        # one transfer of the averaged metrics of all slots
+        avgs = (sums / torch.tensor(counts, device=device)).t().tolist()
+        sums.zero_()
+        counts = [0] * len(counts)
+        finished = []
+        for k in range(len(instances)):
+            log_dict = dict(zip(METRICS, avgs[k]))
+            stop = monitors[k] is not None and monitors[k].step(iters[k], log_dict)
+            if stop or iters[k] >= budgets[k]:
+                finished.append(k)
+                with torch.no_grad():
+                    pred = models.call(k, a_batch[k])
+                idx = args.start + instances[k]
+                result_path = os.path.join(save_dir, f'results-{idx}.pt')
+                torch.save({'truth': u_batch[k].cpu(), 'pred': pred.cpu()}, result_path)
+                row = {'idx': idx, 'stop iter': iters[k],
+                       'time': default_timer() - t_starts[k], **log_dict}
+                results.append(row)
+                print(f'Instance {idx}: stopped at iteration {iters[k]}, '
+                      f'PDE loss {log_dict["PDE"]:.3e}, test error {log_dict["test error"]:.5f}')
+                if wandb and args.log:
+                    wandb.log({f'instance/{key}': value for key, value in row.items()})
+                if pbar is not None:
+                    pbar.update(1)
+
+        idle = []
+        for k in finished:
+            if len(pending) > 0:
+                start(k)
+            else:
+                idle.append(k)
+        if len(idle) > 0:
+            # no instance left to swap in, drop the idle slots
+            keep = [k for k in range(len(instances)) if k not in idle]
+            models.select(keep)
+            optimizer.select(keep)
+            u_batch, a_batch = u_batch[keep], a_batch[keep]
+            sums = sums[:, keep]
+            instances = [instances[k] for k in keep]
+            iters = [iters[k] for k in keep]
+            budgets = [budgets[k] for k in keep]
+            monitors = [monitors[k] for k in keep]
+            counts = [counts[k] for k in keep]
+            t_starts = [t_starts[k] for k in keep]
+
+    if pbar is not None:
+        pbar.close()
+    results.sort(key=lambda row: row['idx'])
+    torch.save(results, os.path.join(save_dir, f'summary-{args.start}-{args.stop}.pt'))
+    avg_err = sum(row['test error'] for row in results) / len(results)
+    avg_iter = sum(row['stop iter'] for row in results) / len(results)
+    print(f'Averaged test error over {len(results)} instances: {avg_err:.5f}; averaged iterations: {avg_iter:.1f}')
+    if wandb and args.log:
+        run.summary['test error'] = avg_err
+        run.summary['stop iter'] = avg_iter
+        run.finish()
+    return results
+
+
+def subprocess(args):
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, yaml.FullLoader)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    # set random seed
+    config['seed'] = args.seed
+    seed = args.seed
+    torch.manual_seed(seed)
+    random.seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+    # create model
+    model = FNO3d(modes1=config['model']['modes1'],
+                  modes2=config['model']['modes2'],
+                  modes3=config['model']['modes3'],
+                  fc_dim=config['model']['fc_dim'],
+                  layers=config['model']['layers'],
+                  act=config['model']['act'],
+                  pad_ratio=config['model']['pad_ratio']).to(device)
+    num_params = count_params(model)
+    config['num_params'] = num_params
+    print(f'Number of parameters: {num_params}')
+    # Load from checkpoint
+    if args.ckpt:
+        ckpt_path = args.ckpt
+        ckpt = torch.load(ckpt_path)
+        model.load_state_dict(ckpt['model'])
+        print('Weights loaded from %s' % ckpt_path)
+
+    # test instances start, ..., stop - 1
+    dataset = KFDataset(paths=config['data']['paths'],
+                        raw_res=config['data']['raw_res'],
+                        data_res=config['data']['data_res'],
+                        pde_res=config['data']['data_res'],
+                        n_samples=config['data']['n_test_samples'],
+                        total_samples=args.stop - args.start,
+                        idx=args.start,
+                        offset=config['data']['testoffset'],
+                        t_duration=config['data']['t_duration'])
+    train_instances(model, dataset, device, config, args)
+    print('Done!')
+
+
+if __name__ == '__main__':
+    torch.backends.cudnn.benchmark = True
+    # parse options
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--config', type=str, help='Path to the configuration file')
+    parser.add_argument('--start', type=int, default=0, help='Index of the first instance')
+    parser.add_argument('--stop', type=int, default=1, help='Index after the last instance')
+    parser.add_argument('--num_models', type=int, default=4, help='Number of instances optimized at once')
+    parser.add_argument('--log', action='store_true', help='Turn on the wandb')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--tqdm', action='store_true', help='Turn on the tqdm')
+    args = parser.parse_args()
+    if args.seed is None:
+        args.seed = random.randint(0, 100000)
+    subprocess(args)
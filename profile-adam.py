@@ -0,0 +1,71 @@
+'''
+Compare the per-tensor loop and the multi-tensor (foreach) implementation of train_utils.Adam
+on the parameters of FNO3d.
+'''
+from argparse import ArgumentParser
+from timeit import default_timer
+
+import torch
+
+from models import FNO3d
+from train_utils.adam import Adam
+
+
+def bench(model, foreach, num_steps, device):
+    optimizer = Adam(model.parameters(), lr=1e-3, foreach=foreach)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+    # warm up and lazy state initialization
+    for _ in range(5):
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = default_timer()
+    for _ in range(num_steps):
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t1 = default_timer()
+    return (t1 - t0) / num_steps
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--modes', type=int, default=12)
+    parser.add_argument('--width', type=int, default=64)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--num_steps', type=int, default=100)
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    width = args.width
+    torch.manual_seed(0)
+    model = FNO3d(modes1=[args.modes] * args.layers,
+                  modes2=[args.modes] * args.layers,
+                  modes3=[args.modes] * args.layers,
+                  layers=[width] * (args.layers + 1)).to(device)
+    num_tensors = len(list(model.parameters()))
+    num_complex = sum(p.is_complex() for p in model.parameters())
+    print(f'{num_tensors} parameter tensors, {num_complex} complex, on {device}')
+
+    # check both implementations give the same update
+    ref = FNO3d(modes1=[args.modes] * args.layers,
+                modes2=[args.modes] * args.layers,
+                modes3=[args.modes] * args.layers,
+                layers=[width] * (args.layers + 1)).to(device)
+    ref.load_state_dict(model.state_dict())
+    for m, foreach in [(model, True), (ref, False)]:
+        torch.manual_seed(1)
+        optimizer = Adam(m.parameters(), lr=1e-3, foreach=foreach)
+        for _ in range(3):
+            for p in m.parameters():
+                p.grad = torch.randn_like(p)
+            optimizer.step()
+    max_diff = max((p - q).abs().max().item() for p, q in zip(model.parameters(), ref.parameters()))
+    print(f'Max difference between the updates: {max_diff}')
+
+    t_loop = bench(model, False, args.num_steps, device)
+    t_foreach = bench(model, True, args.num_steps, device)
+    print(f'Per-tensor loop: {t_loop * 1e3:.3f} ms/step')
+    print(f'Multi-tensor:    {t_foreach * 1e3:.3f} ms/step')
+    print(f'Speedup: {t_loop / t_foreach:.2f}x')
@@ -0,0 +1,239 @@
+'''
+Post-training pruning of the Fourier modes of a trained FNO2d / FNO3d, e.g.
+python3 prune_modes.py --config_path configs/test/Re500-05s.yaml --budget 0.02 --out checkpoints/Re500-FDM/pruned.pt
+
+The candidates are the outermost shells of modes of every Fourier layer, one direction at a time.
+The candidates holding the least weight energy are tried on the validation set, and the one that increases
+the relative L2 error the least is removed. Pruning stops once every remaining candidate would push the error
+above (1 + budget) times the error of the unpruned model.
+The weights are then sliced to the kept modes, which gives a smaller model and checkpoint; the new modes are
+written to a config next to the checkpoint, and the inference time of both models is reported.
+'''
+import os
+import copy
+import yaml
+from argparse import ArgumentParser
+from timeit import default_timer
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from models import FNO3d, FNO2d
+from train_utils import NSLoader, DarcyFlow
+from train_utils.losses import LpLoss
+from train_utils.utils import count_params
+
+
+def build(config, device):
+    '''
+    Model and validation batches of a test config, as in eval_operator.py
+    '''
+    data_config = config['data']
+    if 'name' in data_config and data_config['name'] == 'Darcy':
+        dataset = DarcyFlow(data_config['datapath'],
+                            nx=data_config['nx'], sub=data_config['sub'],
+                            offset=data_config['offset'], num=data_config['n_sample'])
+        dataloader = DataLoader(dataset, batch_size=config['test']['batchsize'], shuffle=False)
+        model = FNO2d(modes1=config['model']['modes1'],
+                      modes2=config['model']['modes2'],
+                      fc_dim=config['model']['fc_dim'],
+                      layers=config['model']['layers'],
+                      act=config['model']['act']).to(device)
+        mesh = dataset.mesh
+        mollifier = (torch.sin(np.pi * mesh[..., 0]) * torch.sin(np.pi * mesh[..., 1]) * 0.001).to(device)
+
+        def predict(model, x, y):
+            return model(x).reshape(y.shape) * mollifier
+    else:
+        loader = NSLoader(datapath1=data_config['datapath'],
+                          nx=data_config['nx'], nt=data_config['nt'],
+                          sub=data_config['sub'], sub_t=data_config['sub_t'],
+                          N=data_config['total_num'],
+                          t_interval=data_config['time_interval'])
+        dataloader = loader.make_loader(n_sample=data_config['n_sample'],
+                                        batch_size=config['test']['batchsize'],
+                                        start=data_config['offset'],
+                                        train=data_config['shuffle'])
+        model = FNO3d(modes1=config['model']['modes1'],
+                      modes2=config['model']['modes2'],
+                      modes3=config['model']['modes3'],
+                      fc_dim=config['model']['fc_dim'],
+                      layers=config['model']['layers']).to(device)
+
+        def predict(model, x, y):
+            x_in = F.pad(x, (0, 0, 0, 5), 'constant', 0)
+            out = model(x_in)[..., :-5, :]
+            return out.reshape(y.shape)
+
+    if 'ckpt' in config['test']:
+        ckpt = torch.load(config['test']['ckpt'], map_location=device)
+        model.load_state_dict(ckpt['model'])
+        print('Weights loaded from %s' % config['test']['ckpt'])
+    return model, dataloader, predict
+
+
+@torch.no_grad()
+def val_error(model, batches, predict):
+    lploss = LpLoss(size_average=True)
+    errors = [lploss(predict(model, x, y), y).item() for x, y in batches]
+    return float(np.mean(errors))
+
+
+def get_modes(speconv):
+    _, modes = speconv.active_weights()
+    return list(modes)
+
+
+def set_modes(speconv, modes):
+    speconv.set_active_modes(*modes)
+
+
+@torch.no_grad()
+def energy(speconv, modes):
+    '''
+    Energy of the weights of the lowest `modes`, summed over the corners
+    '''
+    old = speconv.active_modes
+    set_modes(speconv, modes)
+    weights, _ = speconv.active_weights()
+    value = sum(torch.sum(torch.abs(w) ** 2).item() for w in weights)
+    speconv.active_modes = old
+    return value
+
+
+def candidates(model, step):
+    '''
+    Yield (layer, direction, new modes) for every shell of modes that can be removed
+    '''
+    for i, speconv in enumerate(model.sp_convs):
+        modes = get_modes(speconv)
+        for d in range(len(modes)):
+            if modes[d] > 1:
+                new_modes = list(modes)
+                new_modes[d] = max(1, modes[d] - step)
+                yield i, d, new_modes
+
+
+def prune(model, batches, predict, budget, step=1, num_trials=4):
+    '''
+    Greedy pruning of the modes within the error budget
+    Args:
+        budget: largest relative increase of the validation error
+        step: number of modes removed from one direction at a time
+        num_trials: number of candidates with the least energy evaluated on the validation set in every round
+    Returns:
+        validation error of the unpruned and of the pruned model
+    '''
+    base_err = val_error(model, batches, predict)
+    max_err = base_err * (1 + budget)
+    print(f'Validation error before pruning: {base_err:.5f}, budget: {max_err:.5f}')
+    total_energy = [energy(speconv, get_modes(speconv)) for speconv in model.sp_convs]
+    rejected = set()
+    err = base_err
+    while True:
+        # rank the shells by the fraction of the energy of their layer they hold
+        ranked = []
+        for i, d, new_modes in candidates(model, step):
+            if (i, d, tuple(new_modes)) in rejected:
+                continue
+            speconv = model.sp_convs[i]
+            removed = energy(speconv, get_modes(speconv)) - energy(speconv, new_modes)
+            ranked.append((removed / total_energy[i], i, d, new_modes))
+        if len(ranked) == 0:
+            break
+        ranked.sort(key=lambda c: c[0])
+
+        # output sensitivity of the shells with the least energy
+        best = None
+        for frac, i, d, new_modes in ranked[:num_trials]:
+            speconv = model.sp_convs[i]
+            modes = get_modes(speconv)
+            set_modes(speconv, new_modes)
+            trial_err = val_error(model, batches, predict)
+            set_modes(speconv, modes)
+            if trial_err > max_err:
+                rejected.add((i, d, tuple(new_modes)))
+            elif best is None or trial_err < best[0]:
+                best = (trial_err, frac, i, d, new_modes)
+        if best is None:
+            continue
+        err, frac, i, d, new_modes = best
+        set_modes(model.sp_convs[i], new_modes)
+        print(f'Layer {i}: modes {new_modes}, removed {frac:.2e} of the energy, validation error {err:.5f}')
+    return base_err, err
+
+
+@torch.no_grad()
+def time_inference(model, batches, predict, repeat=3):
+    for x, y in batches[:1]:
+        predict(model, x, y)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t0 = default_timer()
+    for _ in range(repeat):
+        for x, y in batches:
+            predict(model, x, y)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (default_timer() - t0) / (repeat * len(batches))
+
+
+def main(args):
+    with open(args.config_path, 'r') as stream:
+        config = yaml.load(stream, yaml.FullLoader)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model, dataloader, predict = build(config, device)
+    model.eval()
+    batches = []
+    for x, y in dataloader:
+        batches.append((x.to(device), y.to(device)))
+        if args.n_val is not None and len(batches) * x.shape[0] >= args.n_val:
+            break
+
+    original = copy.deepcopy(model)
+    base_err, err = prune(model, batches, predict, args.budget, step=args.step, num_trials=args.num_trials)
+    for speconv in model.sp_convs:
+        speconv.prune_to_active()
+    modes = [[speconv.modes1 for speconv in model.sp_convs],
+             [speconv.modes2 for speconv in model.sp_convs]]
+    if isinstance(model, FNO3d):
+        modes.append([speconv.modes3 for speconv in model.sp_convs])
+    for k, m in enumerate(modes, start=1):
+        setattr(model, f'modes{k}', m)
+        config['model'][f'modes{k}'] = m
+
+    # save the pruned model and its config
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    torch.save({'model': model.state_dict()}, args.out)
+    config['test']['ckpt'] = args.out
+    config_path = os.path.splitext(args.out)[0] + '.yaml'
+    with open(config_path, 'w') as f:
+        yaml.dump(config, f)
+
+    t_original = time_inference(original, batches, predict)
+    t_pruned = time_inference(model, batches, predict)
+    size_original = sum(v.numel() * v.element_size() for v in original.state_dict().values())
+    size_pruned = sum(v.numel() * v.element_size() for v in model.state_dict().values())
+    print(f'Modes: {modes}')
+    print(f'Validation error: {base_err:.5f} -> {err:.5f}')
+    print(f'Parameters: {count_params(original)} -> {count_params(model)}; '
+          f'checkpoint: {size_original / 2 ** 20:.2f} MB -> {size_pruned / 2 ** 20:.2f} MB')
+    print(f'Inference time per batch: {t_original * 1000:.2f} ms -> {t_pruned * 1000:.2f} ms, '
+          f'speedup {t_original / t_pruned:.2f}x')
+    print(f'Pruned model saved at {args.out}, config at {config_path}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--config_path', type=str, help='Path to the test configuration file')
+    parser.add_argument('--budget', type=float, default=0.02,
+                        help='Largest relative increase of the validation error, e.g. 0.02 for 2%%')
+    parser.add_argument('--step', type=int, default=1, help='Number of modes removed from one direction at a time')
+    parser.add_argument('--num_trials', type=int, default=4,
+                        help='Number of candidates with the least energy tried in every round')
+    parser.add_argument('--n_val', type=int, default=None, help='Number of validation samples, default all of them')
+    parser.add_argument('--out', type=str, default='checkpoints/pruned.pt', help='Path of the pruned checkpoint')
+    args = parser.parse_args()
+    main(args)
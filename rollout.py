@@ -0,0 +1,211 @@
+'''
+Long-horizon rollout of Kolmogorov flow by chaining FNO3d windows, e.g.
+python3 rollout.py --config configs/instance/Re500-1_8-PINO-s.yaml --ckpt [checkpoint] --horizon 50 --num_traj 16 --out exp/rollout/Re500-50s.npy
+
+Each window of t_duration starts from the last predicted frame of the previous one, fed through the grid input as in convert_ic.
+The trajectories are rolled out in batches and every window is written to a .npy memmap of shape (N, num_frames, S, S)
+as soon as it is predicted, so the memory does not grow with the horizon.
+With --threshold, a window whose PDE residual exceeds it is recomputed by the pseudospectral solver
+from the same initial frame (re-anchoring), so that the rollout does not drift off the attractor.
+'''
+import os
+import math
+import yaml
+from argparse import ArgumentParser
+from timeit import default_timer
+from tqdm import tqdm
+
+import numpy as np
+import torch
+
+from models import FNO3d
+from solver.kolmogorov_flow import KolmogorovFlow2d
+from train_utils.losses import LpLoss, FDM_NS_vorticity, get_forcing
+from train_utils.utils import convert_ic, count_params
+
+
+class RolloutEngine(object):
+    '''
+    Chains windows of a trained FNO3d into long trajectories
+    '''
+    def __init__(self, model, T, t_duration, Re, threshold=None, anchor_dt=1e-3, forcing_n=4):
+        '''
+        Args:
+            model: FNO3d trained on windows of t_duration with T time steps
+            T: number of time steps of a window, both ends included
+            t_duration: time span of a window
+            Re: Reynolds number
+            threshold: largest relative PDE residual of a predicted window, None never re-anchors
+            anchor_dt: time step of the solver used for re-anchoring
+            forcing_n: forcing number n of the forcing -n cos(ny)
+        '''
+        self.model = model
+        self.T = T
+        self.t_duration = t_duration
+        self.Re = Re
+        self.threshold = threshold
+        self.anchor_dt = anchor_dt
+        self.forcing_n = forcing_n
+        self.residual_loss = LpLoss(reduction=False)
+        self.forcing = None
+
+    def num_windows(self, horizon):
+        return math.ceil(horizon / self.t_duration - 1e-6)
+
+    @torch.inference_mode()
+    def predict(self, u0):
+        '''
+        Args:
+            u0: initial frames (N, S, S)
+        Returns:
+            window (N, S, S, T)
+        '''
+        N, S = u0.shape[0], u0.shape[1]
+        a_in = convert_ic(u0, N, S, self.T)
+        return self.model(a_in)[..., 0]
+
+    @torch.inference_mode()
+    def residual(self, w):
+        '''
+        Relative PDE residual of each window, as the PDE loss of PINO_loss3d
+        '''
+        S = w.shape[1]
+        if self.forcing is None or self.forcing.shape[1] != S:
+            self.forcing = get_forcing(S).to(w.device)
+        Du = FDM_NS_vorticity(w, 1 / self.Re, self.t_duration)
+        f = self.forcing.repeat(w.shape[0], 1, 1, w.shape[3] - 2)
+        return self.residual_loss(Du, f)
+
+    @torch.inference_mode()
+    def solve(self, u0):
+        '''
+        Solve one window with the pseudospectral solver, recorded on the time grid of the model
+        '''
+        NS = KolmogorovFlow2d(u0.double(), self.Re, self.forcing_n)
+        dt = self.t_duration / (self.T - 1)
+        frames = [u0]
+        for _ in range(self.T - 1):
+            NS.advance(dt, delta_t=self.anchor_dt)
+            frames.append(NS.vorticity().to(u0.dtype))
+        return torch.stack(frames, dim=-1)
+
+    @torch.inference_mode()
+    def rollout(self, u0, num_windows, out, start=0, pbar=None):
+        '''
+        Roll out a batch of trajectories and write them into out[start: start + N]
+        Args:
+            u0: initial frames (N, S, S)
+            num_windows: number of windows to chain
+            out: array of shape (total trajectories, num_windows * (T - 1) + 1, S, S), e.g. a memmap
+            start: index of the first trajectory of the batch in out
+        Returns:
+            residuals: (N, num_windows) PDE residual of each predicted window
+            anchored: (N, num_windows) whether the window was recomputed by the solver
+        '''
+        N = u0.shape[0]
+        residuals = torch.zeros(N, num_windows)
+        anchored = torch.zeros(N, num_windows, dtype=torch.bool)
+        out[start: start + N, 0] = u0.cpu().numpy()
+        for i in range(num_windows):
+            w = self.predict(u0)
+            res = self.residual(w)
+            residuals[:, i] = res.cpu()
+            if self.threshold is not None:
+                bad = torch.nonzero(res > self.threshold).flatten()
+                if len(bad) > 0:
+                    w[bad] = self.solve(u0[bad])
+                    anchored[bad.cpu(), i] = True
+            # the first frame of the window is the last frame of the previous one
+            frames = w[..., 1:].permute(0, 3, 1, 2).cpu().numpy()
+            out[start: start + N, 1 + i * (self.T - 1): 1 + (i + 1) * (self.T - 1)] = frames
+            if hasattr(out, 'flush'):
+                out.flush()
+            u0 = w[..., -1]
+            if pbar is not None:
+                pbar.update(1)
+        return residuals, anchored
+
+
+def load_ics(config, num_traj):
+    '''
+    Initial frames of the test trajectories, subsampled to the data resolution
+    '''
+    raw_data = np.load(config['data']['paths'][0], mmap_mode='r')
+    sub_x = config['data']['raw_res'][0] // config['data']['data_res'][0]
+    offset = config['data']['testoffset']
+    ics = raw_data[offset: offset + num_traj, 0, ::sub_x, ::sub_x]
+    return torch.tensor(np.array(ics), dtype=torch.float32)
+
+
+def subprocess(args):
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, yaml.FullLoader)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    model = FNO3d(modes1=config['model']['modes1'],
+                  modes2=config['model']['modes2'],
+                  modes3=config['model']['modes3'],
+                  fc_dim=config['model']['fc_dim'],
+                  layers=config['model']['layers'],
+                  act=config['model']['act'],
+                  pad_ratio=config['model']['pad_ratio']).to(device)
+    print(f'Number of parameters: {count_params(model)}')
+    if args.ckpt:
+        ckpt = torch.load(args.ckpt, map_location=device)
+        model.load_state_dict(ckpt['model'])
+        print('Weights loaded from %s' % args.ckpt)
+    model.eval()
+
+    t_duration = config['data']['t_duration']
+    if t_duration == 1.0:
+        T = config['data']['data_res'][2]
+    else:
+        T = int(config['data']['data_res'][2] * t_duration) + 1
+    engine = RolloutEngine(model, T, t_duration, config['data']['Re'],
+                           threshold=args.threshold, anchor_dt=args.anchor_dt)
+
+    ics = load_ics(config, args.num_traj)
+    N, S = ics.shape[0], ics.shape[1]
+    num_windows = engine.num_windows(args.horizon)
+    num_frames = num_windows * (T - 1) + 1
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    out = np.lib.format.open_memmap(args.out, mode='w+', dtype=np.float32, shape=(N, num_frames, S, S))
+    print(f'Rolling out {N} trajectories of {num_windows} windows ({num_frames} frames) into {args.out}')
+
+    pbar = tqdm(total=num_windows * math.ceil(N / args.batchsize), dynamic_ncols=True) if args.tqdm else None
+    residuals, anchored = [], []
+    t0 = default_timer()
+    for start in range(0, N, args.batchsize):
+        u0 = ics[start: start + args.batchsize].to(device)
+        res, anc = engine.rollout(u0, num_windows, out, start=start, pbar=pbar)
+        residuals.append(res)
+        anchored.append(anc)
+    duration = default_timer() - t0
+    if pbar is not None:
+        pbar.close()
+    del out
+
+    residuals = torch.cat(residuals, dim=0)
+    anchored = torch.cat(anchored, dim=0)
+    stats_path = os.path.splitext(args.out)[0] + '-stats.pt'
+    torch.save({'residual': residuals, 'anchored': anchored, 'dt': t_duration / (T - 1), 'time': duration}, stats_path)
+    print(f'Done in {duration:.1f}s, {N * num_windows / duration:.1f} windows/s; '
+          f'averaged PDE residual {residuals.mean().item():.3e}, '
+          f'{anchored.sum().item()} of {anchored.numel()} windows re-anchored by the solver')
+
+
+if __name__ == '__main__':
+    torch.backends.cudnn.benchmark = True
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--config', type=str, help='Path to the configuration file')
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--horizon', type=float, default=50.0, help='Length of the trajectories in time units')
+    parser.add_argument('--num_traj', type=int, default=1, help='Number of test trajectories to roll out')
+    parser.add_argument('--batchsize', type=int, default=8, help='Number of trajectories rolled out together')
+    parser.add_argument('--out', type=str, default='exp/rollout/rollout.npy', help='Output .npy file')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Re-anchor a window with the solver if its PDE residual exceeds it')
+    parser.add_argument('--anchor_dt', type=float, default=1e-3, help='Time step of the solver')
+    parser.add_argument('--tqdm', action='store_true', help='Turn on the tqdm')
+    args = parser.parse_args()
+    subprocess(args)
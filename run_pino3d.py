@@ -28,7 +28,11 @@ def run_instance(loader, config, data_config):
         model.load_state_dict(ckpt['model'])
         print('Weights loaded from %s' % ckpt_path)
 
-    if 'twolayer' in config['train'] and config['train']['twolayer']:
+    if 'adapter_rank' in config['train']:
+        # train low-rank adapters of the spectral weights only
+        model.add_adapters(config['train']['adapter_rank'])
+        params = [param for param in model.parameters() if param.requires_grad]
+    elif 'twolayer' in config['train'] and config['train']['twolayer']:
         requires_grad(model, False)
         requires_grad(model.sp_convs[-1], True)
         requires_grad(model.ws[-1], True)
@@ -10,6 +10,7 @@ import torch
 from train_utils.datasets import NSLoader
 from train_utils.losses import LpLoss
 from solver.kolmogorov_flow import KolmogorovFlow2d
+from solver.spinup import kolmogorov_spinup, branch
 
 
 def solve(a,
@@ -42,17 +43,54 @@ def solve(a,
     return sol
 
 
+def bench_warm(args, config, device):
+    '''
+    Benchmark the solver on states branched from a cached spun-up state instead of the test set
+    '''
+    data_config = config['data']
+    S = data_config['nx'] // data_config['sub']
+    res_t = int(data_config['nt'] * data_config['time_interval']) // data_config['sub_t']
+    w0 = kolmogorov_spinup(data_config['Re'], S, n=4, seed=args.seed,
+                           cache_dir=args.cache_dir, device=device)
+    states = branch(w0, data_config['n_sample'], eps=args.branch_eps, seed=args.seed)
+    time_cost = []
+    for u0 in states:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t1 = default_timer()
+        solve(u0, res_x=S, res_t=res_t,
+              end=data_config['time_interval'],
+              Re=data_config['Re'], n=4,
+              delta_t=args.deltat)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t2 = default_timer()
+        time_cost.append(t2 - t1)
+    time_cost = np.array(time_cost)
+    print(f'Warm states: {len(states)}; \n'
+          f'Time cost = mean: {time_cost.mean()}s; std_err: {time_cost.std(ddof=1) / math.sqrt(len(states))}s; \n'
+          f'Solver resolution: {S} x {S} x {res_t + 1}')
+
+
 if __name__ == '__main__':
     torch.backends.cudnn.benchmark = True
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     parser = ArgumentParser(description='Basic paser')
     parser.add_argument('--config_path', type=str, help='Path to the configuration file')
     parser.add_argument('--deltat', type=float, default=1e-3, help='delta T')
+    parser.add_argument('--warm_start', action='store_true', help='Benchmark from cached spun-up states')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the spun-up state cache')
+    parser.add_argument('--branch_eps', type=float, default=1e-3, help='Relative size of the perturbations of the warm states')
+    parser.add_argument('--seed', type=int, default=0)
     args = parser.parse_args()
     config_file = args.config_path
     with open(config_file, 'r') as stream:
         config = yaml.load(stream, yaml.FullLoader)
 
+    if args.warm_start:
+        bench_warm(args, config, device)
+        exit()
+
     data_config = config['data']
     loader = NSLoader(datapath1=data_config['datapath'],
                       nx=data_config['nx'], nt=data_config['nt'],
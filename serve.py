@@ -0,0 +1,304 @@
+'''
+Serve FNO3d predictions of Kolmogorov flow over HTTP, e.g.
+python3 serve.py --config configs/instance/Re500-1_8-PINO-s.yaml --ckpt [checkpoint] --port 8000
+
+POST /predict   body: .npy array of initial conditions, (S, S) or (n, S, S)
+                optional query: T=[number of time steps], t=[comma separated time indices to return, e.g. -1]
+                returns: .npy array of the predicted vorticity, (n, S, S, T) or (n, S, S, number of time indices)
+GET  /stats     returns: JSON of the request, batch, latency and throughput counters
+
+The checkpoint is loaded once. Pending requests of the same shape are grouped into one batch,
+which waits at most --max_latency ms for more requests and holds at most --max_batch samples.
+The batches run one at a time on a worker thread under torch.inference_mode, so the event loop keeps accepting requests.
+'''
+import io
+import json
+import yaml
+import asyncio
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import torch
+
+from models import FNO3d
+from train_utils.utils import convert_ic, count_params
+
+
+def num_time_steps(config):
+    '''
+    Number of time steps of the model output, as in KFDataset
+    '''
+    t_duration = config['data']['t_duration']
+    if t_duration == 1.0:
+        return config['data']['data_res'][2]
+    return int(config['data']['data_res'][2] * t_duration) + 1
+
+
+class ServerStats(object):
+    '''
+    Counters of the server, latencies are kept for the last `window` requests
+    '''
+    def __init__(self, window=1000):
+        self.t_start = default_timer()
+        self.requests = 0
+        self.samples = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+
+    def add_batch(self, num_samples, duration):
+        self.batches += 1
+        self.samples += num_samples
+        self.busy_time += duration
+
+    def add_request(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.finished.append(default_timer())
+
+    def summary(self, queued=0):
+        uptime = default_timer() - self.t_start
+        stats = {'uptime': uptime,
+                 'requests': self.requests,
+                 'samples': self.samples,
+                 'batches': self.batches,
+                 'errors': self.errors,
+                 'queued requests': queued,
+                 'avg batch size': self.samples / max(self.batches, 1),
+                 'utilization': self.busy_time / max(uptime, 1e-9),
+                 'throughput': self.samples / max(uptime, 1e-9)}
+        if len(self.finished) > 1:
+            stats['recent requests/s'] = (len(self.finished) - 1) / max(self.finished[-1] - self.finished[0], 1e-9)
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000
+            stats['latency ms'] = {'mean': float(latencies.mean()),
+                                   'p50': float(np.percentile(latencies, 50)),
+                                   'p90': float(np.percentile(latencies, 90)),
+                                   'p99': float(np.percentile(latencies, 99))}
+        return stats
+
+
+class MicroBatcher(object):
+    '''
+    Groups pending requests by shape and runs them as batches.
+    The batch of the oldest pending request is started once it holds max_batch samples
+    or its oldest request has waited max_latency seconds.
+    '''
+    def __init__(self, predict, max_batch=16, max_latency=0.01, stats=None):
+        '''
+        Args:
+            predict: function of a numpy batch of initial conditions (n, S, S), T and t_indices, returning (n, S, S, T)
+            max_batch: largest number of samples in a batch
+            max_latency: longest time in seconds a request waits for others to join its batch
+        '''
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.stats = stats if stats is not None else ServerStats()
+        self.pending = {}
+        self.arrived = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def num_queued(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    async def submit(self, ic, T, t_indices=None):
+        '''
+        Queue a request and wait for its prediction
+        '''
+        future = asyncio.get_running_loop().create_future()
+        key = (tuple(ic.shape[1:]), T, t_indices)
+        self.pending.setdefault(key, []).append((ic, future, default_timer()))
+        self.arrived.set()
+        return await future
+
+    def _num_samples(self, queue):
+        return sum(ic.shape[0] for ic, _, _ in queue)
+
+    def _take(self, key):
+        '''
+        Remove the requests of the next batch from the queue of key, at least one request
+        '''
+        queue = self.pending[key]
+        num = 0
+        count = 0
+        for ic, _, _ in queue:
+            if count > 0 and num + ic.shape[0] > self.max_batch:
+                break
+            num += ic.shape[0]
+            count += 1
+        batch, self.pending[key] = queue[:count], queue[count:]
+        if len(self.pending[key]) == 0:
+            del self.pending[key]
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self.pending) == 0:
+                self.arrived.clear()
+                await self.arrived.wait()
+            # serve the shape whose oldest request has waited the longest
+            key = min(self.pending, key=lambda k: self.pending[k][0][2])
+            deadline = self.pending[key][0][2] + self.max_latency
+            while self._num_samples(self.pending[key]) < self.max_batch:
+                timeout = deadline - default_timer()
+                if timeout <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            requests = self._take(key)
+            ics = np.concatenate([ic for ic, _, _ in requests], axis=0)
+            t0 = default_timer()
+            try:
+                out = await loop.run_in_executor(self.executor, self.predict, ics, key[1], key[2])
+            except Exception as e:
+                self.stats.errors += len(requests)
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            t1 = default_timer()
+            self.stats.add_batch(ics.shape[0], t1 - t0)
+            start = 0
+            for ic, future, t_arrival in requests:
+                if not future.done():
+                    future.set_result(out[start: start + ic.shape[0]])
+                start += ic.shape[0]
+                self.stats.add_request(t1 - t_arrival)
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+async def write_response(writer, status, body, content_type):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+    header = (f'HTTP/1.1 {status} {reasons[status]}\r\n'
+              f'Content-Type: {content_type}\r\n'
+              f'Content-Length: {len(body)}\r\n\r\n')
+    writer.write(header.encode() + body)
+    await writer.drain()
+
+
+async def handle_connection(reader, writer, batcher, default_T):
+    '''
+    Minimal HTTP/1.1 with keep-alive: one request after the other on the same connection
+    '''
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            url = urlsplit(target)
+
+            if method == 'GET' and url.path == '/stats':
+                stats = batcher.stats.summary(queued=batcher.num_queued())
+                await write_response(writer, 200, json.dumps(stats).encode(), 'application/json')
+            elif method == 'POST' and url.path == '/predict':
+                try:
+                    ic = np.load(io.BytesIO(body), allow_pickle=False).astype(np.float32)
+                    if ic.ndim == 2:
+                        ic = ic[None]
+                    if ic.ndim != 3 or ic.shape[1] != ic.shape[2]:
+                        raise ValueError(f'Expected initial conditions of shape (n, S, S), got {ic.shape}')
+                    query = parse_qs(url.query)
+                    T = int(query['T'][0]) if 'T' in query else default_T
+                    t_indices = tuple(int(t) for t in query['t'][0].split(',')) if 't' in query else None
+                except ValueError as e:
+                    batcher.stats.errors += 1
+                    await write_response(writer, 400, str(e).encode(), 'text/plain')
+                    continue
+                try:
+                    out = await batcher.submit(ic, T, t_indices)
+                except Exception as e:
+                    await write_response(writer, 500, str(e).encode(), 'text/plain')
+                    continue
+                await write_response(writer, 200, to_npy(out), 'application/octet-stream')
+            else:
+                await write_response(writer, 404, b'Not found', 'text/plain')
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def load_model(config, ckpt_path, device):
+    model = FNO3d(modes1=config['model']['modes1'],
+                  modes2=config['model']['modes2'],
+                  modes3=config['model']['modes3'],
+                  fc_dim=config['model']['fc_dim'],
+                  layers=config['model']['layers'],
+                  act=config['model']['act'],
+                  pad_ratio=config['model']['pad_ratio']).to(device)
+    print(f'Number of parameters: {count_params(model)}')
+    if ckpt_path:
+        ckpt = torch.load(ckpt_path, map_location=device)
+        model.load_state_dict(ckpt['model'])
+        print('Weights loaded from %s' % ckpt_path)
+    model.eval()
+    return model
+
+
+async def serve(args):
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, yaml.FullLoader)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model = load_model(config, args.ckpt, device)
+
+    @torch.inference_mode()
+    def predict(ics, T, t_indices=None):
+        u0 = torch.from_numpy(ics).to(device)
+        N, S = u0.shape[0], u0.shape[1]
+        a_in = convert_ic(u0, N, S, T)
+        out = model(a_in, t_indices=None if t_indices is None else list(t_indices))
+        return out[..., 0].cpu().numpy()
+
+    batcher = MicroBatcher(predict, max_batch=args.max_batch, max_latency=args.max_latency / 1000)
+    default_T = num_time_steps(config)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, batcher, default_T),
+        host=args.host, port=args.port)
+    print(f'Serving on http://{args.host}:{args.port}, default T={default_T}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+if __name__ == '__main__':
+    torch.backends.cudnn.benchmark = True
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--config', type=str, help='Path to the configuration file')
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch', type=int, default=16, help='Largest number of samples in a batch')
+    parser.add_argument('--max_latency', type=float, default=10.0,
+                        help='Longest time in ms a request waits for others to join its batch')
+    args = parser.parse_args()
+    asyncio.run(serve(args))
@@ -1,9 +1,14 @@
 import torch
 import math
 
+from solver.periodic import spectral_downsample
 
-class KolmogorovFlow2d(object):
 
+class KolmogorovFlow2d(object):
+    '''
+    Re and n are either numbers shared by the batch,
+    or tensors of shape (N,) with one Reynolds number and one forcing number per sample of w0 (N, s, s).
+    '''
     def __init__(self, w0, Re, n):
 
         # Grid size
@@ -14,21 +19,33 @@ class KolmogorovFlow2d(object):
 
         assert math.log2(self.s).is_integer(), "Grid size must be power of 2."
 
-        assert n >= 0 and isinstance(n, int), "Forcing number must be non-negative integer."
+        # Device
+        self.device = w0.device
+
+        self.batched = torch.is_tensor(Re) or torch.is_tensor(n)
 
-        assert n < self.s // 2 - 1, "Forcing number too large for grid size."
+        if self.batched:
+            n = torch.as_tensor(n, device=self.device).long().reshape(-1)
+            Re = torch.as_tensor(Re, dtype=torch.float32, device=self.device).reshape(-1)
+
+            assert not torch.is_floating_point(n) and bool(torch.all(n >= 0)), "Forcing number must be non-negative integer."
+
+            assert bool(torch.all(n < self.s // 2 - 1)), "Forcing number too large for grid size."
+
+            assert bool(torch.all(Re > 0)), "Reynolds number must be positive."
+        else:
+            assert n >= 0 and isinstance(n, int), "Forcing number must be non-negative integer."
+
+            assert n < self.s // 2 - 1, "Forcing number too large for grid size."
+
+            assert Re > 0, "Reynolds number must be positive."
 
         # Forcing number
         self.n = n
 
-        assert Re > 0, "Reynolds number must be positive."
-
         # Reynolds number
         self.Re = Re
 
-        # Device
-        self.device = w0.device
-
         # Current time
         self.time = 0.0
 
@@ -48,7 +65,20 @@ class KolmogorovFlow2d(object):
         self.inv_lap = 1.0 / self.inv_lap
 
         # Negative scaled Laplacian
-        self.G = (1.0 / self.Re) * (self.k_x ** 2 + self.k_y ** 2)
+        if self.batched:
+            self.G = (1.0 / self.Re).view(-1, 1, 1) * (self.k_x ** 2 + self.k_y ** 2)
+        else:
+            self.G = (1.0 / self.Re) * (self.k_x ** 2 + self.k_y ** 2)
+
+        # Forcing -ncos(ny) of each sample in Fourier space
+        if self.batched:
+            N = w0.shape[0]
+            n = self.n.expand(N)
+            amp = (n.float() / 2.0) * (self.s ** 2)
+            idx = torch.arange(N, device=self.device)
+            self.f_h = torch.zeros_like(self.w_h)
+            self.f_h[idx, 0, n] -= amp
+            self.f_h[idx, 0, (-n) % self.s] -= amp
 
         # Dealiasing mask using 2/3 rule
         self.dealias = (self.k_x ** 2 + self.k_y ** 2 <= (self.s / 3.0) ** 2).float()
@@ -56,13 +86,19 @@ class KolmogorovFlow2d(object):
         self.dealias[0, 0] = 0.0
 
     # Get current vorticity from stream function (Fourier space)
-    def vorticity(self, stream_f=None, real_space=True):
+    # If res is given, the vorticity is returned on a res x res grid by truncating the spectrum
+    def vorticity(self, stream_f=None, real_space=True, res=None):
         if stream_f is not None:
-            w_h = self.Re * self.G * stream_f
+            if self.batched:
+                w_h = self.Re.view(-1, 1, 1) * self.G * stream_f
+            else:
+                w_h = self.Re * self.G * stream_f
         else:
             w_h = self.w_h
 
         if real_space:
+            if res is not None:
+                return spectral_downsample(w_h, self.s, self.s, res, res)
             return torch.fft.irfft2(w_h, s=(self.s, self.s), norm="backward")
         else:
             return w_h
@@ -118,7 +154,9 @@ class KolmogorovFlow2d(object):
         nonlin = -1j * (t1 + t2)
 
         # Apply forcing: -ncos(ny)
-        if self.n > 0:
+        if self.batched:
+            nonlin = nonlin + self.f_h
+        elif self.n > 0:
             nonlin[..., 0, self.n] -= (float(self.n) / 2.0) * (self.s ** 2)
             nonlin[..., 0, -self.n] -= (float(self.n) / 2.0) * (self.s ** 2)
 
@@ -5,6 +5,21 @@ import math
 
 #Setup for indexing in the 'ij' format
 
+#Truncate the spectrum of a field on an s1 x s2 grid and return it in physical space on an r1 x r2 grid
+#w_h can be either in rfft2 layout (s1, s2//2 + 1) or in fft2 layout (s1, s2)
+def spectral_downsample(w_h, s1, s2, r1, r2):
+    if r1 == s1 and r2 == s2:
+        return fft.irfft2(w_h, s=(s1, s2))
+
+    assert r1 <= s1 and r2 <= s2, "Target grid must not be finer than the solver grid."
+
+    out_h = torch.zeros(*w_h.shape[:-2], r1, r2//2 + 1, dtype=w_h.dtype, device=w_h.device)
+    out_h[..., :r1//2, :] = w_h[..., :r1//2, :r2//2 + 1]
+    out_h[..., -(r1//2):, :] = w_h[..., -(r1//2):, :r2//2 + 1]
+
+    #Rescale for the unnormalized inverse transform on the coarse grid
+    return fft.irfft2(out_h, s=(r1, r2))*((r1*r2)/(s1*s2))
+
 #Solve: -Lap(u) = f
 class Poisson2d(object):
 
@@ -35,6 +50,8 @@ class Poisson2d(object):
 #       u = (psi_y, -psi_x)
 #       -Lap(psi) = w
 #Note: Adaptive time-step takes smallest step across the batch
+#Note: Re can be a number or a tensor of shape (N,) with one Reynolds number per sample,
+#      f can be of shape (s1, s2) or (N, s1, s2) with one forcing per sample
 class NavierStokes2d(object):
 
     def __init__(self, s1, s2, L1=2*math.pi, L2=2*math.pi, device=None, dtype=torch.float64):
@@ -127,6 +144,10 @@ class NavierStokes2d(object):
         else:
             xi = 1.0
         
+        #Smallest Reynolds number across the batch
+        if torch.is_tensor(Re):
+            Re = torch.min(Re).item()
+
         #Viscosity
         mu = (1.0/Re)*xi*((self.L1/(2*math.pi))**(3.0/4.0))*(((self.L2/(2*math.pi))**(3.0/4.0)))
 
@@ -136,13 +157,27 @@ class NavierStokes2d(object):
         #Time step based on CFL condition
         return min(0.5*self.h/max_speed, 0.5*(self.h**2)/mu)
 
+    #Vorticity in physical space on the grid res = (r1, r2) from its spectrum, without a full-grid inverse transform
+    def physical(self, w_h, res=None):
+        if res is None:
+            res = (self.s1, self.s2)
+        elif isinstance(res, int):
+            res = (res, res)
+        return spectral_downsample(w_h, self.s1, self.s2, res[0], res[1])
+
     def advance(self, w, f=None, T=1.0, Re=100, adaptive=True, delta_t=1e-3):
+        w_h = self.advance_h(fft.rfft2(w), f, T, Re, adaptive, delta_t)
+        return fft.irfft2(w_h, s=(self.s1, self.s2))
 
-        #Rescale Laplacian by Reynolds number
-        GG = (1.0/Re)*self.G
+    #Same as advance, but takes and returns the vorticity in Fourier space
+    def advance_h(self, w_h, f=None, T=1.0, Re=100, adaptive=True, delta_t=1e-3):
 
-        #Move to Fourier space
-        w_h = fft.rfft2(w)
+        #Rescale Laplacian by Reynolds number, per sample if Re is a tensor
+        if torch.is_tensor(Re):
+            Re = Re.to(device=self.G.device, dtype=self.G.dtype)
+            GG = (1.0/Re).view(-1, 1, 1)*self.G
+        else:
+            GG = (1.0/Re)*self.G
 
         if f is not None:
             f_h = fft.rfft2(f)
@@ -180,7 +215,7 @@ class NavierStokes2d(object):
                 q, v = self.velocity_field(self.stream_function(w_h, real_space=False), real_space=True)
                 delta_t = self.time_step(q, v, f, Re)
         
-        return fft.irfft2(w_h, s=(self.s1, self.s2))
+        return w_h
     
     def __call__(self, w, f=None, T=1.0, Re=100, adaptive=True, delta_t=1e-3):
         return self.advance(w, f, T, Re, adaptive, delta_t)
\ No newline at end of file
@@ -1,81 +1,125 @@
 import torch
 
 import math
+from functools import lru_cache
 
 torch.manual_seed(0)
 
 
-class GaussianRF(object):
-    def __init__(self, dim, size, length=1.0, alpha=2.0, tau=3.0, sigma=None, boundary="periodic", constant_eig=False, device=None):
-
-        self.dim = dim
-        self.device = device
+def _freqs(size, device=None, dtype=torch.float32):
+    # wavenumbers in the order of torch.fft.fft: 0, 1, ..., size//2 - 1, -size//2, ..., -1
+    k_max = size//2
+    return torch.cat((torch.arange(start=0, end=k_max, step=1, dtype=dtype, device=device), \
+                      torch.arange(start=-k_max, end=0, step=1, dtype=dtype, device=device)), 0)
 
-        if sigma is None:
-            sigma = tau**(0.5*(2*alpha - self.dim))
 
-        k_max = size//2
+def _support(freqs, k_max):
+    # indices of the flattened half spectrum with |k_i| <= k_max in every direction
+    grids = torch.meshgrid(*freqs, indexing='ij')
+    mask = torch.ones_like(grids[0], dtype=torch.bool)
+    for k in grids:
+        mask &= torch.abs(k) <= k_max
+    return torch.nonzero(mask.flatten()).squeeze(1)
 
-        const = (4*(math.pi**2))/(length**2)
 
-        if dim == 1:
-            k = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device), \
-                           torch.arange(start=-k_max, end=0, step=1, device=device)), 0)
+@lru_cache(maxsize=16)
+def _sqrt_eig(dim, size, length, alpha, tau, sigma, constant_eig):
+    '''
+    Square root of the eigenvalues of the covariance operator on the half spectrum,
+    i.e. only the first size//2 + 1 frequencies of the last dimension.
+    Cached on the CPU per set of arguments, do not modify the returned tensor in place.
+    '''
+    const = (4*(math.pi**2))/(length**2)
+    freqs = [_freqs(size)] * (dim - 1) + \
+            [torch.arange(start=0, end=size//2 + 1, step=1, dtype=torch.float32)]
+    grids = torch.meshgrid(*freqs, indexing='ij')
+    k2 = sum(k**2 for k in grids)
 
-            self.sqrt_eig = size*math.sqrt(2.0)*sigma*((const*(k**2) + tau**2)**(-alpha/2.0))
+    sqrt_eig = (size**dim)*math.sqrt(2.0)*sigma*((const*k2 + tau**2)**(-alpha/2.0))
+    if constant_eig:
+        sqrt_eig[(0, ) * dim] = (size**dim)*sigma*(tau**(-alpha))
+    else:
+        sqrt_eig[(0, ) * dim] = 0.0
+    return sqrt_eig, freqs
 
-            if constant_eig:
-                self.sqrt_eig[0] = size*sigma*(tau**(-alpha))
-            else:
-                self.sqrt_eig[0] = 0.0
 
-        elif dim == 2:
-            wavenumers = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device), \
-                                    torch.arange(start=-k_max, end=0, step=1, device=device)), 0).repeat(size,1)
+@lru_cache(maxsize=16)
+def _sqrt_eig2d(s1, s2, L1, L2, alpha, tau, sigma, dtype):
+    '''
+    Cached on the CPU per set of arguments, do not modify the returned tensor in place.
+    '''
+    const1 = (4*(math.pi**2))/(L1**2)
+    const2 = (4*(math.pi**2))/(L2**2)
 
-            k_x = wavenumers.transpose(0,1)
-            k_y = wavenumers
+    k1 = _freqs(s1, dtype=dtype).view(-1, 1).repeat(1, s2//2 + 1)
+    k2 = torch.arange(start=0, end=s2//2 + 1, step=1, dtype=dtype).view(1, -1).repeat(s1, 1)
 
-            self.sqrt_eig = (size**2)*math.sqrt(2.0)*sigma*((const*(k_x**2 + k_y**2) + tau**2)**(-alpha/2.0))
+    sqrt_eig = s1*s2*sigma*((const1*k1**2 + const2*k2**2 + tau**2)**(-alpha/2.0))
+    sqrt_eig[0,0] = 0.0
+    return sqrt_eig, [k1[:, 0], k2[0]]
 
-            if constant_eig:
-                self.sqrt_eig[0,0] = (size**2)*sigma*(tau**(-alpha))
-            else:
-                self.sqrt_eig[0,0] = 0.0
 
-        elif dim == 3:
-            wavenumers = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device), \
-                                    torch.arange(start=-k_max, end=0, step=1, device=device)), 0).repeat(size,size,1)
-
-            k_x = wavenumers.transpose(1,2)
-            k_y = wavenumers
-            k_z = wavenumers.transpose(0,2)
-
-            self.sqrt_eig = (size**3)*math.sqrt(2.0)*sigma*((const*(k_x**2 + k_y**2 + k_z**2) + tau**2)**(-alpha/2.0))
-
-            if constant_eig:
-                self.sqrt_eig[0,0,0] = (size**3)*sigma*(tau**(-alpha))
-            else:
-                self.sqrt_eig[0,0,0] = 0.0
+class GaussianRF(object):
+    '''
+    Gaussian random field on the periodic domain [0, length]^dim.
+    Only the independent half of the spectrum is sampled.
+    If k_max is given, only the modes with |k_i| <= k_max are sampled.
+    '''
+    def __init__(self, dim, size, length=1.0, alpha=2.0, tau=3.0, sigma=None, boundary="periodic", constant_eig=False, k_max=None, device=None):
 
-        self.size = []
-        for j in range(self.dim):
-            self.size.append(size)
+        self.dim = dim
+        self.device = device
 
-        self.size = tuple(self.size)
+        if sigma is None:
+            sigma = tau**(0.5*(2*alpha - self.dim))
 
-    def sample(self, N):
+        self.size = tuple([size] * self.dim)
+        self.half_size = tuple([size] * (self.dim - 1) + [size//2 + 1])
+        self.fft_dims = list(range(-self.dim, 0))
 
-        coeff = torch.randn(N, *self.size, dtype=torch.cfloat, device=self.device)
-        coeff = self.sqrt_eig*coeff
+        sqrt_eig, freqs = _sqrt_eig(dim, size, float(length), float(alpha), float(tau), float(sigma), constant_eig)
+        self.sqrt_eig = sqrt_eig.to(device)
+        if k_max is None or k_max >= size//2:
+            self.index = None
+        else:
+            self.index = _support(freqs, k_max).to(device)
+            self.sqrt_eig_trunc = self.sqrt_eig.flatten()[self.index]
+
+    def sample(self, N, out=None):
+        '''
+        Args:
+            N: number of samples
+            out: optional preallocated output of shape (N, *size)
+        Returns:
+            tensor of shape (N, *size)
+        '''
+        if self.index is None:
+            coeff = torch.randn(N, *self.half_size, dtype=torch.cfloat, device=self.device)
+            coeff.mul_(self.sqrt_eig)
+        else:
+            xi = torch.randn(N, self.index.shape[0], dtype=torch.cfloat, device=self.device)
+            coeff = torch.zeros(N, self.sqrt_eig.numel(), dtype=torch.cfloat, device=self.device)
+            coeff[:, self.index] = self.sqrt_eig_trunc*xi
+            coeff = coeff.view(N, *self.half_size)
 
-        u = torch.fft.irfftn(coeff, self.size, norm="backward")
+        u = torch.fft.irfftn(coeff, s=self.size, dim=self.fft_dims, norm="backward", out=out)
         return u
 
+    def sample_into(self, out, batchsize=None):
+        '''
+        Fill the preallocated tensor out of shape (N, *size) with N samples, batchsize samples at a time.
+        '''
+        N = out.shape[0]
+        if batchsize is None:
+            batchsize = N
+        for i in range(0, N, batchsize):
+            self.sample(min(batchsize, N - i), out=out[i:i + batchsize])
+        return out
+
 
 class GaussianRF2d(object):
 
-    def __init__(self, s1, s2, L1=2*math.pi, L2=2*math.pi, alpha=2.0, tau=3.0, sigma=None, mean=None, boundary="periodic", device=None, dtype=torch.float64):
+    def __init__(self, s1, s2, L1=2*math.pi, L2=2*math.pi, alpha=2.0, tau=3.0, sigma=None, mean=None, boundary="periodic", k_max=None, device=None, dtype=torch.float64):
 
         self.s1 = s1
         self.s2 = s2
@@ -90,30 +134,53 @@ class GaussianRF2d(object):
         else:
             self.sigma = sigma
 
-        const1 = (4*(math.pi**2))/(L1**2)
-        const2 = (4*(math.pi**2))/(L2**2)
-
-        freq_list1 = torch.cat((torch.arange(start=0, end=s1//2, step=1),\
-                                torch.arange(start=-s1//2, end=0, step=1)), 0)
-        k1 = freq_list1.view(-1,1).repeat(1, s2//2 + 1).type(dtype).to(device)
-
-        freq_list2 = torch.arange(start=0, end=s2//2 + 1, step=1)
-
-        k2 = freq_list2.view(1,-1).repeat(s1, 1).type(dtype).to(device)
-
-        self.sqrt_eig = s1*s2*self.sigma*((const1*k1**2 + const2*k2**2 + tau**2)**(-alpha/2.0))
-        self.sqrt_eig[0,0] = 0.0
+        sqrt_eig, freqs = _sqrt_eig2d(s1, s2, float(L1), float(L2), float(alpha), float(tau), float(self.sigma), dtype)
+        self.sqrt_eig = sqrt_eig.to(device)
+        if k_max is None or k_max >= max(s1, s2)//2:
+            self.index = None
+        else:
+            self.index = _support(freqs, k_max).to(device)
+            self.sqrt_eig_trunc = self.sqrt_eig.flatten()[self.index]
+
+    def sample(self, N, xi=None, out=None):
+        '''
+        Args:
+            N: number of samples
+            xi: optional real normal coefficients of shape (N, s1, s2//2 + 1, 2), modified in place;
+                with k_max, only the coefficients of the kept modes are used
+            out: optional preallocated output of shape (N, s1, s2)
+        Returns:
+            tensor of shape (N, s1, s2)
+        '''
+        if self.index is not None:
+            if xi is None:
+                xi = torch.randn(N, self.index.shape[0], 2, dtype=self.dtype, device=self.device)
+            else:
+                xi = xi.reshape(N, -1, 2)[:, self.index]
+            coeff = torch.zeros(N, self.sqrt_eig.numel(), dtype=torch.view_as_complex(xi).dtype, device=self.device)
+            coeff[:, self.index] = self.sqrt_eig_trunc*torch.view_as_complex(xi)
+            coeff = coeff.view(N, self.s1, self.s2//2 + 1)
+        else:
+            if xi is None:
+                xi  = torch.randn(N, self.s1, self.s2//2 + 1, 2, dtype=self.dtype, device=self.device)
+            xi[...,0] = self.sqrt_eig*xi [...,0]
+            xi[...,1] = self.sqrt_eig*xi [...,1]
+            coeff = torch.view_as_complex(xi)
 
-    def sample(self, N, xi=None):
-        if xi is None:
-            xi  = torch.randn(N, self.s1, self.s2//2 + 1, 2, dtype=self.dtype, device=self.device)
-        
-        xi[...,0] = self.sqrt_eig*xi [...,0]
-        xi[...,1] = self.sqrt_eig*xi [...,1]
-        
-        u = torch.fft.irfft2(torch.view_as_complex(xi), s=(self.s1, self.s2))
+        u = torch.fft.irfft2(coeff, s=(self.s1, self.s2), out=out)
 
         if self.mean is not None:
             u += self.mean
-        
-        return u
\ No newline at end of file
+
+        return u
+
+    def sample_into(self, out, batchsize=None):
+        '''
+        Fill the preallocated tensor out of shape (N, s1, s2) with N samples, batchsize samples at a time.
+        '''
+        N = out.shape[0]
+        if batchsize is None:
+            batchsize = N
+        for i in range(0, N, batchsize):
+            self.sample(min(batchsize, N - i), out=out[i:i + batchsize])
+        return out
@@ -1,6 +1,6 @@
 import math
 
-from rfsampler import GaussianRF
+from solver.random_fields import GaussianRF
 import torch
 from timeit import default_timer
 
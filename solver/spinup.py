@@ -0,0 +1,103 @@
+import os
+import json
+import math
+import hashlib
+
+import torch
+
+from solver.random_fields import GaussianRF, GaussianRF2d
+from solver.kolmogorov_flow import KolmogorovFlow2d
+
+
+class SpinupCache(object):
+    '''
+    File cache of spun-up vorticity fields.
+    Each entry is keyed by the parameters that determine the state, e.g.
+    (solver, Re, resolution, forcing, GRF parameters, seed, warmup time).
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(params):
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    def path(self, params):
+        return os.path.join(self.cache_dir, f'spinup-{self.key(params)}.pt')
+
+    def load(self, params, device=None):
+        path = self.path(params)
+        if not os.path.exists(path):
+            return None
+        state = torch.load(path, map_location=device)
+        if state['params'] != params:
+            raise ValueError(f'Hash collision in {path}: {state["params"]} != {params}')
+        return state['w']
+
+    def save(self, params, w):
+        path = self.path(params)
+        tmp_path = path + '.tmp'
+        torch.save({'params': params, 'w': w.detach().cpu()}, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def get(self, params, spinup_fn, device=None):
+        '''
+        Load the state of params from the cache; compute it with spinup_fn() and store it on a miss.
+        '''
+        w = self.load(params, device=device)
+        if w is None:
+            print(f'Spin-up cache miss, computing {params}')
+            w = spinup_fn()
+            self.save(params, w)
+        else:
+            print(f'Spin-up state loaded from {self.path(params)}')
+        return w
+
+
+def branch(w, num, eps=1e-3, sampler=None, seed=None):
+    '''
+    Branch num trajectories from one warm state with small smooth perturbations
+    Args:
+        w: vorticity of shape (S, S) or (1, S, S)
+        num: number of branches
+        eps: perturbation amplitude relative to the RMS of w
+        sampler: random field sampler with .sample(N), default GaussianRF2d on [0, 2pi]^2
+        seed: seed of the perturbations
+    Returns:
+        tensor of shape (num, S, S)
+    '''
+    w = w.reshape(1, w.shape[-2], w.shape[-1])
+    if sampler is None:
+        sampler = GaussianRF2d(w.shape[-2], w.shape[-1], alpha=2.5, tau=7.0, device=w.device, dtype=w.dtype)
+    if seed is not None:
+        torch.manual_seed(seed)
+    noise = sampler.sample(num).to(w.dtype)
+    noise = noise / torch.sqrt(torch.mean(noise ** 2, dim=[1, 2], keepdim=True))
+    scale = torch.sqrt(torch.mean(w ** 2))
+    return w + eps * scale * noise
+
+
+def kolmogorov_spinup(Re, s, n=4, T_in=100.0, seed=0, delta_t=1e-3, cache_dir=None, device=None):
+    '''
+    Spun-up vorticity of KolmogorovFlow2d started from a GRF sample, cached in cache_dir if given
+    Returns:
+        tensor of shape (1, s, s)
+    '''
+    params = {'solver': 'KolmogorovFlow2d', 'Re': float(Re), 'res': s, 'forcing': n,
+              'grf': {'alpha': 2.5, 'tau': 7.0, 'length': 2 * math.pi},
+              'seed': seed, 'T_in': float(T_in), 'delta_t': delta_t}
+
+    def spinup():
+        torch.manual_seed(seed)
+        GRF = GaussianRF(2, s, 2 * math.pi, alpha=2.5, tau=7, device=device)
+        u0 = GRF.sample(1)
+        NS = KolmogorovFlow2d(u0, Re, n)
+        NS.advance(T_in, delta_t=delta_t)
+        return NS.vorticity()
+
+    if cache_dir is None:
+        return spinup()
+    return SpinupCache(cache_dir).get(params, spinup, device=device)
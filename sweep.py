@@ -0,0 +1,251 @@
+'''
+Run a list of training configs concurrently, e.g.
+python3 sweep.py --script train_PINO3d.py --configs 'configs/transfer/*.yaml' --devices 0 1 2 3 --extra='--start 9'
+
+Every data file referred to by the configs is decoded once into shared memory (float32 .npy),
+the jobs read it through np.load(mmap_mode='r') so they share the pages instead of each loading the raw file.
+The jobs are packed onto the devices, each with its own thread limit and log file.
+The final metrics of each job (see train_utils.utils.write_sweep_result) are collected into one table.
+'''
+import os
+import csv
+import glob
+import json
+import queue
+import shlex
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+import yaml
+import numpy as np
+
+# config entries holding data files, as (section, key)
+DATA_KEYS = [('data', 'datapath'), ('data', 'datapath2'), ('data', 'paths'),
+             ('data', 'path'), ('test', 'path'), ('test', 'paths')]
+
+
+def expand_configs(patterns):
+    config_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f'No config matches {pattern}')
+        for path in matches:
+            if path not in config_files:
+                config_files.append(path)
+    return config_files
+
+
+def get_config_flag(script):
+    '''
+    Scripts take the config either by --config_path (train_PINO3d.py, train_operator.py, ...) or by --config
+    '''
+    with open(script, 'r') as f:
+        source = f.read()
+    return '--config_path' if "'--config_path'" in source else '--config'
+
+
+def data_files(config):
+    '''
+    Yield (section, key, index, path) of the data files of a config, index is None for a single path
+    '''
+    for section, key in DATA_KEYS:
+        if section not in config or key not in config[section]:
+            continue
+        value = config[section][key]
+        if isinstance(value, str):
+            yield section, key, None, value
+        elif isinstance(value, (list, tuple)):
+            for i, path in enumerate(value):
+                yield section, key, i, path
+
+
+def stage_file(path, shm_dir, chunk=16):
+    '''
+    Decode a .npy file into float32 in shared memory, the trainers cast the data to float32 anyway
+    Args:
+        path: source file
+        shm_dir: directory in shared memory
+        chunk: number of samples copied at a time
+    Returns:
+        path of the staged file
+    '''
+    digest = hashlib.md5(os.path.abspath(path).encode()).hexdigest()[:8]
+    name = os.path.splitext(os.path.basename(path))[0]
+    staged_path = os.path.join(shm_dir, f'{name}-{digest}.npy')
+    if os.path.exists(staged_path):
+        return staged_path
+    raw_data = np.load(path, mmap_mode='r')
+    dtype = np.float32 if np.issubdtype(raw_data.dtype, np.floating) else raw_data.dtype
+    tmp_path = staged_path + '.tmp.npy'
+    staged = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=raw_data.shape)
+    if raw_data.ndim == 0:
+        staged[...] = raw_data
+    else:
+        for i in range(0, raw_data.shape[0], chunk):
+            staged[i:i + chunk] = raw_data[i:i + chunk]
+    staged.flush()
+    del staged
+    os.replace(tmp_path, staged_path)
+    return staged_path
+
+
+def stage_data(configs, shm_dir):
+    '''
+    Stage every .npy file of the configs once and point the configs to the staged copies
+    Args:
+        configs: dict of config name to config dict, modified in place
+        shm_dir: directory in shared memory
+    Returns:
+        dict of source path to staged path
+    '''
+    staged = {}
+    for config in configs.values():
+        for section, key, i, path in data_files(config):
+            if not path.endswith('.npy') or not os.path.exists(path):
+                # .mat files and missing files are left to the job
+                continue
+            if path not in staged:
+                t1 = default_timer()
+                staged[path] = stage_file(path, shm_dir)
+                print(f'Staged {path} -> {staged[path]} in {default_timer() - t1:.1f}s')
+            if i is None:
+                config[section][key] = staged[path]
+            else:
+                config[section][key][i] = staged[path]
+    return staged
+
+
+def job_name(config_file):
+    name = os.path.splitext(os.path.normpath(config_file))[0]
+    return name.replace(os.sep, '_')
+
+
+def run_job(name, config_path, slots, args, sweep_dir):
+    '''
+    Run one config on a free slot and return its row of the result table
+    '''
+    device = slots.get()
+    try:
+        result_path = os.path.join(sweep_dir, 'results', f'{name}.json')
+        log_path = os.path.join(sweep_dir, 'logs', f'{name}.log')
+        env = os.environ.copy()
+        env['PINO_SWEEP_RESULT'] = result_path
+        env['OMP_NUM_THREADS'] = str(args.threads)
+        env['MKL_NUM_THREADS'] = str(args.threads)
+        env['CUDA_VISIBLE_DEVICES'] = '' if device == 'cpu' else device
+        cmd = [args.python, args.script, args.config_flag, config_path] + shlex.split(args.extra)
+        print(f'[{device}] {" ".join(cmd)}')
+        t1 = default_timer()
+        with open(log_path, 'w') as log_file:
+            returncode = subprocess.call(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        t2 = default_timer()
+        print(f'[{device}] {name} finished with code {returncode} in {t2 - t1:.1f}s, log: {log_path}')
+    finally:
+        slots.put(device)
+
+    row = {'config': name, 'device': device, 'returncode': returncode, 'time': round(t2 - t1, 1)}
+    if os.path.exists(result_path):
+        with open(result_path, 'r') as f:
+            row.update(json.load(f))
+    return row
+
+
+def write_table(rows, out_path):
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    # print the table
+    cells = [[str(row.get(key, '')) for key in columns] for row in rows]
+    widths = [max([len(key)] + [len(line[j]) for line in cells]) for j, key in enumerate(columns)]
+    print(' | '.join(key.ljust(w) for key, w in zip(columns, widths)))
+    for line in cells:
+        print(' | '.join(cell.ljust(w) for cell, w in zip(line, widths)))
+    print(f'Results are saved to {out_path}')
+
+
+def main(args):
+    config_files = expand_configs(args.configs)
+    if args.config_flag is None:
+        args.config_flag = get_config_flag(args.script)
+    # each device runs jobs_per_device jobs at a time
+    slots = queue.Queue()
+    for _ in range(args.jobs_per_device):
+        for device in args.devices:
+            slots.put(device)
+    num_workers = len(args.devices) * args.jobs_per_device
+    if args.threads is None:
+        args.threads = max(1, multiprocessing.cpu_count() // num_workers)
+
+    sweep_dir = args.sweep_dir
+    for sub_dir in ['configs', 'logs', 'results']:
+        os.makedirs(os.path.join(sweep_dir, sub_dir), exist_ok=True)
+    configs = {}
+    for config_file in config_files:
+        with open(config_file, 'r') as f:
+            configs[job_name(config_file)] = yaml.load(f, yaml.FullLoader)
+
+    # decode the shared data once
+    os.makedirs(args.shm_dir, exist_ok=True)
+    staged = stage_data(configs, args.shm_dir)
+    config_paths = {}
+    for name, config in configs.items():
+        config_paths[name] = os.path.join(sweep_dir, 'configs', f'{name}.yaml')
+        with open(config_paths[name], 'w') as f:
+            yaml.dump(config, f, sort_keys=False)
+        # drop the result of an earlier sweep
+        result_path = os.path.join(sweep_dir, 'results', f'{name}.json')
+        if os.path.exists(result_path):
+            os.remove(result_path)
+
+    print(f'Running {len(configs)} jobs, {num_workers} at a time with {args.threads} threads each')
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_job, name, config_paths[name], slots, args, sweep_dir)
+                       for name in configs]
+            rows = [future.result() for future in futures]
+    finally:
+        if not args.keep_shm:
+            for staged_path in staged.values():
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+    out_path = args.out if args.out else os.path.join(sweep_dir, 'results.csv')
+    write_table(rows, out_path)
+    num_failed = sum(row['returncode'] != 0 for row in rows)
+    if num_failed > 0:
+        print(f'{num_failed} of {len(rows)} jobs failed')
+
+
+if __name__ == '__main__':
+    default_shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    parser = ArgumentParser(description='Basic paser')
+    parser.add_argument('--script', type=str, default='train_PINO3d.py', help='Training script to run')
+    parser.add_argument('--configs', type=str, nargs='+', help='Config files or glob patterns')
+    parser.add_argument('--config_flag', type=str, default=None,
+                        help='Option of the script taking the config, detected from the script by default')
+    parser.add_argument('--devices', type=str, nargs='+', default=['cpu'],
+                        help='GPU ids to run the jobs on, or cpu')
+    parser.add_argument('--jobs_per_device', type=int, default=1, help='Number of concurrent jobs on each device')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of threads of each job, the cores are split between the jobs by default')
+    parser.add_argument('--extra', type=str, default='', help='Extra arguments passed to the script')
+    parser.add_argument('--sweep_dir', type=str, default='exp/sweep', help='Directory of the configs, logs and results')
+    parser.add_argument('--shm_dir', type=str, default=os.path.join(default_shm, 'pino-sweep'),
+                        help='Directory in shared memory for the decoded data')
+    parser.add_argument('--keep_shm', action='store_true', help='Keep the decoded data after the sweep')
+    parser.add_argument('--python', type=str, default='python3')
+    parser.add_argument('--out', type=str, default=None, help='Path of the result table, sweep_dir/results.csv by default')
+    args = parser.parse_args()
+    main(args)
@@ -1,3 +1,4 @@
+import os
 import yaml
 from argparse import ArgumentParser
 import random
@@ -11,7 +12,7 @@ from train_utils.datasets import NSLoader
 from train_utils.data_utils import data_sampler
 from train_utils.losses import get_forcing
 from train_utils.train_3d import train
-from train_utils.distributed import setup, cleanup
+from train_utils.distributed import setup, cleanup, find_free_port
 from train_utils.utils import requires_grad
 
 from models import FNO3d, FNO2d
@@ -63,10 +64,11 @@ def subprocess_fn(rank, args):
         model.load_state_dict(ckpt['model'])
         print('Weights loaded from %s' % ckpt_path)
 
-    if args.distributed:
-        model = DDP(model, device_ids=[rank], broadcast_buffers=False)
-
-    if 'twolayer' in config['train'] and config['train']['twolayer']:
+    if 'adapter_rank' in config['train']:
+        # train low-rank adapters of the spectral weights only
+        model.add_adapters(config['train']['adapter_rank'])
+        params = [param for param in model.parameters() if param.requires_grad]
+    elif 'twolayer' in config['train'] and config['train']['twolayer']:
         requires_grad(model, False)
         requires_grad(model.sp_convs[-1], True)
         requires_grad(model.ws[-1], True)
@@ -79,6 +81,9 @@ def subprocess_fn(rank, args):
     else:
         params = model.parameters()
 
+    if args.distributed:
+        model = DDP(model, device_ids=[rank], broadcast_buffers=False)
+
     optimizer = Adam(params, betas=(0.9, 0.999),
                      lr=config['train']['base_lr'])
     scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
@@ -114,6 +119,7 @@ if __name__ == '__main__':
     args.distributed = args.num_gpus > 1
 
     if args.distributed:
+        os.environ.setdefault('MASTER_PORT', str(find_free_port()))
         mp.spawn(subprocess_fn, args=(args, ), nprocs=args.num_gpus)
     else:
         subprocess_fn(0, args)
@@ -13,8 +13,12 @@ from torch.utils.data import DataLoader
 from models import FNO2d
 
 from train_utils.losses import LpLoss, darcy_loss 
-from train_utils.datasets import DarcyFlow, DarcyIC, sample_data
-from train_utils.utils import save_ckpt, count_params, dict2str
+from train_utils.datasets import DarcyFlow, DarcyIC, ResumableIterator
+from train_utils.utils import count_params, dict2str, batched_forward
+from train_utils.metrics import MetricAccumulator, ConvergenceMonitor
+from train_utils.checkpoint import CheckpointWriter, load_state
+from train_utils.data_utils import data_sampler
+from train_utils.distributed import launch, wrap_ddp, get_device, get_rank, get_world_size
 
 try:
     import wandb
@@ -39,8 +43,9 @@ def eval_darcy(model, val_loader, criterion,
         out = model(a).squeeze(dim=-1)
         out = out * mollifier
         val_loss = criterion(out, u)
-        val_err.append(val_loss.item())
+        val_err.append(val_loss.detach())
     N = len(val_loader)
+    val_err = torch.stack(val_err).cpu().numpy()
 
     avg_err = np.mean(val_err)
     std_err = np.std(val_err, ddof=1) / np.sqrt(N)
@@ -53,17 +58,25 @@ def train(model,
           val_loader,            # validation data
           optimizer, 
           scheduler,
-          device, config, args):
+          device, config, args, 
+          ckpt=None):            # checkpoint to resume from
     save_step = config['train']['save_step']
     eval_step = config['train']['eval_step']
+    log_step = config['train']['log_step'] if 'log_step' in config['train'] else 100
 
     f_weight = config['train']['f_loss']
     xy_weight = config['train']['xy_loss']
+    # run data and PDE batches in one forward when their shapes match
+    joint_batch = config['train']['joint_batch'] if 'joint_batch' in config['train'] else True
+    # stop once the training has converged, set by the early_stop section of train
+    monitor = ConvergenceMonitor.from_config(config)
 
     # set up directory
     base_dir = os.path.join('exp', config['log']['logdir'])
     ckpt_dir = os.path.join(base_dir, 'ckpts')
     os.makedirs(ckpt_dir, exist_ok=True)
+    keep_ckpts = config['train']['keep_ckpts'] if 'keep_ckpts' in config['train'] else None
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_ckpts) if get_rank() == 0 else None
 
     # loss fn
     lploss = LpLoss(size_average=True)
@@ -77,21 +90,39 @@ def train(model,
                          group=config['log']['group'], 
                          config=config, reinit=True, 
                          settings=wandb.Settings(start_method='fork'))
-    pbar = range(config['train']['num_iter'])
-    pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
+    u_loader = ResumableIterator(train_u_loader)
+    ic_loader = ResumableIterator(ic_loader)
+    loaders = {'u_loader': u_loader, 'ic_loader': ic_loader}
+    if ckpt is not None:
+        start_iter = load_state(ckpt, optimizer, scheduler, 
+                                loaders=loaders, 
+                                restore_rng=get_world_size() == 1)
+    else:
+        start_iter = 0
 
-    u_loader = sample_data(train_u_loader)
-    ic_loader = sample_data(ic_loader)
-    for e in pbar:
-        log_dict = {}
+    num_iter = config['train']['num_iter']
+    if monitor is not None:
+        num_iter = monitor.num_iter(num_iter)
+    pbar = range(start_iter, num_iter)
+    if get_rank() == 0:
+        pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
 
+    meter = MetricAccumulator(device)
+    for e in pbar:
         optimizer.zero_grad()
-        # data loss
+        inputs = []
         if xy_weight > 0:
-            ic, u = next(u_loader)
+            data_ic, u = next(u_loader)
             u = u.to(device)
+            inputs.append(data_ic.to(device))
+        if f_weight > 0:
+            ic = next(ic_loader)
             ic = ic.to(device)
-            out = model(ic).squeeze(dim=-1)
+            inputs.append(ic)
+        outs = batched_forward(model, inputs, concat=joint_batch)
+        # data loss
+        if xy_weight > 0:
+            out = outs.pop(0).squeeze(dim=-1)
             out = out * u_mol
             data_loss = lploss(out, u)
         else:
@@ -99,13 +130,11 @@ def train(model,
         
         if f_weight > 0:
             # pde loss
-            ic = next(ic_loader)
-            ic = ic.to(device)
-            out = model(ic).squeeze(dim=-1)
+            out = outs.pop(0).squeeze(dim=-1)
             out = out * ic_mol
             u0 = ic[..., 0]
             f_loss = darcy_loss(out, u0)
-            log_dict['PDE'] = f_loss.item()
+            meter.update({'PDE': f_loss})
         else:
             f_loss = 0.0
         loss = data_loss * xy_weight + f_loss * f_weight
@@ -114,32 +143,49 @@ def train(model,
         optimizer.step()
         scheduler.step()
 
-        log_dict['train loss'] = loss.item()
-        log_dict['data'] = data_loss.item()
-        if e % eval_step == 0:
-            eval_err, std_err = eval_darcy(model, val_loader, lploss, device)
-            log_dict['val error'] = eval_err
-        logstr = dict2str(log_dict)
-        pbar.set_description(
-            (
-                logstr
-            )
-        )
-        if wandb and args.log:
-            wandb.log(log_dict)
-        if e % save_step == 0 and e > 0:
-            ckpt_path = os.path.join(ckpt_dir, f'model-{e}.pt')
-            save_ckpt(ckpt_path, model, optimizer, scheduler)
+        meter.update({'train loss': loss, 'data': data_loss})
+        stop = False
+        if e % log_step == 0 or e % eval_step == 0:
+            log_dict = meter.compute()
+            meter.reset()
+            if e % eval_step == 0 and get_rank() == 0:
+                eval_err, std_err = eval_darcy(model, val_loader, lploss, device)
+                log_dict['val error'] = eval_err
+            if get_rank() == 0:
+                logstr = dict2str(log_dict)
+                pbar.set_description(
+                    (
+                        logstr
+                    )
+                )
+            if monitor is not None:
+                stop = monitor.step(e, log_dict)
+                if stop:
+                    log_dict['stop iter'] = e
+            if wandb and args.log:
+                wandb.log(log_dict, step=e)
+        if (e % save_step == 0 and e > 0 or stop) and writer is not None:
+            data_state = {key: loader.state_dict() for key, loader in loaders.items()}
+            writer.save(e, model, optimizer, scheduler, data_state=data_state)
+        if stop:
+            break
 
+    if writer is not None:
+        writer.close()
+    if monitor is not None and monitor.stop_iter is not None and wandb and args.log:
+        run.summary['stop iter'] = monitor.stop_iter
     # clean up wandb
     if wandb and args.log:
         run.finish()
 
 
-def subprocess(args):
+def subprocess(rank, args):
     with open(args.config, 'r') as f:
         config = yaml.load(f, yaml.FullLoader)
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    device = get_device(rank)
+    world_size = get_world_size()
+    # only the first process logs
+    args.log = args.log and rank == 0
 
     # set random seed
     config['seed'] = args.seed
@@ -160,6 +206,7 @@ def subprocess(args):
     config['num_params'] = num_params
     print(f'Number of parameters: {num_params}')
     # Load from checkpoint
+    ckpt = None
     if args.ckpt:
         ckpt_path = args.ckpt
         ckpt = torch.load(ckpt_path)
@@ -178,20 +225,23 @@ def subprocess(args):
         test_err, std_err = eval_darcy(model, testloader, criterion, device)
         print(f'Averaged test relative L2 error: {test_err}; Standard error: {std_err}')
     else:
-        # training set
-        batchsize = config['train']['batchsize']
+        # training set, the batch is split across the processes
+        batchsize = config['train']['batchsize'] // world_size
+        distributed = world_size > 1
         u_set = DarcyFlow(datapath=config['data']['path'], 
                           nx=config['data']['nx'], 
                           sub=config['data']['sub'], 
                           offset=config['data']['offset'], 
                           num=config['data']['n_sample'])
-        u_loader = DataLoader(u_set, batch_size=batchsize, num_workers=4, shuffle=True)
+        u_loader = DataLoader(u_set, batch_size=batchsize, num_workers=4, 
+                              sampler=data_sampler(u_set, shuffle=True, distributed=distributed))
         ic_set = DarcyIC(datapath=config['data']['path'], 
                          nx=config['data']['nx'], 
                          sub=config['data']['pde_sub'], 
                          offset=config['data']['offset'], 
                          num=config['data']['n_sample'])
-        ic_loader = DataLoader(ic_set, batch_size=batchsize, num_workers=4, shuffle=True)
+        ic_loader = DataLoader(ic_set, batch_size=batchsize, num_workers=4, 
+                               sampler=data_sampler(ic_set, shuffle=True, distributed=distributed))
         # val set
         valset = DarcyFlow(datapath=config['test']['path'], 
                            nx=config['test']['nx'], 
@@ -200,21 +250,20 @@ def subprocess(args):
                            num=config['test']['n_sample'])
         val_loader = DataLoader(valset, batch_size=batchsize, num_workers=4)
         print(f'Train set: {len(u_set)}; test set: {len(valset)}.')
+        bucket_cap_mb = config['train']['bucket_cap_mb'] if 'bucket_cap_mb' in config['train'] else 25
+        model = wrap_ddp(model, device, bucket_cap_mb=bucket_cap_mb)
         optimizer = Adam(model.parameters(), lr=config['train']['base_lr'])
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, 
                                                          milestones=config['train']['milestones'], 
                                                          gamma=config['train']['scheduler_gamma'])
-        if args.ckpt:
-            ckpt = torch.load(ckpt_path)
-            optimizer.load_state_dict(ckpt['optim'])
-            scheduler.load_state_dict(ckpt['scheduler'])
         train(model, 
               u_loader,
               ic_loader, 
               val_loader, 
               optimizer, scheduler, 
               device, 
-              config, args)
+              config, args, 
+              ckpt=ckpt)
               
     print('Done!')
         
@@ -229,7 +278,8 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type=int, default=None)
     parser.add_argument('--ckpt', type=str, default=None)
     parser.add_argument('--test', action='store_true', help='Test')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of data-parallel processes')
     args = parser.parse_args()
     if args.seed is None:
         args.seed = random.randint(0, 100000)
-    subprocess(args)
\ No newline at end of file
+    launch(subprocess, args.num_procs, args=(args, ))
\ No newline at end of file
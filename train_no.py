@@ -15,7 +15,11 @@ from train_utils.adam import Adam
 
 from train_utils.losses import LpLoss, PINO_loss3d, get_forcing
 from train_utils.datasets import NS3DDataset, KFDataset
-from train_utils.utils import save_ckpt, count_params
+from train_utils.utils import count_params, micro_batches, grad_sync
+from train_utils.metrics import MetricAccumulator
+from train_utils.checkpoint import CheckpointWriter, load_state
+from train_utils.data_utils import data_sampler
+from train_utils.distributed import launch, wrap_ddp, get_device, get_rank, get_world_size
 
 try:
     import wandb
@@ -36,7 +40,8 @@ def train_ns(model,
              val_loader,
              optimizer, 
              scheduler,
-             device, config, args):
+             device, config, args, 
+             ckpt=None):            # checkpoint to resume from
     # parse configuration
     v = 1/ config['data']['Re']
     t_duration = config['data']['t_duration']
@@ -45,10 +50,14 @@ def train_ns(model,
     ic_weight = config['train']['ic_loss']
     f_weight = config['train']['f_loss']
     xy_weight = config['train']['xy_loss']
+    # split the batches into micro-batches and accumulate the gradients
+    micro_bs = config['train']['micro_batchsize'] if 'micro_batchsize' in config['train'] else None
     # set up directory
     base_dir = os.path.join('exp', config['log']['logdir'])
     ckpt_dir = os.path.join(base_dir, 'ckpts')
     os.makedirs(ckpt_dir, exist_ok=True)
+    keep_ckpts = config['train']['keep_ckpts'] if 'keep_ckpts' in config['train'] else None
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_ckpts) if get_rank() == 0 else None
 
     # loss fn
     lploss = LpLoss(size_average=True)
@@ -63,58 +72,65 @@ def train_ns(model,
                          group=config['log']['group'], 
                          config=config, reinit=True, 
                          settings=wandb.Settings(start_method='fork'))
-    pbar = range(config['train']['epochs'])
-    pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
+    # the checkpoints are saved at the end of an epoch, so the epoch and the random state locate the data
+    if ckpt is not None:
+        start_epoch = load_state(ckpt, optimizer, scheduler, 
+                                 restore_rng=get_world_size() == 1)
+    else:
+        start_epoch = 0
+    pbar = range(start_epoch, config['train']['epochs'])
+    if get_rank() == 0:
+        pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
     zero = torch.zeros(1).to(device)
+    meter = MetricAccumulator(device)
+    val_meter = MetricAccumulator(device)
     for e in pbar:
-        loss_dict = {
-            'train_loss': 0.0, 
-            'ic_loss': 0.0, 
-            'pde_loss': 0.0
-        }
+        meter.reset()
 
         # train 
         model.train()
-        for u, a in train_loader:
-            u, a = u.to(device), a.to(device)
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(e)
+        for batch in train_loader:
             optimizer.zero_grad()
-
-            if ic_weight == 0.0 and f_weight == 0.0:
-                # FNO
-                a_in = a[:, ::data_s_step, ::data_s_step, ::data_t_step]
-                out = model(a_in)
-                loss_ic, loss_f = zero, zero
-                loss = lploss(out, u)
-            else:
-                # PINO
-                a_in = a
-                out = model(a_in)
-                # PDE loss
-                u0 = a[:, :, :, 0, -1]
-                loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
-                # data loss
-                # print(out.shape)
-                # print(u.shape)
-                data_loss = lploss(out[:, ::data_s_step, ::data_s_step, ::data_t_step], u)
-                loss = data_loss * xy_weight + loss_f * f_weight + loss_ic * ic_weight
-            
-            loss.backward()
+            batch_size = batch[0].shape[0]
+            mbs = micro_batches(batch, micro_bs)
+            # the losses are batch means, each micro-batch is weighted by its share of the batch
+            for i, (u, a) in enumerate(mbs):
+                u, a = u.to(device), a.to(device)
+                scale = u.shape[0] / batch_size
+                with grad_sync(model, sync=i == len(mbs) - 1):
+                    if ic_weight == 0.0 and f_weight == 0.0:
+                        # FNO
+                        a_in = a[:, ::data_s_step, ::data_s_step, ::data_t_step]
+                        out = model(a_in)
+                        loss_ic, loss_f = zero, zero
+                        loss = lploss(out, u)
+                    else:
+                        # PINO
+                        a_in = a
+                        out = model(a_in)
+                        # PDE loss
+                        u0 = a[:, :, :, 0, -1]
+                        loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
+                        # data loss
+                        data_loss = lploss(out[:, ::data_s_step, ::data_s_step, ::data_t_step], u)
+                        loss = data_loss * xy_weight + loss_f * f_weight + loss_ic * ic_weight
+
+                    (loss * scale).backward()
+                meter.update({'train_loss': loss, 'ic_loss': loss_ic, 'pde_loss': loss_f}, n=scale)
             optimizer.step()
-
-            loss_dict['train_loss'] += loss.item()
-            loss_dict['ic_loss'] += loss_ic.item()
-            loss_dict['pde_loss'] += loss_f.item()
         scheduler.step()
-        
-        loader_size = len(train_loader)
-        train_loss = loss_dict['train_loss'] / loader_size
-        ic_loss = loss_dict['ic_loss'] / loader_size
-        pde_loss = loss_dict['pde_loss'] / loader_size
+
+        loss_avg = meter.compute()
+        train_loss = loss_avg['train_loss']
+        ic_loss = loss_avg['ic_loss']
+        pde_loss = loss_avg['pde_loss']
 
         # eval
         model.eval()
         with torch.no_grad():
-            val_error = 0.0
+            val_meter.reset()
             for u, a in val_loader:
                 u, a = u.to(device), a.to(device)
 
@@ -130,14 +146,15 @@ def train_ns(model,
                     out = model(a_in)
                     # data loss
                     data_loss = lploss(out[:, ::data_s_step, ::data_s_step, ::data_t_step], u)
-                val_error += data_loss.item()
-            avg_val_error = val_error / len(val_loader)
-
-        pbar.set_description(
-            (
-                f'Train loss: {train_loss}. IC loss: {ic_loss}, PDE loss: {pde_loss}, val error: {avg_val_error}'
+                val_meter.update({'val_error': data_loss})
+            avg_val_error = val_meter.compute()['val_error']
+
+        if get_rank() == 0:
+            pbar.set_description(
+                (
+                    f'Train loss: {train_loss}. IC loss: {ic_loss}, PDE loss: {pde_loss}, val error: {avg_val_error}'
+                )
             )
-        )
         log_dict = {
             'Train loss': train_loss, 
             'IC loss': ic_loss, 
@@ -147,9 +164,10 @@ def train_ns(model,
 
         if wandb and args.log:
             wandb.log(log_dict)
-        if e % save_step == 0:
-            ckpt_path = os.path.join(ckpt_dir, f'model-{e}.pt')
-            save_ckpt(ckpt_path, model, optimizer)
+        if e % save_step == 0 and writer is not None:
+            writer.save(e, model, optimizer, scheduler)
+    if writer is not None:
+        writer.close()
     # clean up wandb
     if wandb and args.log:
         run.finish()
@@ -168,8 +186,8 @@ def eval_ns(model, val_loader, device, config, args):
     data_s_step = val_loader.dataset.data_s_step
     data_t_step = val_loader.dataset.data_t_step
 
+    meter = MetricAccumulator(device)
     with torch.no_grad():
-        val_error = 0.0
         for u, a in tqdm(val_loader):
             u, a = u.to(device), a.to(device)
             # a = a[:, ::data_s_step, ::data_s_step, ::data_t_step]
@@ -177,16 +195,19 @@ def eval_ns(model, val_loader, device, config, args):
             out = model(a_in)
             out = out[:, ::data_s_step, ::data_s_step, ::data_t_step]
             data_loss = lploss(out, u)
-            val_error += data_loss.item()
-        avg_val_err = val_error / len(val_loader)
+            meter.update({'val_error': data_loss})
+        avg_val_err = meter.compute()['val_error']
 
     print(f'Average relative L2 error {avg_val_err}')
 
 
-def subprocess(args):
+def subprocess(rank, args):
     with open(args.config, 'r') as f:
         config = yaml.load(f, yaml.FullLoader)
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    device = get_device(rank)
+    world_size = get_world_size()
+    # only the first process logs
+    args.log = args.log and rank == 0
 
     # set random seed
     config['seed'] = args.seed
@@ -208,6 +229,7 @@ def subprocess(args):
     config['num_params'] = num_params
     print(f'Number of parameters: {num_params}')
     # Load from checkpoint
+    ckpt = None
     if args.ckpt:
         ckpt_path = args.ckpt
         ckpt = torch.load(ckpt_path)
@@ -236,8 +258,9 @@ def subprocess(args):
         eval_ns(model, test_loader, device, config, args)
 
     else:
-        # prepare datast
-        batchsize = config['train']['batchsize']
+        # prepare datast, the batch is split across the processes
+        batchsize = config['train']['batchsize'] // world_size
+        distributed = world_size > 1
 
         dataset = datasets[dataname](paths=config['data']['paths'], 
                                      raw_res=config['data']['raw_res'],
@@ -257,16 +280,21 @@ def subprocess(args):
         trainset = Subset(dataset, indices=train_idx)
         valset = Subset(dataset, indices=test_idx)
 
-        train_loader = DataLoader(trainset, batch_size=batchsize, num_workers=4, shuffle=True)
+        train_loader = DataLoader(trainset, batch_size=batchsize, num_workers=4, 
+                                  sampler=data_sampler(trainset, shuffle=True, distributed=distributed))
 
-        val_loader = DataLoader(valset, batch_size=batchsize, num_workers=4)
+        val_loader = DataLoader(valset, batch_size=batchsize, num_workers=4, 
+                                sampler=data_sampler(valset, shuffle=False, distributed=distributed))
+        bucket_cap_mb = config['train']['bucket_cap_mb'] if 'bucket_cap_mb' in config['train'] else 25
+        model = wrap_ddp(model, device, bucket_cap_mb=bucket_cap_mb)
         optimizer = Adam(model.parameters(), lr=config['train']['base_lr'])
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, 
                                                          milestones=config['train']['milestones'], 
                                                          gamma=config['train']['scheduler_gamma'])
         print(dataset.data.shape)
         train_ns(model, train_loader, val_loader, 
-                optimizer, scheduler, device, config, args)
+                optimizer, scheduler, device, config, args, 
+                ckpt=ckpt)
     print('Done!')
 
 
@@ -280,7 +308,8 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type=int, default=None)
     parser.add_argument('--ckpt', type=str, default=None)
     parser.add_argument('--test', action='store_true', help='Test')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of data-parallel processes')
     args = parser.parse_args()
     if args.seed is None:
         args.seed = random.randint(0, 100000)
-    subprocess(args)
\ No newline at end of file
+    launch(subprocess, args.num_procs, args=(args, ))
\ No newline at end of file
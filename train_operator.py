@@ -7,13 +7,19 @@ from torch.utils.data import DataLoader
 from solver.random_fields import GaussianRF
 from train_utils import Adam
 from train_utils.datasets import NSLoader, online_loader, DarcyFlow, DarcyCombo
+from train_utils.data_utils import data_sampler
 from train_utils.train_3d import mixed_train
 from train_utils.train_2d import train_2d_operator
+from train_utils.distributed import launch, wrap_ddp, get_device, get_world_size
 from models import FNO3d, FNO2d
 
 
-def train_3d(args, config):
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+def train_3d(rank, args, config):
+    device = get_device(rank)
+    world_size = get_world_size()
+    # different random ICs on each process, the batch is split across the processes
+    torch.manual_seed(torch.initial_seed() + rank)
+    config['train']['batchsize'] = config['train']['batchsize'] // world_size
     data_config = config['data']
 
     # prepare dataloader for training with data
@@ -30,10 +36,14 @@ def train_3d(args, config):
                           N=data_config['total_num'],
                           t_interval=data_config['time_interval'])
 
-    train_loader = loader.make_loader(data_config['n_sample'],
-                                      batch_size=config['train']['batchsize'],
-                                      start=data_config['offset'],
-                                      train=data_config['shuffle'])
+    trainset = loader.make_dataset(data_config['n_sample'],
+                                   start=data_config['offset'],
+                                   train=data_config['shuffle'])
+    train_loader = DataLoader(trainset, batch_size=config['train']['batchsize'],
+                              sampler=data_sampler(trainset,
+                                                   shuffle=data_config['shuffle'],
+                                                   distributed=world_size > 1),
+                              drop_last=True)
     # prepare dataloader for training with only equations
     gr_sampler = GaussianRF(2, data_config['S2'], 2 * math.pi, alpha=2.5, tau=7, device=device)
     a_loader = online_loader(gr_sampler,
@@ -55,6 +65,8 @@ def train_3d(args, config):
         ckpt = torch.load(ckpt_path)
         model.load_state_dict(ckpt['model'])
         print('Weights loaded from %s' % ckpt_path)
+    bucket_cap_mb = config['train']['bucket_cap_mb'] if 'bucket_cap_mb' in config['train'] else 25
+    model = wrap_ddp(model, device, bucket_cap_mb=bucket_cap_mb)
     # create optimizer and learning rate scheduler
     optimizer = Adam(model.parameters(), betas=(0.9, 0.999),
                      lr=config['train']['base_lr'])
@@ -70,13 +82,15 @@ def train_3d(args, config):
                 scheduler,
                 config,
                 device,
-                log=args.log,
+                log=args.log and rank == 0,
                 project=config['log']['project'],
-                group=config['log']['group'])
+                group=config['log']['group'],
+                use_tqdm=rank == 0)
 
 
-def train_2d(args, config):
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+def train_2d(rank, args, config):
+    device = get_device(rank)
+    world_size = get_world_size()
     data_config = config['data']
 
     # dataset = DarcyFlow(data_config['datapath'],
@@ -89,7 +103,8 @@ def train_2d(args, config):
                          pde_sub=data_config['pde_sub'], 
                          num=data_config['n_samples'], 
                          offset=data_config['offset'])
-    train_loader = DataLoader(dataset, batch_size=config['train']['batchsize'], shuffle=True)
+    train_loader = DataLoader(dataset, batch_size=config['train']['batchsize'] // world_size,
+                              sampler=data_sampler(dataset, shuffle=True, distributed=world_size > 1))
     model = FNO2d(modes1=config['model']['modes1'],
                   modes2=config['model']['modes2'],
                   fc_dim=config['model']['fc_dim'],
@@ -102,6 +117,8 @@ def train_2d(args, config):
         ckpt = torch.load(ckpt_path)
         model.load_state_dict(ckpt['model'])
         print('Weights loaded from %s' % ckpt_path)
+    bucket_cap_mb = config['train']['bucket_cap_mb'] if 'bucket_cap_mb' in config['train'] else 25
+    model = wrap_ddp(model, device, bucket_cap_mb=bucket_cap_mb)
 
     optimizer = Adam(model.parameters(), betas=(0.9, 0.999),
                      lr=config['train']['base_lr'])
@@ -111,18 +128,18 @@ def train_2d(args, config):
     train_2d_operator(model,
                       train_loader,
                       optimizer, scheduler,
-                      config, rank=0, log=args.log,
+                      config, rank=device, log=args.log and rank == 0,
                       project=config['log']['project'],
-                      group=config['log']['group'])
+                      group=config['log']['group'],
+                      use_tqdm=rank == 0)
 
 
 if __name__ == '__main__':
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-
     # parse options
     parser = ArgumentParser(description='Basic paser')
     parser.add_argument('--config_path', type=str, help='Path to the configuration file')
     parser.add_argument('--log', action='store_true', help='Turn on the wandb')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of data-parallel processes')
     args = parser.parse_args()
 
     config_file = args.config_path
@@ -130,6 +147,6 @@ if __name__ == '__main__':
         config = yaml.load(stream, yaml.FullLoader)
 
     if 'name' in config['data'] and config['data']['name'] == 'Darcy':
-        train_2d(args, config)
+        launch(train_2d, args.num_procs, args=(args, config))
     else:
-        train_3d(args, config)
+        launch(train_3d, args.num_procs, args=(args, config))
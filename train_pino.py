@@ -4,6 +4,8 @@ import yaml
 import random
 from argparse import ArgumentParser
 import math
+import bisect
+from timeit import default_timer
 from tqdm import tqdm
 
 import numpy as np
@@ -15,8 +17,12 @@ from torch.utils.data import DataLoader
 from models import FNO3d
 
 from train_utils.losses import LpLoss, PINO_loss3d, get_forcing
-from train_utils.datasets import KFDataset, KFaDataset, sample_data
-from train_utils.utils import save_ckpt, count_params, dict2str
+from train_utils.datasets import KFDataset, KFaDataset, ResumableIterator
+from train_utils.utils import count_params, dict2str, batched_forward, micro_batches, grad_sync, write_sweep_result
+from train_utils.checkpoint import CheckpointWriter, load_state
+from train_utils.metrics import MetricAccumulator, ConvergenceMonitor
+from train_utils.data_utils import data_sampler
+from train_utils.distributed import launch, wrap_ddp, get_device, get_rank, get_world_size
 
 try:
     import wandb
@@ -32,41 +38,64 @@ def eval_ns(model, val_loader, criterion, device):
         u, a = u.to(device), a.to(device)
         out = model(a)
         val_loss = criterion(out, u)
-        val_err.append(val_loss.item())
+        val_err.append(val_loss.detach())
 
     N = len(val_loader)
-
+    val_err = torch.stack(val_err).cpu().numpy()
     avg_err = np.mean(val_err)
     std_err = np.std(val_err, ddof=1) / np.sqrt(N)
     return avg_err, std_err
 
 
 def train_ns(model, 
-             train_u_loader,        # training data
-             train_a_loader,        # initial conditions
+             train_u_loader,        # training data, list of loaders for a curriculum
+             train_a_loader,        # initial conditions, list of loaders for a curriculum
              val_loader,            # validation data
              optimizer, 
              scheduler,
-             device, config, args):
-    start_iter = config['train']['start_iter']
+             device, config, args, 
+             ckpt=None):            # checkpoint to resume from
     v = 1/ config['data']['Re']
     t_duration = config['data']['t_duration']
     save_step = config['train']['save_step']
     eval_step = config['train']['eval_step']
+    log_step = config['train']['log_step'] if 'log_step' in config['train'] else 100
 
     ic_weight = config['train']['ic_loss']
     f_weight = config['train']['f_loss']
     xy_weight = config['train']['xy_loss']
+    # run data and PDE batches in one forward when their shapes match
+    joint_batch = config['train']['joint_batch'] if 'joint_batch' in config['train'] else True
+    # split the batches into micro-batches and accumulate the gradients
+    micro_bs = config['train']['micro_batchsize'] if 'micro_batchsize' in config['train'] else None
+    pde_micro_bs = config['train']['pde_micro_batchsize'] if 'pde_micro_batchsize' in config['train'] else micro_bs
     # set up directory
     base_dir = os.path.join('exp', config['log']['logdir'])
     ckpt_dir = os.path.join(base_dir, 'ckpts')
     os.makedirs(ckpt_dir, exist_ok=True)
+    keep_ckpts = config['train']['keep_ckpts'] if 'keep_ckpts' in config['train'] else None
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_ckpts) if get_rank() == 0 else None
+
+    # report the training time to reach the target validation error
+    target_error = config['train']['target_error'] if 'target_error' in config['train'] else None
+    # stop once the training has converged, set by the early_stop section of train
+    monitor = ConvergenceMonitor.from_config(config)
 
     # loss fn
     lploss = LpLoss(size_average=True)
-    
-    S = config['data']['pde_res'][0]
-    forcing = get_forcing(S).to(device)
+
+    # resolution curriculum: stage k uses the k-th loaders from iteration milestones[k]
+    if isinstance(train_u_loader, (list, tuple)):
+        curriculum = config['curriculum']
+        stage_starts = curriculum['milestones']
+        stage_res = curriculum['pde_res']
+        modes_ratio = curriculum['modes_ratio'] if 'modes_ratio' in curriculum else None
+    else:
+        train_u_loader, train_a_loader = [train_u_loader], [train_a_loader]
+        stage_starts = [0]
+        stage_res = [config['data']['pde_res']]
+        modes_ratio = None
+    forcings = [get_forcing(res[0]).to(device) for res in stage_res]
     # set up wandb
     if wandb and args.log:
         run = wandb.init(project=config['log']['project'], 
@@ -74,74 +103,185 @@ def train_ns(model,
                          group=config['log']['group'], 
                          config=config, reinit=True, 
                          settings=wandb.Settings(start_method='fork'))
-    
-    pbar = range(start_iter, config['train']['num_iter'])
+
+    u_loaders = [ResumableIterator(loader) for loader in train_u_loader]
+    a_loaders = [ResumableIterator(loader) for loader in train_a_loader]
+    loaders = {'u_loader': u_loaders[0], 'a_loader': a_loaders[0]}
+    for k in range(1, len(stage_starts)):
+        loaders[f'u_loader-{k}'] = u_loaders[k]
+        loaders[f'a_loader-{k}'] = a_loaders[k]
+    if ckpt is not None:
+        start_iter = load_state(ckpt, optimizer, scheduler, 
+                                loaders=loaders, 
+                                restore_rng=get_world_size() == 1)
+    else:
+        start_iter = config['train']['start_iter']
+    stage = -1
+
+    num_iter = config['train']['num_iter']
+    if monitor is not None:
+        num_iter = monitor.num_iter(num_iter)
+    pbar = range(start_iter, num_iter)
     if args.tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
-
-    u_loader = sample_data(train_u_loader)
-    a_loader = sample_data(train_a_loader)
+    meter = MetricAccumulator(device)
+    final_log = {}
+    t_start = default_timer()
+    eval_time = 0.0
+    time_to_target = None
 
     for e in pbar:
-        log_dict = {}
-
+        if bisect.bisect_right(stage_starts, e) - 1 != stage:
+            stage = bisect.bisect_right(stage_starts, e) - 1
+            u_loader, a_loader = u_loaders[stage], a_loaders[stage]
+            forcing = forcings[stage]
+            if modes_ratio is not None:
+                net = model.module if hasattr(model, 'module') else model
+                net.set_active_modes(modes_ratio[stage])
+            if len(stage_starts) > 1:
+                print(f'Iteration {e}: PDE resolution {stage_res[stage]}')
         optimizer.zero_grad()
-        # data loss
+        data_mbs, pde_mbs = [], []
         if xy_weight > 0:
-            u, a_in = next(u_loader)
-            u = u.to(device)
-            a_in = a_in.to(device)
-            out = model(a_in)
-            data_loss = lploss(out, u)
-        else:
-            data_loss = torch.zeros(1, device=device)
+            u_batch = next(u_loader)
+            data_size = u_batch[0].shape[0]
+            data_mbs = micro_batches(u_batch, micro_bs)
+        if f_weight != 0.0:
+            a_batch = next(a_loader)
+            pde_size = a_batch.shape[0]
+            pde_mbs = micro_batches(a_batch, pde_micro_bs)
 
+        # the losses are batch means, each micro-batch is weighted by its share of the batch
+        data_loss = torch.zeros(1, device=device)
+        loss_ic = torch.zeros(1, device=device)
+        loss_f = torch.zeros(1, device=device)
+        loss = torch.zeros(1, device=device)
+        num_mbs = max(len(data_mbs), len(pde_mbs))
+        for i in range(num_mbs):
+            with grad_sync(model, sync=i == num_mbs - 1):
+                inputs = []
+                if i < len(data_mbs):
+                    u, a_in = data_mbs[i]
+                    u = u.to(device)
+                    a_in = a_in.to(device)
+                    inputs.append(a_in)
+                if i < len(pde_mbs):
+                    a = pde_mbs[i].to(device)
+                    inputs.append(a)
+                outs = batched_forward(model, inputs, concat=joint_batch)
+                mb_loss = 0.0
+                # data loss
+                if i < len(data_mbs):
+                    out = outs.pop(0)
+                    mb_data = lploss(out, u) * (u.shape[0] / data_size)
+                    mb_loss = mb_loss + mb_data * xy_weight
+                    data_loss += mb_data.detach()
+                if i < len(pde_mbs):
+                    # pde loss
+                    out = outs.pop(0)
+                    u0  = a[:, :, :, 0, -1]
+                    mb_ic, mb_f = PINO_loss3d(out, u0, forcing, v, t_duration)
+                    scale = a.shape[0] / pde_size
+                    mb_loss = mb_loss + (mb_f * f_weight + mb_ic * ic_weight) * scale
+                    loss_ic += mb_ic.detach() * scale
+                    loss_f += mb_f.detach() * scale
+                mb_loss.backward()
+                loss += mb_loss.detach()
         if f_weight != 0.0:
-            # pde loss
-            a = next(a_loader)
-            a = a.to(device)
-            out = model(a)
-            
-            u0  = a[:, :, :, 0, -1]
-            loss_ic, loss_f = PINO_loss3d(out, u0, forcing, v, t_duration)
-            log_dict['IC'] = loss_ic.item()
-            log_dict['PDE'] = loss_f.item()
-        else:
-            loss_ic = loss_f = 0.0
-        loss = data_loss * xy_weight + loss_f * f_weight + loss_ic * ic_weight
+            meter.update({'IC': loss_ic, 'PDE': loss_f})
 
-        loss.backward()
         optimizer.step()
         scheduler.step()
 
-        log_dict['train loss'] = loss.item()
-        log_dict['data'] = data_loss.item()
-        if e % eval_step == 0:
-            eval_err, std_err = eval_ns(model, val_loader, lploss, device)
-            log_dict['val error'] = eval_err
-        
-        if args.tqdm:
-            logstr = dict2str(log_dict)
-            pbar.set_description(
-                (
-                    logstr
+        meter.update({'train loss': loss, 'data': data_loss})
+        stop = False
+        if e % log_step == 0 or e % eval_step == 0:
+            log_dict = meter.compute()
+            meter.reset()
+            if e % eval_step == 0 and get_rank() == 0:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                t_eval = default_timer()
+                # wall-clock time spent training, without the evaluations
+                train_time = t_eval - t_start - eval_time
+                eval_err, std_err = eval_ns(model, val_loader, lploss, device)
+                eval_time += default_timer() - t_eval
+                log_dict['val error'] = eval_err
+                log_dict['train time'] = train_time
+                if target_error is not None and time_to_target is None and eval_err <= target_error:
+                    time_to_target = train_time
+                    log_dict['time to target'] = time_to_target
+                    print(f'Reached val error {eval_err} <= {target_error} at iteration {e} after {time_to_target:.1f}s of training')
+
+            if args.tqdm:
+                logstr = dict2str(log_dict)
+                pbar.set_description(
+                    (
+                        logstr
+                    )
                 )
-            )
-        if wandb and args.log:
-            wandb.log(log_dict)
-        if e % save_step == 0 and e > 0:
-            ckpt_path = os.path.join(ckpt_dir, f'model-{e}.pt')
-            save_ckpt(ckpt_path, model, optimizer, scheduler)
+            if monitor is not None:
+                stop = monitor.step(e, log_dict)
+                if stop:
+                    log_dict['stop iter'] = e
+            final_log.update(log_dict)
+            if wandb and args.log:
+                wandb.log(log_dict, step=e)
+        if (e % save_step == 0 and e > 0 or stop) and writer is not None:
+            data_state = {key: loader.state_dict() for key, loader in loaders.items()}
+            writer.save(e, model, optimizer, scheduler, data_state=data_state)
+        if stop:
+            break
 
+    if writer is not None:
+        writer.close()
+    if target_error is not None and get_rank() == 0:
+        if time_to_target is None:
+            print(f'Target val error {target_error} not reached')
+        elif wandb and args.log:
+            run.summary['time to target'] = time_to_target
+    if monitor is not None and monitor.stop_iter is not None and wandb and args.log:
+        run.summary['stop iter'] = monitor.stop_iter
+    if get_rank() == 0:
+        write_sweep_result(final_log)
     # clean up wandb
     if wandb and args.log:
         run.finish()
 
 
-def subprocess(args):
+def build_loaders(config, data_res, pde_res, batchsize, distributed=False):
+    '''
+    Loaders of the training data at data_res and of the initial conditions at pde_res
+    '''
+    u_set = KFDataset(paths=config['data']['paths'], 
+                      raw_res=config['data']['raw_res'],
+                      data_res=data_res, 
+                      pde_res=data_res, 
+                      n_samples=config['data']['n_data_samples'], 
+                      offset=config['data']['offset'], 
+                      t_duration=config['data']['t_duration'])
+    u_loader = DataLoader(u_set, batch_size=batchsize, num_workers=4, 
+                          sampler=data_sampler(u_set, shuffle=True, distributed=distributed))
+
+    a_set = KFaDataset(paths=config['data']['paths'], 
+                       raw_res=config['data']['raw_res'], 
+                       pde_res=pde_res, 
+                       n_samples=config['data']['n_a_samples'],
+                       offset=config['data']['a_offset'], 
+                       t_duration=config['data']['t_duration'])
+    a_loader = DataLoader(a_set, batch_size=batchsize, num_workers=4, 
+                          sampler=data_sampler(a_set, shuffle=True, distributed=distributed))
+    return u_set, u_loader, a_set, a_loader
+
+
+def subprocess(rank, args):
     with open(args.config, 'r') as f:
         config = yaml.load(f, yaml.FullLoader)
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    device = get_device(rank)
+    world_size = get_world_size()
+    # only the first process logs
+    args.log = args.log and rank == 0
+    args.tqdm = args.tqdm and rank == 0
 
     # set random seed
     config['seed'] = args.seed
@@ -163,6 +303,7 @@ def subprocess(args):
     config['num_params'] = num_params
     print(f'Number of parameters: {num_params}')
     # Load from checkpoint
+    ckpt = None
     if args.ckpt:
         ckpt_path = args.ckpt
         ckpt = torch.load(ckpt_path)
@@ -183,24 +324,22 @@ def subprocess(args):
         test_err, std_err = eval_ns(model, testloader, criterion, device)
         print(f'Averaged test relative L2 error: {test_err}; Standard error: {std_err}')
     else:
-        # training set
-        batchsize = config['train']['batchsize']
-        u_set = KFDataset(paths=config['data']['paths'], 
-                          raw_res=config['data']['raw_res'],
-                          data_res=config['data']['data_res'], 
-                          pde_res=config['data']['data_res'], 
-                          n_samples=config['data']['n_data_samples'], 
-                          offset=config['data']['offset'], 
-                          t_duration=config['data']['t_duration'])
-        u_loader = DataLoader(u_set, batch_size=batchsize, num_workers=4, shuffle=True)
-
-        a_set = KFaDataset(paths=config['data']['paths'], 
-                           raw_res=config['data']['raw_res'], 
-                           pde_res=config['data']['pde_res'], 
-                           n_samples=config['data']['n_a_samples'],
-                           offset=config['data']['a_offset'], 
-                           t_duration=config['data']['t_duration'])
-        a_loader = DataLoader(a_set, batch_size=batchsize, num_workers=4, shuffle=True)
+        # training set, the batch is split across the processes
+        batchsize = config['train']['batchsize'] // world_size
+        distributed = world_size > 1
+        if 'curriculum' in config:
+            # datasets subsampled from the raw data for each stage of the curriculum
+            u_loader, a_loader = [], []
+            for data_res, pde_res in zip(config['curriculum']['data_res'], config['curriculum']['pde_res']):
+                u_set, stage_u_loader, a_set, stage_a_loader = build_loaders(config, data_res, pde_res, 
+                                                                             batchsize, distributed)
+                u_loader.append(stage_u_loader)
+                a_loader.append(stage_a_loader)
+        else:
+            u_set, u_loader, a_set, a_loader = build_loaders(config, 
+                                                             config['data']['data_res'], 
+                                                             config['data']['pde_res'], 
+                                                             batchsize, distributed)
         # val set
         valset = KFDataset(paths=config['data']['paths'], 
                            raw_res=config['data']['raw_res'],
@@ -211,21 +350,19 @@ def subprocess(args):
                            t_duration=config['data']['t_duration'])
         val_loader = DataLoader(valset, batch_size=batchsize, num_workers=4)
         print(f'Train set: {len(u_set)}; Test set: {len(valset)}; IC set: {len(a_set)}')
+        bucket_cap_mb = config['train']['bucket_cap_mb'] if 'bucket_cap_mb' in config['train'] else 25
+        model = wrap_ddp(model, device, bucket_cap_mb=bucket_cap_mb)
         optimizer = Adam(model.parameters(), lr=config['train']['base_lr'])
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, 
                                                          milestones=config['train']['milestones'], 
                                                          gamma=config['train']['scheduler_gamma'])
-        if args.ckpt:
-            ckpt = torch.load(ckpt_path)
-            optimizer.load_state_dict(ckpt['optim'])
-            scheduler.load_state_dict(ckpt['scheduler'])
-            config['train']['start_iter'] = scheduler.last_epoch
         train_ns(model, 
                  u_loader, a_loader, 
                  val_loader, 
                  optimizer, scheduler, 
                  device, 
-                 config, args)
+                 config, args, 
+                 ckpt=ckpt)
     print('Done!')
         
         
@@ -240,7 +377,8 @@ if __name__ == '__main__':
     parser.add_argument('--ckpt', type=str, default=None)
     parser.add_argument('--test', action='store_true', help='Test')
     parser.add_argument('--tqdm', action='store_true', help='Turn on the tqdm')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of data-parallel processes')
     args = parser.parse_args()
     if args.seed is None:
         args.seed = random.randint(0, 100000)
-    subprocess(args)
\ No newline at end of file
+    launch(subprocess, args.num_procs, args=(args, ))
\ No newline at end of file
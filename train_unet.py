@@ -15,8 +15,10 @@ from torch.utils.data import DataLoader
 from baselines.unet3d import UNet3D
 
 from train_utils.losses import LpLoss
-from train_utils.datasets import KFDataset, KFaDataset, sample_data
-from train_utils.utils import save_ckpt, count_params, dict2str
+from train_utils.datasets import KFDataset, KFaDataset, ResumableIterator
+from train_utils.utils import count_params, dict2str
+from train_utils.metrics import MetricAccumulator, ConvergenceMonitor
+from train_utils.checkpoint import CheckpointWriter, load_state
 
 try:
     import wandb
@@ -34,9 +36,10 @@ def eval_ns(model, val_loader, criterion, device):
         out = model(a)
         out = out.squeeze(1).permute(0, 2, 3, 1)
         val_loss = criterion(out, u)
-        val_err.append(val_loss.item())
+        val_err.append(val_loss.detach())
 
     N = len(val_loader)
+    val_err = torch.stack(val_err).cpu().numpy()
 
     avg_err = np.mean(val_err)
     std_err = np.std(val_err, ddof=1) / np.sqrt(N)
@@ -48,16 +51,21 @@ def train_ns(model,
              val_loader,            # validation data
              optimizer, 
              scheduler,
-             device, config, args):
-    start_iter = config['train']['start_iter']
+             device, config, args, 
+             ckpt=None):            # checkpoint to resume from
     v = 1/ config['data']['Re']
     save_step = config['train']['save_step']
     eval_step = config['train']['eval_step']
+    log_step = config['train']['log_step'] if 'log_step' in config['train'] else 100
+    # stop once the training has converged, set by the early_stop section of train
+    monitor = ConvergenceMonitor.from_config(config)
 
     # set up directory
     base_dir = os.path.join('exp', config['log']['logdir'])
     ckpt_dir = os.path.join(base_dir, 'ckpts')
     os.makedirs(ckpt_dir, exist_ok=True)
+    keep_ckpts = config['train']['keep_ckpts'] if 'keep_ckpts' in config['train'] else None
+    writer = CheckpointWriter(ckpt_dir, keep_last=keep_ckpts)
 
     # loss fn
     lploss = LpLoss(size_average=True)
@@ -70,16 +78,24 @@ def train_ns(model,
                          group=config['log']['group'], 
                          config=config, reinit=True, 
                          settings=wandb.Settings(start_method='fork'))
-    
-    pbar = range(start_iter, config['train']['num_iter'])
+
+    u_loader = ResumableIterator(train_u_loader)
+    loaders = {'u_loader': u_loader}
+    if ckpt is not None:
+        start_iter = load_state(ckpt, optimizer, scheduler, loaders=loaders)
+    else:
+        start_iter = config['train']['start_iter']
+
+    num_iter = config['train']['num_iter']
+    if monitor is not None:
+        num_iter = monitor.num_iter(num_iter)
+    pbar = range(start_iter, num_iter)
     if args.tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.2)
 
-    u_loader = sample_data(train_u_loader)
+    meter = MetricAccumulator(device)
 
     for e in pbar:
-        log_dict = {}
-
         optimizer.zero_grad()
         # data loss
         u, a_in = next(u_loader)
@@ -95,24 +111,37 @@ def train_ns(model,
         optimizer.step()
         scheduler.step()
 
-        log_dict['train loss'] = loss.item()
-        if e % eval_step == 0:
-            eval_err, std_err = eval_ns(model, val_loader, lploss, device)
-            log_dict['val error'] = eval_err
-        
-        if args.tqdm:
-            logstr = dict2str(log_dict)
-            pbar.set_description(
-                (
-                    logstr
+        meter.update({'train loss': loss})
+        stop = False
+        if e % log_step == 0 or e % eval_step == 0:
+            log_dict = meter.compute()
+            meter.reset()
+            if e % eval_step == 0:
+                eval_err, std_err = eval_ns(model, val_loader, lploss, device)
+                log_dict['val error'] = eval_err
+
+            if args.tqdm:
+                logstr = dict2str(log_dict)
+                pbar.set_description(
+                    (
+                        logstr
+                    )
                 )
-            )
-        if wandb and args.log:
-            wandb.log(log_dict)
-        if e % save_step == 0 and e > 0:
-            ckpt_path = os.path.join(ckpt_dir, f'model-{e}.pt')
-            save_ckpt(ckpt_path, model, optimizer, scheduler)
-
+            if monitor is not None:
+                stop = monitor.step(e, log_dict)
+                if stop:
+                    log_dict['stop iter'] = e
+            if wandb and args.log:
+                wandb.log(log_dict, step=e)
+        if e % save_step == 0 and e > 0 or stop:
+            data_state = {key: loader.state_dict() for key, loader in loaders.items()}
+            writer.save(e, model, optimizer, scheduler, data_state=data_state)
+        if stop:
+            break
+
+    writer.close()
+    if monitor is not None and monitor.stop_iter is not None and wandb and args.log:
+        run.summary['stop iter'] = monitor.stop_iter
     # clean up wandb
     if wandb and args.log:
         run.finish()
@@ -137,6 +166,7 @@ def subprocess(args):
     config['num_params'] = num_params
     print(f'Number of parameters: {num_params}')
     # Load from checkpoint
+    ckpt = None
     if args.ckpt:
         ckpt_path = args.ckpt
         ckpt = torch.load(ckpt_path)
@@ -182,17 +212,13 @@ def subprocess(args):
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, 
                                                          milestones=config['train']['milestones'], 
                                                          gamma=config['train']['scheduler_gamma'])
-        if args.ckpt:
-            ckpt = torch.load(ckpt_path)
-            optimizer.load_state_dict(ckpt['optim'])
-            scheduler.load_state_dict(ckpt['scheduler'])
-            config['train']['start_iter'] = scheduler.last_epoch
         train_ns(model, 
                  u_loader, 
                  val_loader, 
                  optimizer, scheduler, 
                  device, 
-                 config, args)
+                 config, args, 
+                 ckpt=ckpt)
     print('Done!')
         
         
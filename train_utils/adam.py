@@ -5,6 +5,10 @@ from typing import List, Optional
 from torch.optim.optimizer import Optimizer
 
 
+def _has_foreach():
+    return hasattr(torch, '_foreach_addcdiv_') and hasattr(torch, '_foreach_maximum_')
+
+
 def adam(params: List[Tensor],
          grads: List[Tensor],
          exp_avgs: List[Tensor],
@@ -17,10 +21,39 @@ def adam(params: List[Tensor],
          beta2: float,
          lr: float,
          weight_decay: float,
-         eps: float):
+         eps: float,
+         negative: bool = False,
+         foreach: Optional[bool] = None):
     r"""Functional API that performs Adam algorithm computation.
     See :class:`~torch.optim.Adam` for details.
+    If negative, the update is added instead of subtracted (gradient ascent).
+    If foreach, the update is computed with the multi-tensor kernels.
     """
+    if foreach is None:
+        foreach = _has_foreach()
+    if foreach:
+        func = _multi_tensor_adam
+    else:
+        func = _single_tensor_adam
+    func(params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, state_steps,
+         amsgrad=amsgrad, beta1=beta1, beta2=beta2, lr=lr,
+         weight_decay=weight_decay, eps=eps, negative=negative)
+
+
+def _single_tensor_adam(params: List[Tensor],
+                        grads: List[Tensor],
+                        exp_avgs: List[Tensor],
+                        exp_avg_sqs: List[Tensor],
+                        max_exp_avg_sqs: List[Tensor],
+                        state_steps: List[int],
+                        *,
+                        amsgrad: bool,
+                        beta1: float,
+                        beta2: float,
+                        lr: float,
+                        weight_decay: float,
+                        eps: float,
+                        negative: bool):
 
     for i, param in enumerate(params):
 
@@ -47,8 +80,79 @@ def adam(params: List[Tensor],
             denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
 
         step_size = lr / bias_correction1
+        if not negative:
+            step_size = -step_size
+
+        param.addcdiv_(exp_avg, denom, value=step_size)
+
 
-        param.addcdiv_(exp_avg, denom, value=-step_size)
+def _group_by_device_and_dtype(*tensorlists):
+    '''
+    Split aligned lists of tensors into groups sharing the device and dtype of the first list
+    Returns:
+        dict mapping (device, dtype) to a list of sublists, one per input list
+    '''
+    groups = {}
+    for i, p in enumerate(tensorlists[0]):
+        key = (p.device, p.dtype)
+        if key not in groups:
+            groups[key] = [[] for _ in tensorlists]
+        for group, tensors in zip(groups[key], tensorlists):
+            group.append(tensors[i])
+    return groups
+
+
+def _multi_tensor_adam(params: List[Tensor],
+                       grads: List[Tensor],
+                       exp_avgs: List[Tensor],
+                       exp_avg_sqs: List[Tensor],
+                       max_exp_avg_sqs: List[Tensor],
+                       state_steps: List[int],
+                       *,
+                       amsgrad: bool,
+                       beta1: float,
+                       beta2: float,
+                       lr: float,
+                       weight_decay: float,
+                       eps: float,
+                       negative: bool):
+    if len(params) == 0:
+        return
+    if not amsgrad:
+        max_exp_avg_sqs = [None] * len(params)
+    groups = _group_by_device_and_dtype(params, grads, exp_avgs, exp_avg_sqs, max_exp_avg_sqs, state_steps)
+
+    for (device, dtype), group in groups.items():
+        params_, grads_, exp_avgs_, exp_avg_sqs_, max_exp_avg_sqs_, steps_ = group
+
+        if weight_decay != 0:
+            grads_ = torch._foreach_add(grads_, params_, alpha=weight_decay)
+
+        # Decay the first and second moment running average coefficient
+        torch._foreach_mul_(exp_avgs_, beta1)
+        torch._foreach_add_(exp_avgs_, grads_, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs_, beta2)
+        if dtype.is_complex:
+            # |grad|^2 stored in the complex second moment, as in the single tensor update
+            torch._foreach_addcmul_(exp_avg_sqs_, grads_, [grad.conj() for grad in grads_], value=1 - beta2)
+        else:
+            torch._foreach_addcmul_(exp_avg_sqs_, grads_, grads_, value=1 - beta2)
+
+        bias_correction2_sqrt = [math.sqrt(1 - beta2 ** step) for step in steps_]
+        step_sizes = [lr / (1 - beta1 ** step) for step in steps_]
+        if not negative:
+            step_sizes = [-step_size for step_size in step_sizes]
+
+        if amsgrad:
+            # Maintains the maximum of all 2nd moment running avg. till now
+            torch._foreach_maximum_(max_exp_avg_sqs_, exp_avg_sqs_)
+            denom = torch._foreach_sqrt(max_exp_avg_sqs_)
+        else:
+            denom = torch._foreach_sqrt(exp_avg_sqs_)
+        torch._foreach_div_(denom, bias_correction2_sqrt)
+        torch._foreach_add_(denom, eps)
+
+        torch._foreach_addcdiv_(params_, exp_avgs_, denom, step_sizes)
 
 
 class Adam(Optimizer):
@@ -68,6 +172,8 @@ class Adam(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        foreach (boolean, optional): whether to use the multi-tensor implementation,
+            parameters are grouped by device and dtype (default: None, use it if available)
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
     .. _Decoupled Weight Decay Regularization:
@@ -76,8 +182,11 @@ class Adam(Optimizer):
         https://openreview.net/forum?id=ryQu7f-RZ
     """
 
+    # sign of the update, NAdam ascends the objective
+    negative = False
+
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, foreach=None):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -89,13 +198,14 @@ class Adam(Optimizer):
         if not 0.0 <= weight_decay:
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad, foreach=foreach)
         super(Adam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(Adam, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('foreach', None)
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -159,5 +269,7 @@ class Adam(Optimizer):
                  beta2=beta2,
                  lr=group['lr'],
                  weight_decay=group['weight_decay'],
-                 eps=group['eps'])
+                 eps=group['eps'],
+                 negative=self.negative,
+                 foreach=group['foreach'])
         return loss
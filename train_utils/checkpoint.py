@@ -0,0 +1,166 @@
+import os
+import random
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    '''
+    Copy all the tensors in a nested dict/list/tuple to host memory
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointWriter(object):
+    '''
+    Save checkpoints from a background thread.
+    save() copies the state to host memory and returns; the copy is written to a temporary file
+    which is then renamed, so a checkpoint on disk is always complete.
+    At most one snapshot waits for the writer, save() blocks if the previous one is not written yet.
+    '''
+    def __init__(self, ckpt_dir, keep_last=None, prefix='model'):
+        '''
+        Args:
+            ckpt_dir: directory of the checkpoints
+            keep_last: number of checkpoints to keep, None keeps all of them
+            prefix: checkpoints are saved as {prefix}-{step}.pt
+        '''
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.prefix = prefix
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+        self.saved = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def path(self, step):
+        return os.path.join(self.ckpt_dir, f'{self.prefix}-{step}.pt')
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path, state = item
+            try:
+                self._write(path, state)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _write(self, path, state):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        print(f'Checkpoint is saved to {path}')
+        if path in self.saved:
+            self.saved.remove(path)
+        self.saved.append(path)
+        if self.keep_last is not None:
+            while len(self.saved) > self.keep_last:
+                old_path = self.saved.pop(0)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write checkpoint') from error
+
+    def save(self, step, model, optimizer=None, scheduler=None, data_state=None):
+        '''
+        Snapshot the training state and queue it for writing
+        Args:
+            step: iteration or epoch, used in the file name and to resume
+            model: model, unwrapped if it is DDP
+            optimizer, scheduler: optional
+            data_state: optional position of the data iterators, e.g. {'u_loader': it.state_dict()}
+        Returns:
+            path of the checkpoint
+        '''
+        self._check()
+        if hasattr(model, 'module'):
+            model = model.module
+        state = {
+            'model': model.state_dict(),
+            'optim': optimizer.state_dict() if optimizer else None,
+            'scheduler': scheduler.state_dict() if scheduler else None,
+            'iter': step,
+            'rng': get_rng_state(),
+            'data': data_state,
+        }
+        path = self.path(step)
+        self.queue.put((path, to_cpu(state)))
+        return path
+
+    def wait(self):
+        '''
+        Block until all the queued checkpoints are written
+        '''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def load_state(ckpt, optimizer=None, scheduler=None, loaders=None, restore_rng=True):
+    '''
+    Restore the training state of a checkpoint saved by CheckpointWriter, the model weights are loaded by the caller
+    Args:
+        ckpt: loaded checkpoint dict
+        optimizer, scheduler: optional
+        loaders: optional dict of data iterators with load_state_dict, keyed as in data_state
+        restore_rng: restore the random number generators
+    Returns:
+        iteration to resume from
+    '''
+    if optimizer is not None and ckpt.get('optim') is not None:
+        optimizer.load_state_dict(ckpt['optim'])
+    if scheduler is not None and ckpt.get('scheduler') is not None:
+        scheduler.load_state_dict(ckpt['scheduler'])
+    if loaders is not None and ckpt.get('data') is not None:
+        for key, loader in loaders.items():
+            if key in ckpt['data']:
+                loader.load_state_dict(ckpt['data'][key])
+    if restore_rng and ckpt.get('rng') is not None:
+        set_rng_state(ckpt['rng'])
+    if 'iter' in ckpt:
+        return ckpt['iter'] + 1
+    if scheduler is not None:
+        return scheduler.last_epoch
+    return 0
@@ -2,9 +2,14 @@ from torch.utils import data
 
 
 def sample_data(loader):
+    epoch = 0
     while True:
+        # reshuffle the shards of a DistributedSampler every pass
+        if hasattr(loader.sampler, 'set_epoch'):
+            loader.sampler.set_epoch(epoch)
         for batch in loader:
             yield batch
+        epoch += 1
 
 
 def data_sampler(dataset, shuffle, distributed):
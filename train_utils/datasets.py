@@ -22,9 +22,66 @@ def online_loader(sampler, S, T, time_scale, batchsize=1):
 
 
 def sample_data(loader):
+    epoch = 0
     while True:
+        # reshuffle the shards of a DistributedSampler every pass
+        if hasattr(loader.sampler, 'set_epoch'):
+            loader.sampler.set_epoch(epoch)
         for batch in loader:
             yield batch
+        epoch += 1
+
+
+class ResumableIterator(object):
+    '''
+    Infinite iterator over a DataLoader like sample_data, which can save and restore its position.
+    The order of each pass is drawn from a generator seeded with (seed + pass),
+    so a restored iterator yields the same batches as the original one.
+    '''
+    def __init__(self, loader, seed=None):
+        self.loader = loader
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_(2 ** 31).item())
+        self.seed = seed
+        self.epoch = 0
+        self.index = 0
+        self.iterator = None
+
+    def _start(self):
+        sampler = self.loader.sampler
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(self.epoch)
+        elif hasattr(sampler, 'generator'):
+            sampler.generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.iterator = iter(self.loader)
+        # skip the batches consumed before the checkpoint
+        for _ in range(self.index):
+            next(self.iterator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self._start()
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.epoch += 1
+            self.index = 0
+            self._start()
+            batch = next(self.iterator)
+        self.index += 1
+        return batch
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'index': self.index}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.index = state['index']
+        self.iterator = None
 
 
 class MatReader(object):
@@ -134,12 +191,13 @@ class NSLoader(object):
         self.S = nx // sub
         self.T = int(nt * t_interval) // sub_t + 1
         self.time_scale = t_interval
-        data1 = np.load(datapath1)
-        data1 = torch.tensor(data1, dtype=torch.float)[..., ::sub_t, ::sub, ::sub]
+        # map the file and copy only the subsampled data, the pages are shared by the processes reading it
+        data1 = np.load(datapath1, mmap_mode='r')
+        data1 = torch.tensor(data1[..., ::sub_t, ::sub, ::sub], dtype=torch.float)
 
         if datapath2 is not None:
-            data2 = np.load(datapath2)
-            data2 = torch.tensor(data2, dtype=torch.float)[..., ::sub_t, ::sub, ::sub]
+            data2 = np.load(datapath2, mmap_mode='r')
+            data2 = torch.tensor(data2[..., ::sub_t, ::sub, ::sub], dtype=torch.float)
         if t_interval == 0.5:
             data1 = self.extract(data1)
             if datapath2 is not None:
@@ -1,18 +1,108 @@
 import os
+import socket
 import torch
 import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 
-def setup(rank, world_size):
-    os.environ['MASTER_ADDR'] = 'localhost'
-    os.environ['MASTER_PORT'] = '7777'
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+def get_backend():
+    '''
+    NCCL when every process can own a GPU, gloo otherwise (e.g. multi-core CPU)
+    '''
+    if torch.cuda.is_available() and dist.is_nccl_available():
+        return 'nccl'
+    return 'gloo'
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def setup(rank, world_size, backend=None):
+    '''
+    Initialize the process group. MASTER_ADDR and MASTER_PORT are taken from the environment if set.
+    Without MASTER_PORT, a free port is picked; every process must then be started by launch,
+    which sets it before spawning, since the processes could not agree on a port picked by each of them.
+    '''
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    if 'MASTER_PORT' not in os.environ:
+        if world_size > 1:
+            raise RuntimeError('MASTER_PORT is not set; start the processes with launch or set MASTER_PORT')
+        os.environ['MASTER_PORT'] = str(find_free_port())
+    if backend is None:
+        backend = get_backend()
+    if backend == 'nccl':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
 
 
 def cleanup():
     dist.destroy_process_group()
 
 
+def get_device(rank):
+    if torch.cuda.is_available():
+        return torch.device(f'cuda:{rank % torch.cuda.device_count()}')
+    return torch.device('cpu')
+
+
+def _worker(rank, fn, world_size, threads, args):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    setup(rank, world_size)
+    try:
+        fn(rank, *args)
+    finally:
+        cleanup()
+
+
+def launch(fn, num_procs, args=(), threads=None):
+    '''
+    Run fn(rank, *args) in num_procs processes joined in one process group.
+    With a single process fn(0, *args) is called directly, without a process group.
+    Args:
+        fn: function to run, must be picklable
+        num_procs: number of processes
+        args: extra arguments of fn
+        threads: intra-op threads per process, default splits the CPU cores evenly when running on CPU
+    '''
+    if num_procs <= 1:
+        return fn(0, *args)
+    if threads is None and not torch.cuda.is_available():
+        threads = max(1, (os.cpu_count() or 1) // num_procs)
+    if 'MASTER_PORT' not in os.environ:
+        os.environ['MASTER_PORT'] = str(find_free_port())
+    mp.spawn(_worker, args=(fn, num_procs, threads, args), nprocs=num_procs)
+
+
+def wrap_ddp(model, device, bucket_cap_mb=25):
+    '''
+    Wrap the model in DistributedDataParallel if a process group is initialized.
+    Complex spectral weights are reduced as real views like the other parameters.
+    Args:
+        model: model already moved to device
+        device: device of this process
+        bucket_cap_mb: size of the gradient buckets
+    '''
+    if get_world_size() < 2:
+        return model
+    device_ids = [device] if device.type == 'cuda' else None
+    return DDP(model, device_ids=device_ids,
+               broadcast_buffers=False,
+               bucket_cap_mb=bucket_cap_mb,
+               gradient_as_bucket_view=True)
+
+
+def get_rank():
+    if not dist.is_available() or not dist.is_initialized():
+        return 0
+
+    return dist.get_rank()
+
+
 def get_world_size():
     if not dist.is_available() or not dist.is_initialized():
         return 1
@@ -50,7 +140,7 @@ def reduce_sum(tensor):
 
 
 def reduce_loss_dict(loss_dict):
-    if not dist.is_available() or dist.is_initialized():
+    if not dist.is_available() or not dist.is_initialized():
         return loss_dict
     world_size = get_world_size()
 
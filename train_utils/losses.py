@@ -1,3 +1,4 @@
+import functools
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -65,6 +66,27 @@ def darcy_loss(u, a):
     return loss_f
 
 
+@functools.lru_cache(maxsize=16)
+def ns_wavenumbers(N, device):
+    '''
+    Wavenumbers and negative Laplacian of an N x N periodic grid, computed once per resolution and device.
+    The tensors are shared between calls and must not be modified.
+    Returns:
+        k_x, k_y, lap with shape (1, N, N, 1), lap[0, 0] is set to 1
+    '''
+    # created as normal tensors even when first called under inference mode, so that autograd can use them
+    with torch.inference_mode(False):
+        k_max = N//2
+        k_x = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
+                         torch.arange(start=-k_max, end=0, step=1, device=device)), 0).reshape(N, 1).repeat(1, N).reshape(1,N,N,1)
+        k_y = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
+                         torch.arange(start=-k_max, end=0, step=1, device=device)), 0).reshape(1, N).repeat(N, 1).reshape(1,N,N,1)
+        # Negative Laplacian in Fourier space
+        lap = (k_x ** 2 + k_y ** 2)
+        lap[0, 0, 0, 0] = 1.0
+    return k_x, k_y, lap
+
+
 def FDM_NS_vorticity(w, v=1/40, t_interval=1.0):
     batchsize = w.size(0)
     nx = w.size(1)
@@ -76,14 +98,7 @@ def FDM_NS_vorticity(w, v=1/40, t_interval=1.0):
     w_h = torch.fft.fft2(w, dim=[1, 2])
     # Wavenumbers in y-direction
     k_max = nx//2
-    N = nx
-    k_x = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
-                     torch.arange(start=-k_max, end=0, step=1, device=device)), 0).reshape(N, 1).repeat(1, N).reshape(1,N,N,1)
-    k_y = torch.cat((torch.arange(start=0, end=k_max, step=1, device=device),
-                     torch.arange(start=-k_max, end=0, step=1, device=device)), 0).reshape(1, N).repeat(N, 1).reshape(1,N,N,1)
-    # Negative Laplacian in Fourier space
-    lap = (k_x ** 2 + k_y ** 2)
-    lap[0, 0, 0, 0] = 1.0
+    k_x, k_y, lap = ns_wavenumbers(nx, device)
     f_h = w_h / lap
 
     ux_h = 1j * k_y * f_h
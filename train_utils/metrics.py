@@ -0,0 +1,161 @@
+import math
+import torch
+import torch.distributed as dist
+
+
+class MetricAccumulator(object):
+    '''
+    Accumulate scalar metrics as detached tensors on device.
+    Nothing is synchronized with the host until compute() is called,
+    which reduces the sums across processes and transfers all the averages at once.
+    '''
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    @torch.no_grad()
+    def update(self, metrics, n=1):
+        '''
+        Args:
+            metrics: dict of scalar tensors or numbers
+            n: weight of the values, e.g. the batch size
+        '''
+        for key, value in metrics.items():
+            if torch.is_tensor(value):
+                value = value.detach().reshape(-1).mean().to(self.device, torch.float64)
+            else:
+                value = torch.tensor(float(value), dtype=torch.float64, device=self.device)
+            if key in self.sums:
+                self.sums[key] += value * n
+                self.counts[key] += n
+            else:
+                self.sums[key] = value * n
+                self.counts[key] = n
+
+    @torch.no_grad()
+    def compute(self, reduce=True):
+        '''
+        Average of each metric since the last reset.
+        If reduce, the averages are taken over all processes; every process must then call compute with the same keys.
+        Returns:
+            dict of floats
+        '''
+        if len(self.sums) == 0:
+            return {}
+        keys = sorted(self.sums.keys())
+        sums = torch.stack([self.sums[key] for key in keys])
+        counts = torch.tensor([float(self.counts[key]) for key in keys], dtype=torch.float64, device=self.device)
+        if reduce and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            stats = torch.cat([sums, counts])
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            sums, counts = stats[:len(keys)], stats[len(keys):]
+        avgs = (sums / counts).tolist()
+        return {key: avg for key, avg in zip(keys, avgs)}
+
+
+class ConvergenceMonitor(object):
+    '''
+    Decide when an iteration-based training has converged.
+    It is fed the averaged metrics at every log step and signals a stop when, after min_iter,
+        - the monitored metric falls below threshold,
+        - the best value has not improved by rel_tol (relative) for patience checks (plateau), or
+        - the metric improved by less than min_improvement (relative) over the last window checks.
+    With several processes the decision of rank 0 is broadcast, so only rank 0 needs the metric.
+    '''
+    def __init__(self, metric='train loss',
+                 patience=None, rel_tol=1e-3,
+                 window=None, min_improvement=1e-2,
+                 threshold=None,
+                 min_iter=0, max_iter=None):
+        '''
+        Args:
+            metric: key of the metric in the log dict, lower is better
+            patience: number of checks without improvement before stopping, None turns the plateau rule off
+            rel_tol: relative decrease counted as an improvement of the best value
+            window: number of checks of the relative-improvement rule, None turns it off
+            min_improvement: smallest relative improvement over the window to keep training
+            threshold: stop once the metric is below, None turns it off
+            min_iter: never stop before this iteration
+            max_iter: iteration budget, the training is cut to max_iter iterations
+        '''
+        self.metric = metric
+        self.patience = patience
+        self.rel_tol = rel_tol
+        self.window = window
+        self.min_improvement = min_improvement
+        self.threshold = threshold
+        self.min_iter = min_iter
+        self.max_iter = max_iter
+
+        self.best = math.inf
+        self.num_bad = 0
+        self.history = []
+        self.stop_iter = None
+        self.reason = None
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Build the monitor from the early_stop section of the train config, None if there is no such section
+        '''
+        if 'early_stop' not in config['train']:
+            return None
+        return cls(**config['train']['early_stop'])
+
+    def num_iter(self, num_iter):
+        '''
+        Number of iterations to run within the budget
+        '''
+        if self.max_iter is None:
+            return num_iter
+        return min(num_iter, self.max_iter)
+
+    def _check(self, value):
+        if self.threshold is not None and value <= self.threshold:
+            return f'{self.metric} {value:.3e} below threshold {self.threshold:.3e}'
+
+        if self.best == math.inf or value < self.best - self.rel_tol * abs(self.best):
+            self.best = value
+            self.num_bad = 0
+        else:
+            self.num_bad += 1
+        if self.patience is not None and self.num_bad >= self.patience:
+            return f'{self.metric} plateaued at {self.best:.3e} for {self.num_bad} checks'
+
+        self.history.append(value)
+        if self.window is not None and len(self.history) > self.window:
+            old_value = self.history[-self.window - 1]
+            self.history = self.history[-self.window - 1:]
+            improvement = (old_value - value) / max(abs(old_value), 1e-12)
+            if improvement < self.min_improvement:
+                return f'{self.metric} improved by {improvement:.2%} over the last {self.window} checks'
+        return None
+
+    def step(self, it, log_dict):
+        '''
+        Args:
+            it: current iteration
+            log_dict: averaged metrics, e.g. from MetricAccumulator.compute()
+        Returns:
+            True if the training should stop
+        '''
+        reason = None
+        if self.metric in log_dict:
+            value = float(log_dict[self.metric])
+            reason = self._check(value)
+            if it < self.min_iter:
+                reason = None
+        stop = reason is not None
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            flag = torch.tensor([float(stop)], device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
+            dist.broadcast(flag, src=0)
+            stop = bool(flag.item())
+        if stop:
+            self.stop_iter = it
+            self.reason = reason if reason is not None else 'stopped by rank 0'
+            print(f'Converged at iteration {it}: {self.reason}')
+        return stop
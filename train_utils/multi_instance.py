@@ -0,0 +1,144 @@
+import copy
+import math
+import bisect
+
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+
+class StackedModels(object):
+    '''
+    Independent copies of a model stored as stacked parameters of shape (num_copies, ...).
+    The copies are evaluated together with one vmapped forward, and each copy can be reset on its own,
+    e.g. to start a new test instance in a slot while the other slots keep optimizing.
+    '''
+    def __init__(self, model, num_copies):
+        '''
+        Args:
+            model: pretrained model every copy starts from
+            num_copies: number of copies
+        '''
+        self.init_params = {name: p.detach().clone() for name, p in model.named_parameters()}
+        self.init_buffers = {name: b.detach().clone() for name, b in model.named_buffers()}
+        self.params, self.buffers = stack_module_state([model] * num_copies)
+        # stateless copy of the module, the weights are passed to functional_call
+        self.base = copy.deepcopy(model).to('meta')
+
+    @property
+    def num_copies(self):
+        return next(iter(self.params.values())).shape[0]
+
+    @torch.no_grad()
+    def reset(self, k, state_dict=None):
+        '''
+        Restart copy k from the pretrained weights, or from state_dict if given
+        '''
+        for name, p in self.params.items():
+            src = self.init_params[name] if state_dict is None else state_dict[name]
+            p[k].copy_(src)
+        for name, b in self.buffers.items():
+            src = self.init_buffers[name] if state_dict is None else state_dict[name]
+            b[k].copy_(src)
+
+    def select(self, idx):
+        '''
+        Keep only the copies in idx
+        '''
+        self.params = {name: p[idx].detach().requires_grad_(p.requires_grad)
+                       for name, p in self.params.items()}
+        self.buffers = {name: b[idx] for name, b in self.buffers.items()}
+
+    def state_dict(self, k):
+        '''
+        Weights of copy k, loadable by the original model
+        '''
+        state = {name: p[k].detach().clone() for name, p in self.params.items()}
+        state.update({name: b[k].detach().clone() for name, b in self.buffers.items()})
+        return state
+
+    def call(self, k, x):
+        '''
+        Forward of copy k alone
+        '''
+        return functional_call(self.base, self.state_dict(k), (x, ))
+
+    def zero_grad(self):
+        for p in self.params.values():
+            p.grad = None
+
+    def map(self, func, *inputs):
+        '''
+        Evaluate func(model, *inputs) for every copy in one vmapped call
+        Args:
+            func: function of a callable model and the inputs of one copy
+            inputs: tensors of shape (num_copies, ...)
+        Returns:
+            outputs of func stacked along the first dimension
+        '''
+        def instance(params, buffers, *args):
+            model = lambda x: functional_call(self.base, (params, buffers), (x, ))
+            return func(model, *args)
+        return vmap(instance)(self.params, self.buffers, *inputs)
+
+
+class StackedAdam(object):
+    '''
+    Adam on stacked parameters, every copy has its own moments, step count and learning rate schedule.
+    The learning rate of a copy follows MultiStepLR over its own steps.
+    '''
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 milestones=(), gamma=1.0):
+        '''
+        Args:
+            params: dict of stacked parameters, from StackedModels
+            lr: base learning rate
+            milestones, gamma: step decay of the learning rate of each copy
+        '''
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.milestones = list(milestones)
+        self.gamma = gamma
+        num_copies = next(iter(params.values())).shape[0]
+        self.exp_avgs = {name: torch.zeros_like(p) for name, p in params.items() if p.requires_grad}
+        self.exp_avg_sqs = {name: torch.zeros_like(p) for name, p in params.items() if p.requires_grad}
+        self.steps = [0] * num_copies
+
+    @torch.no_grad()
+    def reset(self, k):
+        for name in self.exp_avgs:
+            self.exp_avgs[name][k].zero_()
+            self.exp_avg_sqs[name][k].zero_()
+        self.steps[k] = 0
+
+    def select(self, idx):
+        self.exp_avgs = {name: m[idx] for name, m in self.exp_avgs.items()}
+        self.exp_avg_sqs = {name: m[idx] for name, m in self.exp_avg_sqs.items()}
+        self.steps = [self.steps[i] for i in idx]
+
+    def get_lr(self, k):
+        return self.lr * self.gamma ** bisect.bisect_right(self.milestones, self.steps[k])
+
+    @torch.no_grad()
+    def step(self, params):
+        beta1, beta2 = self.betas
+        lrs = [self.get_lr(k) for k in range(len(self.steps))]
+        self.steps = [step + 1 for step in self.steps]
+        step_sizes = [-lr / (1 - beta1 ** step) for lr, step in zip(lrs, self.steps)]
+        bias_corrections2 = [math.sqrt(1 - beta2 ** step) for step in self.steps]
+
+        device = next(iter(params.values())).device
+        step_sizes = torch.tensor(step_sizes, device=device)
+        bias_corrections2 = torch.tensor(bias_corrections2, device=device)
+        for name, exp_avg in self.exp_avgs.items():
+            param = params[name]
+            if param.grad is None:
+                continue
+            grad = param.grad
+            exp_avg_sq = self.exp_avg_sqs[name]
+            shape = (-1, ) + (1, ) * (param.dim() - 1)
+            # Decay the first and second moment running average coefficient
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad.conj(), value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / bias_corrections2.view(shape)).add_(self.eps)
+            param.add_(exp_avg / denom * step_sizes.view(shape))
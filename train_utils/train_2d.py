@@ -3,6 +3,8 @@ import torch
 from tqdm import tqdm
 from .utils import save_checkpoint
 from .losses import LpLoss, darcy_loss, PINO_loss
+from .metrics import MetricAccumulator
+from .distributed import get_rank
 
 try:
     import wandb
@@ -28,7 +30,7 @@ def train_2d_operator(model,
         optimizer:
         scheduler:
         config:
-        rank:
+        rank: device of this process
         log:
         project:
         group:
@@ -39,7 +41,7 @@ def train_2d_operator(model,
     Returns:
 
     '''
-    if rank == 0 and wandb and log:
+    if wandb and log:
         run = wandb.init(project=project,
                          entity=config['log']['entity'],
                          group=group,
@@ -60,11 +62,12 @@ def train_2d_operator(model,
     pde_mesh = train_loader.dataset.pde_mesh
     pde_mol = torch.sin(np.pi * pde_mesh[..., 0]) * torch.sin(np.pi * pde_mesh[..., 1]) * 0.001
     pde_mol = pde_mol.to(rank)
+    meter = MetricAccumulator(pde_mol.device)
+    zero = torch.zeros(1, device=pde_mol.device)
     for e in pbar:
-        loss_dict = {'train_loss': 0.0,
-                     'data_loss': 0.0,
-                     'f_loss': 0.0,
-                     'test_error': 0.0}
+        meter.reset()
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(e)
         for data_ic, u, pde_ic in train_loader:
             data_ic, u, pde_ic = data_ic.to(rank), u.to(rank), pde_ic.to(rank)
 
@@ -74,23 +77,27 @@ def train_2d_operator(model,
             if data_weight > 0:
                 pred = model(data_ic).squeeze(dim=-1)
                 pred = pred * mollifier
-                data_loss = myloss(pred, y)
+                data_loss = myloss(pred, u)
+            else:
+                data_loss = zero
 
-            a = x[..., 0]
-            f_loss = darcy_loss(pred, a)
+            # pde loss
+            pde_pred = model(pde_ic).squeeze(dim=-1)
+            pde_pred = pde_pred * pde_mol
+            a = pde_ic[..., 0]
+            f_loss = darcy_loss(pde_pred, a)
 
             loss = data_weight * data_loss + f_weight * f_loss
             loss.backward()
             optimizer.step()
 
-            loss_dict['train_loss'] += loss.item() * y.shape[0]
-            loss_dict['f_loss'] += f_loss.item() * y.shape[0]
-            loss_dict['data_loss'] += data_loss.item() * y.shape[0]
+            meter.update({'train_loss': loss, 'f_loss': f_loss, 'data_loss': data_loss}, n=u.shape[0])
 
         scheduler.step()
-        train_loss_val = loss_dict['train_loss'] / len(train_loader.dataset)
-        f_loss_val = loss_dict['f_loss'] / len(train_loader.dataset)
-        data_loss_val = loss_dict['data_loss'] / len(train_loader.dataset)
+        loss_avg = meter.compute()
+        train_loss_val = loss_avg['train_loss']
+        f_loss_val = loss_avg['f_loss']
+        data_loss_val = loss_avg['data_loss']
 
         if use_tqdm:
             pbar.set_description(
@@ -108,9 +115,10 @@ def train_2d_operator(model,
                     'data loss': data_loss_val
                 }
             )
-    save_checkpoint(config['train']['save_dir'],
-                    config['train']['save_name'],
-                    model, optimizer)
+    if get_rank() == 0:
+        save_checkpoint(config['train']['save_dir'],
+                        config['train']['save_name'],
+                        model, optimizer)
     if wandb and log:
         run.finish()
     print('Done!')
@@ -142,11 +150,12 @@ def train_2d_burger(model,
     if use_tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.1)
 
+    meter = MetricAccumulator(rank)
     for e in pbar:
         model.train()
-        train_pino = 0.0
-        data_l2 = 0.0
-        train_loss = 0.0
+        meter.reset()
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(e)
 
         for x, y in train_loader:
             x, y = x.to(rank), y.to(rank)
@@ -160,13 +169,12 @@ def train_2d_burger(model,
             total_loss.backward()
             optimizer.step()
 
-            data_l2 += data_loss.item()
-            train_pino += loss_f.item()
-            train_loss += total_loss.item()
+            meter.update({'data_l2': data_loss, 'train_pino': loss_f, 'train_loss': total_loss})
         scheduler.step()
-        data_l2 /= len(train_loader)
-        train_pino /= len(train_loader)
-        train_loss /= len(train_loader)
+        loss_avg = meter.compute()
+        data_l2 = loss_avg['data_l2']
+        train_pino = loss_avg['train_pino']
+        train_loss = loss_avg['train_loss']
         if use_tqdm:
             pbar.set_description(
                 (
@@ -2,16 +2,119 @@ import torch
 from tqdm import tqdm
 from timeit import default_timer
 import torch.nn.functional as F
-from .utils import save_checkpoint
+from torch.utils.data import DataLoader, TensorDataset, RandomSampler
+from .utils import save_checkpoint, micro_batches, grad_sync, write_sweep_result
 from .losses import LpLoss, PINO_loss3d, get_forcing
-from .distributed import reduce_loss_dict
 from .data_utils import sample_data
+from .metrics import MetricAccumulator
+from .distributed import get_rank
 
 try:
     import wandb
 except ImportError:
     wandb = None
-    
+
+
+def accumulate_pino3d(model, x, y,
+                      S, T, forcing, v, t_interval,
+                      xy_weight, f_weight, ic_weight,
+                      micro_batchsize=None,
+                      device='cpu',
+                      hidden=None, prefix=None):
+    '''
+    Backward of the PINO loss of one batch, split into micro-batches whose gradients are accumulated.
+    The losses are batch means, so each micro-batch is weighted by its share of the batch.
+    Args:
+        x: input of shape (batchsize, S, S, T, 4)
+        y: target of shape (batchsize, S, S, T), None to train with the equation only
+        micro_batchsize: size of the micro-batches, None for the whole batch
+        hidden: cached output of the frozen prefix of the model for x, see cache_prefix
+        prefix: (number of cached layers, padding) of hidden
+    Returns:
+        dict of the detached batch losses: l2, ic, f, loss
+    '''
+    myloss = LpLoss(size_average=True)
+    batch_size = x.shape[0]
+    batch = [x]
+    if y is not None:
+        batch.append(y)
+    if hidden is not None:
+        batch.append(hidden)
+    mbs = micro_batches(tuple(batch), micro_batchsize)
+    losses = {'l2': 0.0, 'ic': 0.0, 'f': 0.0, 'loss': 0.0}
+    for i, mb in enumerate(mbs):
+        x = mb[0].to(device)
+        mb_size = x.shape[0]
+        scale = mb_size / batch_size
+        with grad_sync(model, sync=i == len(mbs) - 1):
+            if hidden is not None:
+                # only the trainable suffix runs on the cached activation
+                num_layers, num_pad = prefix
+                out = model.forward_suffix(mb[-1].to(device), num_pad, num_layers).reshape(mb_size, S, S, T + 5)
+            else:
+                x_in = F.pad(x, (0, 0, 0, 5), "constant", 0)
+                out = model(x_in).reshape(mb_size, S, S, T + 5)
+            out = out[..., :-5]
+            x = x[:, :, :, 0, -1]
+
+            if y is not None:
+                loss_l2 = myloss(out.view(mb_size, S, S, T), mb[1].to(device).view(mb_size, S, S, T))
+            else:
+                loss_l2 = torch.zeros(1, device=device)
+
+            if ic_weight != 0 or f_weight != 0:
+                loss_ic, loss_f = PINO_loss3d(out.view(mb_size, S, S, T), x, forcing, v, t_interval)
+            else:
+                loss_ic, loss_f = torch.zeros(1, device=device), torch.zeros(1, device=device)
+
+            total_loss = (loss_l2 * xy_weight + loss_f * f_weight + loss_ic * ic_weight) * scale
+            total_loss.backward()
+        losses['l2'] += loss_l2.detach() * scale
+        losses['ic'] += loss_ic.detach() * scale
+        losses['f'] += loss_f.detach() * scale
+        losses['loss'] += total_loss.detach()
+    return losses
+
+
+@torch.no_grad()
+def cache_prefix(model, train_loader, device='cpu', max_gb=4.0):
+    '''
+    Run the frozen prefix of the model, fc0 and the leading frozen Fourier layers, once on the training set.
+    Only the trainable suffix then needs to run at each iteration, e.g. when finetuning the last layer on one instance.
+    The cache is kept in host memory and each batch is moved to the device by accumulate_pino3d.
+    Args:
+        model: FNO3d, not wrapped in DDP
+        train_loader: loader of (x, y)
+        max_gb: largest size of the cached activations, estimated from the first batch
+    Returns:
+        loader of (x, y, hidden) and (number of cached layers, padding),
+        or None if no Fourier layer is frozen or the cache would exceed max_gb
+    '''
+    if hasattr(model, 'module') or not hasattr(model, 'num_frozen_layers'):
+        return None
+    num_layers = model.num_frozen_layers()
+    if num_layers is None:
+        return None
+    xs, ys, hiddens = [], [], []
+    loader = DataLoader(train_loader.dataset, batch_size=train_loader.batch_size, shuffle=False)
+    for x, y in loader:
+        x_in = F.pad(x.to(device), (0, 0, 0, 5), "constant", 0)
+        hidden, num_pad = model.forward_prefix(x_in, num_layers)
+        if len(hiddens) == 0:
+            size = hidden.element_size() * hidden.numel() / x.shape[0] * len(loader.dataset)
+            if size > max_gb * 2 ** 30:
+                print(f'Not caching the frozen layers, the cache would take {size / 2 ** 30:.1f} GB')
+                return None
+        xs.append(x)
+        ys.append(y)
+        hiddens.append(hidden.cpu())
+    dataset = TensorDataset(torch.cat(xs), torch.cat(ys), torch.cat(hiddens))
+    cached_loader = DataLoader(dataset, batch_size=train_loader.batch_size,
+                               shuffle=isinstance(train_loader.sampler, RandomSampler),
+                               drop_last=train_loader.drop_last,
+                               pin_memory=torch.cuda.is_available())
+    return cached_loader, (num_layers, num_pad)
+
 
 def train(model,
           loader, train_loader,
@@ -38,70 +141,63 @@ def train(model,
     t_interval = config['data']['time_interval']
 
     # training settings
-    batch_size = config['train']['batchsize']
     ic_weight = config['train']['ic_loss']
     f_weight = config['train']['f_loss']
     xy_weight = config['train']['xy_loss']
+    micro_bs = config['train']['micro_batchsize'] if 'micro_batchsize' in config['train'] else None
+    # compute the frozen layers once when only the last layers are trained
+    use_cache = config['train']['cache_prefix'] if 'cache_prefix' in config['train'] else True
+    cache_max_gb = config['train']['cache_max_gb'] if 'cache_max_gb' in config['train'] else 4.0
 
     model.train()
-    myloss = LpLoss(size_average=True)
     pbar = range(config['train']['epochs'])
     if use_tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.05)
     zero = torch.zeros(1).to(rank)
+    meter = MetricAccumulator(zero.device)
+
+    prefix = None
+    if use_cache:
+        cached = cache_prefix(model, train_loader, zero.device, max_gb=cache_max_gb)
+        if cached is not None:
+            train_loader, prefix = cached
+            print(f'Cached the output of fc0 and {prefix[0]} frozen Fourier layers')
 
     for ep in pbar:
-        loss_dict = {'train_loss': 0.0,
-                     'train_ic': 0.0,
-                     'train_f': 0.0,
-                     'test_l2': 0.0}
+        meter.reset()
         log_dict = {}
         if rank == 0 and profile:
                 torch.cuda.synchronize()
                 t1 = default_timer()
         # start solving
-        for x, y in train_loader:
-            x, y = x.to(rank), y.to(rank)
-
+        for batch in train_loader:
+            x, y = batch[0], batch[1]
+            hidden = batch[2] if prefix is not None else None
             optimizer.zero_grad()
-            x_in = F.pad(x, (0, 0, 0, 5), "constant", 0)
-            out = model(x_in).reshape(batch_size, S, S, T + 5)
-            out = out[..., :-5]
-            x = x[:, :, :, 0, -1]
-
-            loss_l2 = myloss(out.view(batch_size, S, S, T), y.view(batch_size, S, S, T))
-
-            if ic_weight != 0 or f_weight != 0:
-                loss_ic, loss_f = PINO_loss3d(out.view(batch_size, S, S, T), x, forcing, v, t_interval)
-            else:
-                loss_ic, loss_f = zero, zero
-
-            total_loss = loss_l2 * xy_weight + loss_f * f_weight + loss_ic * ic_weight
-
-            total_loss.backward()
-
+            losses = accumulate_pino3d(model, x, y, S, T, forcing, v, t_interval,
+                                       xy_weight, f_weight, ic_weight,
+                                       micro_batchsize=micro_bs, device=zero.device,
+                                       hidden=hidden, prefix=prefix)
             optimizer.step()
-            loss_dict['train_ic'] += loss_ic
-            loss_dict['test_l2'] += loss_l2
-            loss_dict['train_loss'] += total_loss
-            loss_dict['train_f'] += loss_f
+            meter.update({'train_ic': losses['ic'], 'train_f': losses['f'],
+                          'train_loss': losses['loss'], 'test_l2': losses['l2']})
 
         if rank == 0 and profile:
             torch.cuda.synchronize()
             t2 = default_timer()
             log_dict['Time cost'] = t2 - t1
         scheduler.step()
-        loss_reduced = reduce_loss_dict(loss_dict)
-        train_ic = loss_reduced['train_ic'].item() / len(train_loader)
-        train_f = loss_reduced['train_f'].item() / len(train_loader)
-        train_loss = loss_reduced['train_loss'].item() / len(train_loader)
-        test_l2 = loss_reduced['test_l2'].item() / len(train_loader)
-        log_dict = {
+        loss_avg = meter.compute()
+        train_ic = loss_avg['train_ic']
+        train_f = loss_avg['train_f']
+        train_loss = loss_avg['train_loss']
+        test_l2 = loss_avg['test_l2']
+        log_dict.update({
             'Train f error': train_f,
             'Train L2 error': train_ic,
             'Train loss': train_loss,
             'Test L2 error': test_l2
-            }
+            })
 
         if rank == 0:
             if use_tqdm:
@@ -118,6 +214,7 @@ def train(model,
         save_checkpoint(config['train']['save_dir'],
                         config['train']['save_name'],
                         model, optimizer)
+        write_sweep_result(log_dict)
         if wandb and log:
             run.finish()
 
@@ -150,84 +247,55 @@ def mixed_train(model,              # model of neural operator
     forcing_1 = get_forcing(S1).to(device)
     forcing_2 = get_forcing(S2).to(device)
     # training settings
-    batch_size = config['train']['batchsize']
     ic_weight = config['train']['ic_loss']
     f_weight = config['train']['f_loss']
     xy_weight = config['train']['xy_loss']
     num_data_iter = config['train']['data_iter']
     num_eqn_iter = config['train']['eqn_iter']
+    # data and equation batches can be split into micro-batches of different sizes
+    micro_bs = config['train']['micro_batchsize'] if 'micro_batchsize' in config['train'] else None
+    pde_micro_bs = config['train']['pde_micro_batchsize'] if 'pde_micro_batchsize' in config['train'] else micro_bs
 
     model.train()
-    myloss = LpLoss(size_average=True)
     pbar = range(config['train']['epochs'])
     if use_tqdm:
         pbar = tqdm(pbar, dynamic_ncols=True, smoothing=0.05)
-    zero = torch.zeros(1).to(device)
+    meter = MetricAccumulator(device)
     train_loader = sample_data(train_loader)
     for ep in pbar:
         model.train()
         t1 = default_timer()
-        train_loss = 0.0
-        train_ic = 0.0
-        train_f = 0.0
-        test_l2 = 0.0
-        err_eqn = 0.0
+        meter.reset()
         # train with data
         for _ in range(num_data_iter):
             x, y = next(train_loader)
-            x, y = x.to(device), y.to(device)
             optimizer.zero_grad()
-            x_in = F.pad(x, (0, 0, 0, 5), "constant", 0)
-            out = model(x_in).reshape(batch_size, S1, S1, T1 + 5)
-            out = out[..., :-5]
-            x = x[:, :, :, 0, -1]
-
-            loss_l2 = myloss(out.view(batch_size, S1, S1, T1),
-                             y.view(batch_size, S1, S1, T1))
-
-            if ic_weight != 0 or f_weight != 0:
-                loss_ic, loss_f = PINO_loss3d(out.view(batch_size, S1, S1, T1),
-                                              x, forcing_1,
-                                              v, t_interval)
-            else:
-                loss_ic, loss_f = zero, zero
-
-            total_loss = loss_l2 * xy_weight + loss_f * f_weight + loss_ic * ic_weight
-
-            total_loss.backward()
+            losses = accumulate_pino3d(model, x, y, S1, T1, forcing_1, v, t_interval,
+                                       xy_weight, f_weight, ic_weight,
+                                       micro_batchsize=micro_bs, device=device)
             optimizer.step()
 
-            train_ic = loss_ic.item()
-            test_l2 += loss_l2.item()
-            train_loss += total_loss.item()
-            train_f += loss_f.item()
-        if num_data_iter != 0:
-            train_ic /= num_data_iter
-            train_f /= num_data_iter
-            train_loss /= num_data_iter
-            test_l2 /= num_data_iter
+            meter.update({'train_ic': losses['ic'], 'train_f': losses['f'],
+                          'train_loss': losses['loss'], 'test_l2': losses['l2']})
         # train with random ICs
         for _ in range(num_eqn_iter):
             new_a = next(a_loader)
-            new_a = new_a.to(device)
             optimizer.zero_grad()
-            x_in = F.pad(new_a, (0, 0, 0, 5), "constant", 0)
-            out = model(x_in).reshape(batch_size, S2, S2, T2 + 5)
-            out = out[..., :-5]
-            new_a = new_a[:, :, :, 0, -1]
-            loss_ic, loss_f = PINO_loss3d(out.view(batch_size, S2, S2, T2),
-                                          new_a, forcing_2,
-                                          v, t_interval)
-            eqn_loss = loss_f * f_weight + loss_ic * ic_weight
-            eqn_loss.backward()
+            losses = accumulate_pino3d(model, new_a, None, S2, T2, forcing_2, v, t_interval,
+                                       0.0, f_weight, ic_weight,
+                                       micro_batchsize=pde_micro_bs, device=device)
             optimizer.step()
 
-            err_eqn += eqn_loss.item()
+            meter.update({'err_eqn': losses['loss']})
 
         scheduler.step()
+        loss_avg = meter.compute()
         t2 = default_timer()
-        if num_eqn_iter != 0:
-            err_eqn /= num_eqn_iter
+        train_ic = loss_avg.get('train_ic', 0.0)
+        train_f = loss_avg.get('train_f', 0.0)
+        train_loss = loss_avg.get('train_loss', 0.0)
+        test_l2 = loss_avg.get('test_l2', 0.0)
+        err_eqn = loss_avg.get('err_eqn', 0.0)
         if use_tqdm:
             pbar.set_description(
                 (
@@ -248,9 +316,13 @@ def mixed_train(model,              # model of neural operator
                 }
             )
 
-    save_checkpoint(config['train']['save_dir'],
-                    config['train']['save_name'],
-                    model, optimizer)
+    if get_rank() == 0:
+        save_checkpoint(config['train']['save_dir'],
+                        config['train']['save_name'],
+                        model, optimizer)
+        write_sweep_result({'Data train loss': train_loss,
+                            'Data L2 error': test_l2,
+                            'Random IC Train equation loss': err_eqn})
     if wandb and log:
         run.finish()
 
@@ -287,6 +359,7 @@ def progressive_train(model,
     model.train()
     myloss = LpLoss(size_average=True)
     zero = torch.zeros(1).to(device)
+    meter = MetricAccumulator(device)
     for milestone, epochs in zip(milestones, config['train']['epochs']):
         pbar = range(epochs)
         if use_tqdm:
@@ -297,10 +370,7 @@ def progressive_train(model,
         for ep in pbar:
             model.train()
             t1 = default_timer()
-            train_loss = 0.0
-            train_ic = 0.0
-            train_f = 0.0
-            test_l2 = 0.0
+            meter.reset()
             for x, y in train_loader:
                 x, y = x.to(device), y.to(device)
                 x = x[:, ::milestone, ::milestone, :, :]
@@ -324,16 +394,15 @@ def progressive_train(model,
                 total_loss.backward()
 
                 optimizer.step()
-                train_ic = loss_ic.item()
-                test_l2 += loss_l2.item()
-                train_loss += total_loss.item()
-                train_f += loss_f.item()
+                meter.update({'train_ic': loss_ic, 'train_f': loss_f,
+                              'train_loss': total_loss, 'test_l2': loss_l2})
             scheduler.step()
 
-            train_ic /= len(train_loader)
-            train_f /= len(train_loader)
-            train_loss /= len(train_loader)
-            test_l2 /= len(train_loader)
+            loss_avg = meter.compute()
+            train_ic = loss_avg['train_ic']
+            train_f = loss_avg['train_f']
+            train_loss = loss_avg['train_loss']
+            test_l2 = loss_avg['test_l2']
             t2 = default_timer()
             if use_tqdm:
                 pbar.set_description(
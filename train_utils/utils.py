@@ -1,4 +1,6 @@
 import os
+import json
+import contextlib
 import numpy as np
 import torch
 
@@ -146,6 +148,53 @@ def zero_grad(params):
                 p.grad.zero_()
 
 
+def batched_forward(model, inputs, concat=True):
+    '''
+    Run the model on a list of input batches.
+    If concat and all batches share the same shape except the batch dimension,
+    they are concatenated and the model is called once; otherwise once per batch.
+    Args:
+        model: network
+        inputs: list of tensors of shape (batchsize_i, ...)
+        concat: whether to try the single forward
+    Returns:
+        list of outputs, one per input batch
+    '''
+    if concat and len(inputs) > 1 and all(x.shape[1:] == inputs[0].shape[1:] for x in inputs):
+        sizes = [x.shape[0] for x in inputs]
+        out = model(torch.cat(inputs, dim=0))
+        return list(torch.split(out, sizes, dim=0))
+    return [model(x) for x in inputs]
+
+
+def micro_batches(batch, micro_batchsize):
+    '''
+    Split a batch, a tensor or a tuple of tensors, into micro-batches along the first dimension
+    Args:
+        batch: tensor or tuple of tensors with the same first dimension
+        micro_batchsize: maximal size of a micro-batch, None keeps the whole batch
+    Returns:
+        list of micro-batches of the same type as batch
+    '''
+    if isinstance(batch, torch.Tensor):
+        if micro_batchsize is None:
+            return [batch]
+        return list(torch.split(batch, micro_batchsize, dim=0))
+    if micro_batchsize is None:
+        return [tuple(batch)]
+    return list(zip(*[torch.split(x, micro_batchsize, dim=0) for x in batch]))
+
+
+def grad_sync(model, sync=True):
+    '''
+    Context for the backward of a micro-batch. Skip the DDP gradient all-reduce unless sync,
+    i.e. only the last micro-batch of an accumulation step reduces the gradients.
+    '''
+    if not sync and hasattr(model, 'no_sync'):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
 def count_params(net):
     count = 0
     for p in net.parameters():
@@ -157,25 +206,32 @@ def save_checkpoint(path, name, model, optimizer=None):
     ckpt_dir = 'checkpoints/%s/' % path
     if not os.path.exists(ckpt_dir):
         os.makedirs(ckpt_dir)
-    try:
-        model_state_dict = model.module.state_dict()
-    except AttributeError:
-        model_state_dict = model.state_dict()
-
+    if hasattr(model, 'module'):
+        model = model.module
     if optimizer is not None:
         optim_dict = optimizer.state_dict()
     else:
         optim_dict = 0.0
 
-    torch.save({
-        'model': model_state_dict,
-        'optim': optim_dict
-    }, ckpt_dir + name)
+    adapter_state_dict = model.adapter_state_dict() if hasattr(model, 'adapter_state_dict') else None
+    if adapter_state_dict is not None:
+        # only the adapters are trained, the base weights stay in the pretrained checkpoint
+        torch.save({
+            'adapter': adapter_state_dict,
+            'optim': optim_dict
+        }, ckpt_dir + name)
+    else:
+        torch.save({
+            'model': model.state_dict(),
+            'optim': optim_dict
+        }, ckpt_dir + name)
     print('Checkpoint is saved at %s' % ckpt_dir + name)
 
 
 
 def save_ckpt(path, model, optimizer=None, scheduler=None):
+    if hasattr(model, 'module'):
+        model = model.module
     model_state = model.state_dict()
     if optimizer:
         optim_state = optimizer.state_dict()
@@ -198,4 +254,22 @@ def dict2str(log_dict):
     res = ''
     for key, value in log_dict.items():
         res += f'{key}: {value}|'
-    return res
\ No newline at end of file
+    return res
+
+def write_sweep_result(metrics):
+    '''
+    Write the final metrics of a run to the json file given by $PINO_SWEEP_RESULT,
+    sweep.py sets the variable and collects the file. Does nothing outside a sweep.
+    Args:
+        metrics: dict of scalars
+    '''
+    path = os.environ.get('PINO_SWEEP_RESULT')
+    if not path:
+        return
+    result = {}
+    for key, value in metrics.items():
+        if torch.is_tensor(value):
+            value = value.item()
+        result[key] = float(value)
+    with open(path, 'w') as f:
+        json.dump(result, f)
@@ -0,0 +1,147 @@
+import os
+import torch
+
+
+def ic_embedding(a_in, modes=8):
+    '''
+    Compact embedding of the initial condition: its lowest Fourier coefficients
+    Args:
+        a_in: input of FNO3d with shape (batchsize, x_grid, y_grid, t_grid, 4), the last channel is the initial condition
+        modes: number of modes kept in each direction
+    Returns:
+        real tensor of shape (batchsize, 4 * modes * modes)
+    '''
+    u0 = a_in[:, :, :, 0, -1]
+    size = u0.shape[1] * u0.shape[2]
+    u0_h = torch.fft.rfft2(u0) / size
+    coeff = torch.cat([u0_h[:, :modes, :modes], u0_h[:, -modes:, :modes]], dim=1)
+    return torch.view_as_real(coeff).reshape(u0.shape[0], -1)
+
+
+def _compress(delta, rank):
+    '''
+    Truncated SVD of a weight delta reshaped into a matrix, kept only if it is smaller
+    '''
+    if rank is None or delta.dim() < 2:
+        return delta
+    mat = delta.reshape(delta.shape[0], -1)
+    if rank * (mat.shape[0] + mat.shape[1]) >= mat.numel():
+        return delta
+    U, S, Vh = torch.linalg.svd(mat, full_matrices=False)
+    return {'U': U[:, :rank] * S[:rank].to(U.dtype), 'V': Vh[:rank], 'shape': tuple(delta.shape)}
+
+
+def _decompress(delta):
+    if isinstance(delta, dict):
+        return (delta['U'] @ delta['V']).reshape(delta['shape'])
+    return delta
+
+
+class WarmStartStore(object):
+    '''
+    Finetuned weights of solved instances, indexed by the embedding of their initial conditions.
+    Each entry stores the difference to the pretrained weights, optionally compressed to a low rank,
+    so that a new instance can start from the solution of its nearest neighbor.
+    '''
+    def __init__(self, store_dir, modes=8, rank=None, max_dist=None):
+        '''
+        Args:
+            store_dir: directory of the store
+            modes: number of Fourier modes of the embedding in each direction
+            rank: rank of the stored deltas, None stores them in full
+            max_dist: largest relative distance of a neighbor to start from, None accepts any
+        '''
+        self.store_dir = store_dir
+        self.modes = modes
+        self.rank = rank
+        self.max_dist = max_dist
+        os.makedirs(store_dir, exist_ok=True)
+        self.index_path = os.path.join(store_dir, 'index.pt')
+        if os.path.exists(self.index_path):
+            index = torch.load(self.index_path)
+            self.embeddings = index['embeddings']
+            self.keys = index['keys']
+        else:
+            self.embeddings = None
+            self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def embed(self, a_in):
+        return ic_embedding(a_in, self.modes)[0].detach().cpu()
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Open the store given by the warm_start section of the train config, None if there is no such section
+        '''
+        if 'warm_start' not in config['train']:
+            return None
+        return cls(**config['train']['warm_start'])
+
+    def nearest(self, a_in, exclude=None):
+        '''
+        Args:
+            a_in: input of the new instance
+            exclude: key to leave out, e.g. the instance itself
+        Returns:
+            key of the nearest stored instance and its relative distance, (None, None) if there is none close enough
+        '''
+        if len(self) == 0 or self.keys == [exclude]:
+            return None, None
+        emb = self.embed(a_in)
+        dists = torch.linalg.norm(self.embeddings - emb, dim=1) / torch.linalg.norm(emb).clamp_min(1e-12)
+        if exclude in self.keys:
+            dists[self.keys.index(exclude)] = float('inf')
+        dist, i = torch.min(dists, dim=0)
+        dist = dist.item()
+        if self.max_dist is not None and dist > self.max_dist:
+            return None, None
+        return self.keys[i.item()], dist
+
+    def load(self, key, base_state):
+        '''
+        Weights of a stored instance
+        Args:
+            key: key of the instance
+            base_state: state dict of the pretrained model
+        '''
+        deltas = torch.load(os.path.join(self.store_dir, f'instance-{key}.pt'))['deltas']
+        state = {}
+        for name, value in base_state.items():
+            if name in deltas:
+                state[name] = value + _decompress(deltas[name]).to(value.device, value.dtype)
+            else:
+                state[name] = value
+        return state
+
+    def add(self, key, a_in, state, base_state, meta=None):
+        '''
+        Store the finetuned weights of an instance, replacing an earlier entry of the same key
+        Args:
+            key: name of the instance, e.g. its index
+            a_in: input of the instance
+            state: finetuned state dict
+            base_state: pretrained state dict
+            meta: optional dict saved with the entry
+        '''
+        deltas = {}
+        for name, value in state.items():
+            if torch.is_floating_point(value) or torch.is_complex(value):
+                delta = (value - base_state[name]).detach().cpu()
+                deltas[name] = _compress(delta, self.rank)
+        torch.save({'deltas': deltas, 'meta': meta}, os.path.join(self.store_dir, f'instance-{key}.pt'))
+
+        emb = self.embed(a_in)[None]
+        if key in self.keys:
+            self.embeddings[self.keys.index(key)] = emb[0]
+        elif self.embeddings is None:
+            self.keys = [key]
+            self.embeddings = emb
+        else:
+            self.keys.append(key)
+            self.embeddings = torch.cat([self.embeddings, emb], dim=0)
+        tmp_path = self.index_path + '.tmp'
+        torch.save({'embeddings': self.embeddings, 'keys': self.keys}, tmp_path)
+        os.replace(tmp_path, self.index_path)